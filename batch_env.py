@@ -0,0 +1,386 @@
+import random
+import time
+
+import numpy as np
+
+from game_variants import get_variant, UNKNOWN, CARD_STR
+from play_util import to_model_input
+from legal_actions import OutputTable, ACTION_PLAY, ACTION_DISCARD, ACTION_CLUE
+
+# 同时进行 N 局游戏的 numpy 环境, 规则与 GameController.online_handle_play/discard/clue 完全一致
+# 所有对局同步行动, 每一步的行动座位相同, 因此每个座位一份 batch 为 N 的 KV cache, 每一步只需要一次 batch 前向
+# 牌用 (颜色, 数字) 两个整数表示, 9 表示未知(对应字符串中的 "_")
+# 输出的 token id 与 GameController.AIids 完全相同
+
+def _token_id(vocab, token):
+    # 与 ActionVocab.encode 相同, 不认识的 token 用 -1 表示(不输入模型)
+    idx = vocab.get(token)
+    if idx is None:
+        idx = vocab.get(token.replace("light-myself", "light_myself"), -1)
+    return idx
+
+
+class BatchHanabiEnv:
+    def __init__(self, controller, variant, players, seeds):
+        # 玩法规则来自 game_variants, controller 只提供词表以及模型
+        self.variant = get_variant(variant)
+        self.players = players
+        self.hand_max = 5 if players <= 3 else 4
+        self.suits = self.variant.suits
+        self.special = self.variant.special_dict
+        self.options_token_list = [f"Players-{players}", *self.variant.options_tokens]
+        self.n_games = len(seeds)
+        self.seeds = list(seeds)
+        self.max_seq_len = controller.model.params.max_seq_len
+        self.options_count = len(self.options_token_list)
+        self.build_tables(controller)
+        self.reset()
+
+    def build_tables(self, controller):
+        vocab = controller.action_dict_toid
+        P = self.players
+        card_range = range(10)
+        self.pr_ids = np.array([_token_id(vocab, f"light-PR{rpid}") for rpid in range(P)])
+        self.light_ids = np.full((10, 10, 10, 10), -1, dtype=np.int64)
+        self.myself_ids = np.full((10, 10), -1, dtype=np.int64)
+        for ks in card_range:
+            for kr in card_range:
+                self.myself_ids[ks, kr] = _token_id(vocab, f"light-myself-{CARD_STR[ks * 10 + kr]}")
+                for s in range(self.suits):
+                    for r in range(1, 6):
+                        self.light_ids[s, r, ks, kr] = _token_id(vocab, f"light-{CARD_STR[s * 10 + r]}-{CARD_STR[ks * 10 + kr]}")
+        self.option_ids = np.array([_token_id(vocab, token) for token in self.options_token_list]
+                                   + [_token_id(vocab, "myturn-1")])
+        self.clues_ids = np.array([_token_id(vocab, f"clues-{clue}") for clue in range(9)])
+        self.play_ids = np.full((P, 10), -1, dtype=np.int64)
+        self.discard_ids = np.full((P, 10), -1, dtype=np.int64)
+        for rpid in range(P):
+            who = "myself" if rpid == 0 else f"PR{rpid}"
+            for pos in range(10):
+                self.play_ids[rpid, pos] = _token_id(vocab, f"play-{who}-POS{pos}")
+                self.discard_ids[rpid, pos] = _token_id(vocab, f"discard-{who}-POS{pos}")
+        self.played_ids = np.full((10, 10), -1, dtype=np.int64)
+        self.lossed_ids = np.full((10, 10), -1, dtype=np.int64)
+        for s in range(self.suits):
+            for r in range(1, 6):
+                self.played_ids[s, r] = _token_id(vocab, f"played-{CARD_STR[s * 10 + r]}")
+                self.lossed_ids[s, r] = _token_id(vocab, f"lossed-{CARD_STR[s * 10 + r]}")
+        self.clue_ids = np.full((P, P, 2, 10), -1, dtype=np.int64)
+        for from_rpid in range(P):
+            for to_rpid in range(P):
+                for clue_type, letter in ((0, "I"), (1, "R")):
+                    for value in range(10):
+                        token = f"clue-PRF{from_rpid}->PRT{to_rpid}-{letter}{value}"
+                        token = token.replace("PRF0", "myself").replace("PRT0", "myself")
+                        self.clue_ids[from_rpid, to_rpid, clue_type, value] = _token_id(vocab, token)
+
+        # 模型输出 id -> 动作的解码以及合法动作的检查
+        self.outputs = OutputTable(controller.output_action_dict_toact, self.variant)
+
+    def reset(self):
+        N, P, H, S = self.n_games, self.players, self.hand_max, self.suits
+        # 牌堆与 selfplay.play_game 相同(玩法的 deck 经 random.Random(seed).shuffle), 从末尾开始摸牌
+        decks = []
+        for seed in self.seeds:
+            deck = list(self.variant.deck)
+            random.Random(seed).shuffle(deck)
+            decks.append(deck[::-1])
+        self.deck = np.array(decks, dtype=np.int64)
+        self.deck_size = self.deck.shape[1]
+        self.deck_pos = np.zeros(N, dtype=np.int64)
+        self.hand_suit = np.zeros((N, P, H), dtype=np.int64)
+        self.hand_rank = np.zeros((N, P, H), dtype=np.int64)
+        self.known_suit = np.full((N, P, H), UNKNOWN, dtype=np.int64)
+        self.known_rank = np.full((N, P, H), UNKNOWN, dtype=np.int64)
+        self.hand_size = np.zeros((N, P), dtype=np.int64)
+        self.Irank = np.zeros((N, S), dtype=np.int64)
+        self.Hrank = np.full((N, S), 5, dtype=np.int64)
+        self.discard_count = np.zeros((N, S, 6), dtype=np.int64)
+        self.clue = np.full(N, 8, dtype=np.int64)
+        self.score = np.zeros(N, dtype=np.int64)
+        self.mistake = np.zeros(N, dtype=np.int64)
+        self.final_turns = np.full(N, -1, dtype=np.int64)
+        self.done = np.zeros(N, dtype=bool)
+        self.truncated = np.zeros(N, dtype=bool)
+        self.turns = np.zeros(N, dtype=np.int64)
+        self.turn = 0
+        # 每个座位还没有交给模型的 token(其他玩家的行动)以及已经输入的长度
+        self.pending = np.full((P, N, 2 * P + 2), -1, dtype=np.int64)
+        self.pending_count = np.zeros((P, N), dtype=np.int64)
+        self.seq_len = np.zeros((N, P), dtype=np.int64)
+        rows = np.arange(N)
+        for pid in range(P):
+            for _ in range(H):
+                self.draw(rows, pid)
+
+    def set_state(self, controller, turn, hands, decks, final_turns=-1):
+        # 从 controller 当前的局面开始(用于搜索): hands 为每局每个玩家的手牌编码, decks 为每局剩余的牌(按摸牌顺序)
+        N, P, H = self.n_games, self.players, self.hand_max
+        self.deck = np.array([[(card // 10, card % 10) for card in deck] for deck in decks],
+                             dtype=np.int64).reshape(N, -1, 2)
+        self.deck_size = self.deck.shape[1]
+        self.deck_pos = np.zeros(N, dtype=np.int64)
+        self.hand_size[:] = 0
+        for pid in range(P):
+            known = controller.players[pid].known_cards
+            self.hand_size[:, pid] = len(known)
+            for pos, kcard in enumerate(known):
+                cards = np.array([hand[pid][pos] for hand in hands], dtype=np.int64)
+                self.hand_suit[:, pid, pos] = cards // 10
+                self.hand_rank[:, pid, pos] = cards % 10
+                self.known_suit[:, pid, pos] = kcard // 10
+                self.known_rank[:, pid, pos] = kcard % 10
+        codes = np.arange(self.suits)[:, None] * 10 + np.arange(6)[None]
+        self.discard_count[:] = np.array(controller.discard_count)[codes][None]
+        self.Irank[:] = controller.Irank
+        self.Hrank[:] = controller.Hrank
+        self.clue[:] = controller.clue
+        self.score[:] = controller.score
+        self.mistake[:] = controller.mistake
+        self.final_turns[:] = final_turns
+        self.done[:] = False
+        self.truncated[:] = False
+        self.turns[:] = 0
+        self.turn = turn
+        self.pending_count[:] = 0
+        self.seq_len[:] = 0
+
+    @property
+    def active_pid(self):
+        return self.turn % self.players
+
+    def draw(self, rows, pid):
+        rows = rows[self.deck_pos[rows] < self.deck_size]
+        slot = self.hand_size[rows, pid]
+        card = self.deck[rows, self.deck_pos[rows]]
+        self.hand_suit[rows, pid, slot] = card[:, 0]
+        self.hand_rank[rows, pid, slot] = card[:, 1]
+        self.known_suit[rows, pid, slot] = UNKNOWN
+        self.known_rank[rows, pid, slot] = UNKNOWN
+        self.hand_size[rows, pid] += 1
+        self.deck_pos[rows] += 1
+        return rows
+
+    def push_tokens(self, rows, token_ids):
+        # token_ids: (P, len(rows)), 每个座位视角下的 token
+        for seat in range(self.players):
+            ids = token_ids[seat]
+            self.pending[seat, rows, self.pending_count[seat, rows]] = ids
+            self.pending_count[seat, rows] += 1
+
+    def observe(self):
+        # 返回当前行动座位每局新增的 token id (左侧补 0) 以及 pad_mask
+        N, P, H = self.n_games, self.players, self.hand_max
+        pid = self.active_pid
+        rows = np.arange(N)
+        turn_len = P + self.hand_size.sum(axis=1) + self.options_count + 2
+        pending_mask = np.arange(self.pending.shape[2])[None] < self.pending_count[pid][:, None]
+        pending_len = (pending_mask & (self.pending[pid] >= 0)).sum(axis=1)
+        full = ~self.done & (self.seq_len[:, pid] + pending_len + turn_len > self.max_seq_len)
+        self.truncated |= full
+        self.done |= full
+
+        blocks = [self.pending[pid]]
+        masks = [pending_mask]
+        slots = np.arange(H)[None]
+        for rpid in range(P - 1, -1, -1):
+            owner = (pid + rpid) % P
+            blocks.append(np.full((N, 1), self.pr_ids[rpid]))
+            masks.append(np.ones((N, 1), dtype=bool))
+            ks, kr = self.known_suit[:, owner], self.known_rank[:, owner]
+            if rpid == 0:
+                blocks.append(self.myself_ids[ks, kr])
+            else:
+                blocks.append(self.light_ids[self.hand_suit[:, owner], self.hand_rank[:, owner], ks, kr])
+            masks.append(slots < self.hand_size[:, owner][:, None])
+        blocks.append(np.broadcast_to(self.option_ids, (N, len(self.option_ids))))
+        masks.append(np.ones((N, len(self.option_ids)), dtype=bool))
+        blocks.append(self.clues_ids[self.clue][:, None])
+        masks.append(np.ones((N, 1), dtype=bool))
+
+        ids = np.concatenate(blocks, axis=1)
+        mask = np.concatenate(masks, axis=1) & (ids >= 0) & ~self.done[:, None]
+        # 有效 token 保持原顺序移到右侧(左侧 padding)
+        order = np.argsort(mask, axis=1, kind="stable")
+        ids = np.take_along_axis(ids, order, axis=1)
+        mask = np.take_along_axis(mask, order, axis=1)
+        length = int(mask.sum(axis=1).max()) if N > 0 else 0
+        ids = np.where(mask, ids, 0)[:, ids.shape[1] - length:]
+        mask = mask[:, mask.shape[1] - length:]
+        self.seq_len[rows, pid] += mask.sum(axis=1)
+        self.pending_count[pid][~self.done] = 0
+        return ids, mask
+
+    def decode(self, out_ids):
+        # 模型输出 id -> (类型, 位置, 目标玩家, 提示类型, 提示值)
+        return self.outputs.decode(self.active_pid, self.players, out_ids)
+
+    def hand_codes(self):
+        return self.hand_suit * 10 + self.hand_rank
+
+    def legal_mask(self):
+        # (N, 输出数量): 当前行动座位每局的合法输出
+        return self.outputs.legal_mask(self.active_pid, self.hand_codes(), self.hand_size, self.clue)
+
+    def touched(self, rows, to_pid, clue_type, clue_value):
+        # (len(rows), H) 被提示触及的牌
+        to_pid = np.clip(to_pid, 0, self.players - 1)
+        return self.outputs.touched(self.hand_codes()[rows, to_pid], self.hand_size[rows, to_pid], clue_type, clue_value)
+
+    def legal(self, action):
+        legal = self.outputs.action_legal(self.active_pid, action, self.hand_codes(), self.hand_size, self.clue)
+        return legal & ~self.done
+
+    def fallback(self):
+        # 与 selfplay.fallback_action 相同: 弃最老的牌 -> 给下家的第一个合法提示 -> 出最老的牌
+        N = self.n_games
+        pid = self.active_pid
+        zeros = np.zeros(N, dtype=np.int64)
+        next_pid = np.full(N, (pid + 1) % self.players if self.players > 1 else pid)
+        action_type = np.where(self.clue < 8, ACTION_DISCARD, ACTION_PLAY)
+        clue_type, clue_value = zeros.copy(), zeros.copy()
+        need_clue = self.clue >= 8
+        candidates = [(1, v) for v in range(1, 6)] + [(0, v) for v in range(self.variant.color_clue_count)]
+        for ctype, cvalue in candidates[::-1]:
+            action = (np.full(N, ACTION_CLUE), zeros, next_pid, np.full(N, ctype), np.full(N, cvalue))
+            ok = need_clue & self.legal(action)
+            action_type = np.where(ok, ACTION_CLUE, action_type)
+            clue_type = np.where(ok, ctype, clue_type)
+            clue_value = np.where(ok, cvalue, clue_value)
+        return action_type, zeros, next_pid, clue_type, clue_value
+
+    def step(self, action):
+        action_type, pos, to_pid, clue_type, clue_value = action
+        N, P, H = self.n_games, self.players, self.hand_max
+        pid = self.active_pid
+        live = ~self.done
+        seats = np.arange(P)[:, None]
+        actor_rpid = (pid - seats) % P
+
+        # 出牌/弃牌
+        rows = np.nonzero(live & (action_type != ACTION_CLUE))[0]
+        if len(rows) > 0:
+            p = pos[rows]
+            suit = self.hand_suit[rows, pid, p]
+            rank = self.hand_rank[rows, pid, p]
+            success = (action_type[rows] == ACTION_PLAY) & (self.Irank[rows, suit] + 1 == rank)
+            failed = (action_type[rows] == ACTION_PLAY) & ~success
+
+            ok = rows[success]
+            self.score[ok] += 1
+            self.clue[ok] += (rank[success] == 5) & (self.clue[ok] < 8)
+            self.Irank[ok, suit[success]] += 1
+
+            lost = rows[~success]
+            ls, lr = suit[~success], rank[~success]
+            damounts = self.discard_count[lost, ls, lr]
+            reduce = (self.Irank[lost, ls] < lr) & (((lr == 1) & (damounts == 2)) | ((lr < 5) & (damounts == 1)) | (lr == 5))
+            self.Hrank[lost[reduce], ls[reduce]] = np.minimum(lr[reduce] - 1, self.Hrank[lost[reduce], ls[reduce]])
+            self.discard_count[lost, ls, lr] += 1
+            self.mistake[lost] += failed[~success]
+            self.clue[lost] += (~failed[~success]) & (self.clue[lost] < 8)
+
+            is_play = action_type[rows] == ACTION_PLAY
+            action_ids = np.where(is_play[None], self.play_ids[actor_rpid, p[None]], self.discard_ids[actor_rpid, p[None]])
+            result_ids = np.where(success[None], self.played_ids[suit, rank][None], self.lossed_ids[suit, rank][None])
+            self.push_tokens(rows, action_ids)
+            self.push_tokens(rows, np.broadcast_to(result_ids, (P, len(rows))))
+
+            # 移除这张牌, 后面的牌向前移动, 然后摸牌
+            idx = np.minimum(np.arange(H)[None] + (np.arange(H)[None] >= p[:, None]), H - 1)
+            for array in (self.hand_suit, self.hand_rank, self.known_suit, self.known_rank):
+                array[rows, pid] = np.take_along_axis(array[rows, pid], idx, axis=1)
+            self.hand_size[rows, pid] -= 1
+            drew = self.draw(rows, pid)
+            last = drew[self.deck_pos[drew] == self.deck_size]
+            # 摸到最后一张牌之后每个人(包括自己)还有一回合
+            self.final_turns[last] = P + 1
+
+        # 提示
+        rows = np.nonzero(live & (action_type == ACTION_CLUE))[0]
+        if len(rows) > 0:
+            to, ctype, cvalue = to_pid[rows], clue_type[rows], clue_value[rows]
+            touched = self.touched(rows, to, ctype, cvalue)
+            last_special = self.special.last_special_card
+            suit = self.hand_suit[rows, to]
+            ks = self.known_suit[rows, to]
+            kr = self.known_rank[rows, to]
+            ctype_, cvalue_ = ctype[:, None], cvalue[:, None]
+            special = touched & (suit == last_special)
+            # 与 online_handle_clue 中特殊颜色的规则相同
+            color_rule = special & self.special.all_color_rule & (ks != UNKNOWN) & (ctype_ == 0)
+            color_keep = color_rule & (ks == last_special)
+            color_mark = color_rule & ~color_keep & (ks != cvalue_)
+            rank_rule = special & ~color_keep & ~color_mark & self.special.all_rank_rule & (kr != UNKNOWN) & (ctype_ == 1)
+            rank_only = rank_rule & (ks == last_special)
+            rank_mark = rank_rule & ~rank_only & (kr != cvalue_)
+            normal = touched & ~(color_keep | color_mark | rank_only | rank_mark)
+            new_ks = np.where(color_mark | rank_mark, last_special, ks)
+            new_ks = np.where(normal & (ctype_ == 0), cvalue_, new_ks)
+            new_kr = np.where(rank_only | rank_mark, cvalue_, kr)
+            new_kr = np.where(normal & (ctype_ == 1), cvalue_, new_kr)
+            self.known_suit[rows, to] = new_ks
+            self.known_rank[rows, to] = new_kr
+            self.clue[rows] -= 1
+            from_rpid = np.broadcast_to(actor_rpid, (P, len(rows)))
+            to_rpid = (to[None] - seats) % P
+            self.push_tokens(rows, self.clue_ids[from_rpid, to_rpid, ctype[None], cvalue[None]])
+
+        self.turns[live] += 1
+        self.final_turns[live & (self.final_turns > 0)] -= 1
+        max_score = 5 * self.suits
+        self.done |= live & ((self.mistake >= 3) | (self.score == max_score) | (self.final_turns == 0))
+        self.turn += 1
+
+    def results(self):
+        strikeout = self.mistake >= 3
+        return [{
+            "seed": self.seeds[g],
+            "variant": self.variant.name,
+            "players": self.players,
+            "score": 0 if strikeout[g] else int(self.score[g]),
+            "raw_score": int(self.score[g]),
+            "strikeout": bool(strikeout[g]),
+            "truncated": bool(self.truncated[g]),
+            "turns": int(self.turns[g]),
+        } for g in range(self.n_games)]
+
+
+def policy_actions(env, model, device, kv_cache, ids, mask, topk):
+    # 一次 batch 前向(不合法的输出在 topk 之前屏蔽), 每局选择 topk 中第一个合法的动作(都不合法时用 fallback)
+    # 返回 (动作, 选中的名次)
+    idx, _ = model.play_topk_batch(to_model_input(model, ids, device), to_model_input(model, mask, device),
+                                   topk, kv_cache, to_model_input(model, env.legal_mask(), device))
+    idx = np.array(idx.tolist(), dtype=np.int64)
+    chosen = env.fallback()
+    rank = np.full(env.n_games, topk)
+    for k in range(topk - 1, -1, -1):
+        action = env.decode(idx[:, k])
+        ok = env.legal(action)
+        chosen = tuple(np.where(ok, a, c) for a, c in zip(action, chosen))
+        rank = np.where(ok, k, rank)
+    return chosen, rank
+
+
+def run_batch(controller, variant, players, seeds, topk=5):
+    # 所有对局同步进行, 每一步一次 batch 前向
+    start = time.perf_counter()
+    model, device = controller.model, controller.device
+    env = BatchHanabiEnv(controller, variant, players, seeds)
+    caches = [model.new_cache() for _ in range(players)]
+    ai_rank = [[] for _ in range(env.n_games)]
+    while True:
+        pid = env.active_pid
+        ids, mask = env.observe()
+        if env.done.all():
+            break
+        chosen, rank = policy_actions(env, model, device, caches[pid], ids, mask, topk)
+        for g in np.nonzero(~env.done)[0]:
+            ai_rank[g].append(rank[g])
+        env.step(chosen)
+    seconds = (time.perf_counter() - start) / env.n_games
+    results = env.results()
+    for g, result in enumerate(results):
+        result["ai_rank"] = float(np.mean(ai_rank[g])) if len(ai_rank[g]) > 0 else 0.0
+        result["seconds"] = seconds
+    return results
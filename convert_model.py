@@ -0,0 +1,28 @@
+import sys
+import json
+
+from play_util import checkpoint_paths, convert_checkpoint, export_numpy_weights, load_model, model_file_path
+
+# 离线转换模型权重, 之后 load_model 会直接读取转换后的文件
+# 用法: python convert_model.py [model/xxx] [--numpy] [--bin]  (不填时使用 user_config.json 中的 model)
+# --numpy 额外导出 numpy 推理使用的权重(user_config.json 中 "engine": "numpy")
+# --bin 额外导出带版本号的模型文件, 两种推理都会优先 mmap 读取它
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(args) > 0:
+        model_name = args[0]
+    else:
+        with open(f'user_config.json', 'r') as json_file:
+            model_name = json.load(json_file)["model"]
+    convert_checkpoint(model_name)
+    print(f"wrote {checkpoint_paths(model_name)[1]}")
+    if "--numpy" in sys.argv:
+        print(f"wrote {export_numpy_weights(model_name)}")
+    if "--bin" in sys.argv:
+        load_model(model_name)[0].export(model_file_path(model_name))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import time
+import random
+
+import numpy as np
+
+from search import sample_world, hidden_cards
+from legal_actions import action_arrays
+
+# 牌堆摸完之后(get_current_card() == 0)的精确残局求解
+# 给定所有玩家的手牌(自己的手牌按 belief 抽样), 所有玩家配合取最高分, 对剩余回合内所有的行动序列做深度优先搜索
+# 牌堆已空时手牌的顺序以及提示的具体内容都不影响之后的得分, 因此:
+#   局面 = (每个玩家手牌的多重集合, Irank, 提示数, 失误数, 行动玩家, 剩余回合), 用 Zobrist hash 存入置换表
+#   同一玩家手中相同的牌只展开一次, 所有合法提示合并成一个动作
+# 根节点的候选动作来自模型的 topk, 分数相同时保持模型的顺序
+
+MOVE_PLAY = 0
+MOVE_DISCARD = 1
+MOVE_CLUE = 2
+
+
+class EndgameTimeout(Exception):
+    pass
+
+
+class EndgameSolver:
+    def __init__(self, controller, hands, deadline, seed=0):
+        rnd = random.Random(seed)
+        variant = controller.variant
+        P = controller.players_count
+        self.players = P
+        self.max_score = 5 * variant.suits
+        self.deadline = deadline
+        self.nodes = 0
+        self.table = {}
+        self.outputs = controller.outputs
+        # 能被至少一种合法提示触及的牌
+        self.cluable = controller.outputs.cluable.tolist()
+        # Zobrist keys: 手牌以 (玩家, 牌, 第几张相同的牌) 为单位, 与顺序无关
+        self.hand_keys = [[[rnd.getrandbits(64) for _ in range(4)] for _ in range(100)] for _ in range(P)]
+        self.irank_keys = [[rnd.getrandbits(64) for _ in range(6)] for _ in range(variant.suits)]
+        self.clue_keys = [rnd.getrandbits(64) for _ in range(9)]
+        self.mistake_keys = [rnd.getrandbits(64) for _ in range(4)]
+        self.pid_keys = [rnd.getrandbits(64) for _ in range(P)]
+        self.turn_keys = [rnd.getrandbits(64) for _ in range(2 * P + 2)]
+
+        self.hands = [list(hand) for hand in hands]
+        self.counts = [[0] * 100 for _ in range(P)]
+        self.in_hands = [0] * 100
+        self.hash = 0
+        for pid, hand in enumerate(self.hands):
+            for code in hand:
+                self.hash ^= self.hand_keys[pid][code][self.counts[pid][code]]
+                self.counts[pid][code] += 1
+                self.in_hands[code] += 1
+        self.Irank = list(controller.Irank)
+        for suit, rank in enumerate(self.Irank):
+            self.hash ^= self.irank_keys[suit][rank]
+        self.score = controller.score
+        self.clue = controller.clue
+        self.mistake = controller.mistake
+
+    def upper_bound(self, turns):
+        # 每回合最多加一分, 每种颜色只能接着打出手中还有的牌
+        potential = 0
+        for suit, rank in enumerate(self.Irank):
+            while rank < 5 and self.in_hands[suit * 10 + rank + 1] > 0:
+                rank += 1
+                potential += 1
+        return self.score + min(turns, potential)
+
+    def moves(self, pid):
+        hand = self.hands[pid]
+        codes = list(dict.fromkeys(hand))
+        playable = [code for code in codes if self.Irank[code // 10] + 1 == code % 10]
+        moves = [(MOVE_PLAY, code) for code in playable]
+        if self.clue > 0 and any(self.cluable[code] for to_pid in range(self.players) if to_pid != pid
+                                 for code in self.hands[to_pid]):
+            moves.append((MOVE_CLUE, None))
+        others = [code for code in codes if code not in playable]
+        if self.clue < 8:
+            # 先弃已经没用的牌
+            others.sort(key=lambda code: code % 10 > self.Irank[code // 10])
+            moves += [(MOVE_DISCARD, code) for code in others]
+        else:
+            # 能弃牌时打出失败不会比弃掉同一张牌更好
+            moves += [(MOVE_PLAY, code) for code in others]
+        return moves
+
+    def remove(self, pid, code):
+        self.hands[pid].remove(code)
+        self.counts[pid][code] -= 1
+        self.in_hands[code] -= 1
+        self.hash ^= self.hand_keys[pid][code][self.counts[pid][code]]
+
+    def add(self, pid, code):
+        self.hash ^= self.hand_keys[pid][code][self.counts[pid][code]]
+        self.hands[pid].append(code)
+        self.counts[pid][code] += 1
+        self.in_hands[code] += 1
+
+    def apply(self, pid, move):
+        # 返回 undo 需要的信息: (是否成功打出, 是否增加了提示)
+        kind, code = move
+        if kind == MOVE_CLUE:
+            self.clue -= 1
+            return False, False
+        self.remove(pid, code)
+        if kind == MOVE_DISCARD:
+            gain = self.clue < 8
+            self.clue += gain
+            return False, gain
+        suit, rank = code // 10, code % 10
+        if self.Irank[suit] + 1 == rank:
+            self.hash ^= self.irank_keys[suit][rank - 1] ^ self.irank_keys[suit][rank]
+            self.Irank[suit] = rank
+            self.score += 1
+            gain = rank == 5 and self.clue < 8
+            self.clue += gain
+            return True, gain
+        self.mistake += 1
+        return False, False
+
+    def undo(self, pid, move, info):
+        kind, code = move
+        played, gain = info
+        if kind == MOVE_CLUE:
+            self.clue += 1
+            return
+        self.clue -= gain
+        if played:
+            suit, rank = code // 10, code % 10
+            self.hash ^= self.irank_keys[suit][rank - 1] ^ self.irank_keys[suit][rank]
+            self.Irank[suit] = rank - 1
+            self.score -= 1
+        elif kind == MOVE_PLAY:
+            self.mistake -= 1
+        self.add(pid, code)
+
+    def value(self, pid, turns):
+        # pid 行动, 还剩 turns 回合时能得到的最高分(三次失误为 0 分)
+        if self.mistake >= 3:
+            return 0
+        if turns == 0 or self.score == self.max_score:
+            return self.score
+        self.nodes += 1
+        if self.nodes & 1023 == 0 and time.perf_counter() > self.deadline:
+            raise EndgameTimeout()
+        key = self.hash ^ self.pid_keys[pid] ^ self.turn_keys[turns] ^ self.clue_keys[self.clue] ^ \
+            self.mistake_keys[self.mistake]
+        best = self.table.get(key)
+        if best is not None:
+            return best
+        bound = self.upper_bound(turns)
+        next_pid = (pid + 1) % self.players
+        moves = self.moves(pid)
+        if len(moves) == 0:
+            # 没有手牌也没有提示可用, 只能跳过
+            best = self.value(next_pid, turns - 1)
+        else:
+            best = -1
+            for move in moves:
+                info = self.apply(pid, move)
+                score = self.value(next_pid, turns - 1)
+                self.undo(pid, move, info)
+                if score > best:
+                    best = score
+                    if best >= bound:
+                        break
+        self.table[key] = best
+        return best
+
+    def root_move(self, pid, action):
+        # GameController.get_action 的结果 -> 搜索中的动作, 不合法时返回 None
+        if action is None:
+            return None
+        if action["type"] in ("play", "discard") and action["pid"] != pid:
+            return None
+        hand_len = max(len(hand) for hand in self.hands)
+        hand_codes = np.zeros((1, self.players, max(hand_len, 1)), dtype=np.int64)
+        for to_pid, hand in enumerate(self.hands):
+            hand_codes[0, to_pid, :len(hand)] = hand
+        hand_lens = np.array([[len(hand) for hand in self.hands]], dtype=np.int64)
+        if not self.outputs.action_legal(pid, action_arrays([action]), hand_codes, hand_lens, np.array([self.clue]))[0]:
+            return None
+        if action["type"] == "clue":
+            return MOVE_CLUE, None
+        code = self.hands[pid][action["pos"]]
+        return (MOVE_DISCARD if action["type"] == "discard" else MOVE_PLAY), code
+
+    def root_values(self, pid, turns, actions):
+        values = []
+        for action in actions:
+            move = self.root_move(pid, action)
+            if move is None:
+                values.append(-np.inf)
+                continue
+            info = self.apply(pid, move)
+            values.append(self.value((pid + 1) % self.players, turns - 1))
+            self.undo(pid, move, info)
+        return values
+
+
+def solve_endgame(controller, pid, actions, time_budget, worlds=16, hands=None, seed=None):
+    # 返回每个候选动作在所有世界中的平均最终得分(不合法的动作为 -inf)
+    # hands 为 None 时按 belief 抽 worlds 个世界; 一个世界都没有算完或者看不到其他玩家的牌时返回 None
+    if hands is None and hidden_cards(controller, pid):
+        return None
+    deadline = time.perf_counter() + time_budget
+    turns = controller.final_turns if controller.final_turns > 0 else controller.players_count
+    rng = np.random.default_rng(seed)
+    totals = np.zeros(len(actions))
+    solved = 0
+    for _ in range(1 if hands is not None else worlds):
+        world = hands
+        if world is None:
+            hand, _ = sample_world(controller.belief, pid, rng)
+            world = [hand if player.pid == pid else player.cards for player in controller.players]
+        solver = EndgameSolver(controller, world, deadline)
+        try:
+            totals += solver.root_values(pid, turns, actions)
+        except EndgameTimeout:
+            break
+        solved += 1
+    if solved == 0:
+        return None
+    return totals / solved
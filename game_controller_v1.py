@@ -1,16 +1,8 @@
 from play_util import load_model, generate_answer
-from dataclasses import dataclass
 from game_utils import GameArgs
+from game_variants import get_variant
 import random
 
-@dataclass
-class SpecialGameArgs:
-    no_color_rule: bool = False
-    all_color_rule: bool = False
-    no_rank_rule: bool = False
-    all_rank_rule: bool = False
-    last_special_card: int = 4
-
 def try_start_game(gameargs: GameArgs):
     return GameController(gameargs)
 
@@ -108,54 +100,19 @@ class GameController():
         # Irank是目前的花色的情况
         self.remain_round = self.players_count
 
-        variant_one_card = ["Dark Null", "Dark Brown", "Cocoa Rainbow", "Gray", "Black", "Dark Rainbow", "Gray Pink",
-                            "Dark Pink", "Dark Omni"]
-        no_color_rule_variant = ["Null", "White", "Light Pink", "Dark Null", "Gray", "Gray Pink"]
-        all_color_rule_variant = ["Muddy Rainbow", "Rainbow", "Omni", "Cocoa Rainbow", "Dark Rainbow", "Dark Omni"]
-        no_rank_rule_variant = ["Null", "Brown", "Muddy Rainbow", "Dark Null", "Dark Brown", "Cocoa Rainbow"]
-        all_rank_rule_variant = ["Light Pink", "Pink", "Omni", "Gray Pink", "Dark Pink", "Dark Omni"]
-
+        # v1 一直只区分 5/6 种颜色, 4 Suits 仍然按 5 种颜色处理: 没有特殊颜色的就是 No Variant
+        variant_name = gameargs.variant
+        if "6 Suits" not in variant_name:
+            special = variant_name.replace("(4 Suits)", "").replace("(5 Suits)", "").replace("4 Suits", "").strip()
+            variant_name = f"{special} (5 Suits)" if special and special != "No Variant" else "No Variant"
+        variant = get_variant(variant_name)
         self.variant_name = gameargs.variant
-        self.last_one_card = False
-        self.special_dict = SpecialGameArgs()
-
+        self.last_one_card = variant.last_one_card
+        self.special_dict = variant.special_dict
         # 游戏初始情况
-        if "6 Suits" in self.variant_name:
-            # 6张牌
-            self.Irank = [0, 0, 0, 0, 0, 0]
-            self.Hrank = [5, 5, 5, 5, 5, 5]
-            index_amount = 6
-            self.special_dict.last_special_card = 5
-            self.total_card = 60
-        else:
-            # 5张牌
-            self.Irank = [0, 0, 0, 0, 0]
-            self.Hrank = [5, 5, 5, 5, 5]
-            index_amount = 5
-            self.special_dict.last_special_card = 4
-            self.total_card = 50
-
-        for vstr in variant_one_card:
-            if vstr in self.variant_name:
-                self.last_one_card = True
-                self.total_card -= 5
-                break
-        for vstr in no_color_rule_variant:
-            if vstr in self.variant_name:
-                self.special_dict.no_color_rule = True
-                break
-        for vstr in all_color_rule_variant:
-            if vstr in self.variant_name:
-                self.special_dict.all_color_rule = True
-                break
-        for vstr in no_rank_rule_variant:
-            if vstr in self.variant_name:
-                self.special_dict.no_rank_rule = True
-                break
-        for vstr in all_rank_rule_variant:
-            if vstr in self.variant_name:
-                self.special_dict.all_rank_rule = True
-                break
+        self.Irank = [0] * variant.suits
+        self.Hrank = [5] * variant.suits
+        self.total_card = variant.total_card
 
         for pid in range(self.players_count):
             self.players.append(GamePlayer(pid, self))
@@ -1,25 +1,25 @@
-from play_util import load_model, generate_answer
-from dataclasses import dataclass
+from play_util import load_model, prediction_cache_path, encode_actions, generate_answer_ids, generate_answer_lookahead, generate_answer_beam, generate_answer_positions
 from game_utils import GameArgs
+from game_variants import get_variant, UNKNOWN, UNKNOWN_CARD, CARD_STR, card_code
+from net.prefix_cache import PrefixKVCache
+from prediction_cache import PredictionCache
+from search import ismcts_search
+from endgame import solve_endgame
+from legal_actions import OutputTable
 import random
 import math
+import numpy as np
 import traceback
 import logging
 
-@dataclass
-class SpecialGameArgs:
-    no_color_rule: bool = False
-    all_color_rule: bool = False
-    no_rank_rule: bool = False
-    all_rank_rule: bool = False
-    last_special_card: int = 4
-
 def try_start_game(gameargs: GameArgs):
 
     return GameController(gameargs)
 
 
 class GamePlayer():
+    __slots__ = ("cards", "known_cards", "online_order", "pid", "game_controller")
+
     def __init__(self, pid, game_controller):
         self.cards = []
         self.known_cards = []
@@ -30,27 +30,20 @@ class GamePlayer():
     def gain_card(self, card, order=None):
         self.cards.append(card)
         self.online_order.append(order)
-        self.known_cards.append("I_R_")
+        self.known_cards.append(UNKNOWN_CARD)
+        if order is not None:
+            self.game_controller.order_slot[order] = (self.pid, len(self.cards) - 1)
 
     def get_light_card(self, rpid):
-        light_tokens = []
-        token = f"light-PR{rpid}"
-        light_tokens.append(token)
-        for i in range(len(self.cards)):
-            lcard = self.cards[i]
-            kcard = self.known_cards[i]
-            token = f"light-{lcard}-{kcard}"
-            light_tokens.append(token)
+        light_tokens = [f"light-PR{rpid}"]
+        for card, kcard in zip(self.cards, self.known_cards):
+            light_tokens.append(f"light-{CARD_STR[card]}-{CARD_STR[kcard]}")
         return light_tokens
 
     def get_light_card_myself(self):
-        light_tokens = []
-        token = f"light-PR0"
-        light_tokens.append(token)
-        for i in range(len(self.cards)):
-            kcard = self.known_cards[i]
-            token = f"light-myself-{kcard}"
-            light_tokens.append(token)
+        light_tokens = [f"light-PR0"]
+        for kcard in self.known_cards:
+            light_tokens.append(f"light-myself-{CARD_STR[kcard]}")
         return light_tokens
 
     def get_card_at(self, index):
@@ -59,22 +52,124 @@ class GamePlayer():
     def remove_card_at(self, index):
         self.cards.pop(index)
         self.known_cards.pop(index)
-        self.online_order.pop(index)
-
-    def get_clue(self, clue, clue_type, clue_value):
-        # clue的格式是一个 I_ 或者 R_
-        for card_ind in range(len(self.cards)):
-            # print(clue_info, target_card[card_ind], (clue_info in target_card[card_ind]))
-            if clue in self.cards[card_ind]:
+        order = self.online_order.pop(index)
+        # 后面的牌向前移动一位
+        order_slot = self.game_controller.order_slot
+        order_slot.pop(order, None)
+        for pos in range(index, len(self.online_order)):
+            if self.online_order[pos] is not None:
+                order_slot[self.online_order[pos]] = (self.pid, pos)
+
+    def get_clue(self, clue_type, clue_value):
+        # 按玩法的提示规则(clue_touch 位掩码)更新被提示到的牌
+        touch = self.game_controller.clue_touch[clue_type][clue_value]
+        for card_ind, card in enumerate(self.cards):
+            if (touch >> card) & 1:
                 kcard = self.known_cards[card_ind]
                 if clue_type == 0:
-                    self.known_cards[card_ind] = kcard[:1] + f"{clue_value}" + kcard[2:]
+                    self.known_cards[card_ind] = clue_value * 10 + kcard % 10
                 elif clue_type == 1:
-                    self.known_cards[card_ind] = kcard[:3] + f"{clue_value}" + kcard[4:]
+                    self.known_cards[card_ind] = kcard // 10 * 10 + clue_value
+
+
+class CardBelief():
+    # 每张手牌还可能是哪些牌: masks[pid, pos, code] (code = 颜色 * 10 + 数字), 由提示(包括没有被触及的负面信息)按玩法的触及表更新
+    # unseen[code] 是还没有公开(打出/弃掉)的数量, held[pid, code] 是 pid 手中别人能看到的数量
+    # 对 pid 来说, 剩余可能的牌 = unseen - 其他玩家手中的牌, 与 masks 相乘就是每张牌的候选以及权重
+    __slots__ = ("touch", "masks", "hand_len", "unseen", "held")
+
+    def __init__(self, variant, players, hand_max):
+        codes = np.arange(100)
+        self.touch = np.array([[(mask >> codes) & 1 == 1 for mask in masks] for masks in variant.clue_touch])
+        deck_codes = [suit * 10 + rank for suit, rank in variant.deck]
+        self.unseen = np.bincount(deck_codes, minlength=100)
+        self.masks = np.zeros((players, hand_max, 100), dtype=bool)
+        self.hand_len = np.zeros(players, dtype=np.int64)
+        self.held = np.zeros((players, 100), dtype=np.int64)
+
+    def state(self):
+        # 撤回用的快照: 都是固定大小的数组(玩家数 * 手牌数 * 100), 与对局长度无关; touch 是只读的, 不复制
+        return self.masks.copy(), self.hand_len.copy(), self.unseen.copy(), self.held.copy()
+
+    def set_state(self, state):
+        masks, hand_len, unseen, held = state
+        self.masks, self.hand_len, self.unseen, self.held = masks.copy(), hand_len.copy(), unseen.copy(), held.copy()
+
+    def draw(self, pid, card):
+        pos = self.hand_len[pid]
+        self.masks[pid, pos] = self.unseen > 0
+        self.hand_len[pid] += 1
+        if card // 10 != UNKNOWN and card % 10 != UNKNOWN:
+            self.held[pid, card] += 1
+
+    def reveal(self, pid, pos, card, visible):
+        # 打出/弃掉的牌公开, 后面的牌向前移动一位; visible 表示这张牌之前已经计入 held
+        self.masks[pid, pos:-1] = self.masks[pid, pos + 1:]
+        self.masks[pid, -1] = False
+        self.hand_len[pid] -= 1
+        self.unseen[card] -= 1
+        if visible:
+            self.held[pid, card] -= 1
+
+    def clue(self, pid, positions, clue_type, clue_value):
+        touched = np.zeros(self.masks.shape[1], dtype=bool)
+        touched[positions] = True
+        touch = self.touch[clue_type, clue_value]
+        self.masks[pid] &= np.where(touched[:, None], touch[None], ~touch[None])
+
+    def remaining(self, pid):
+        return self.unseen - self.held.sum(axis=0) + self.held[pid]
+
+    def weights(self, pid):
+        # (手牌数, 100): 每张手牌是某种牌的相对可能性(剩余数量)
+        return self.masks[pid, :self.hand_len[pid]] * np.maximum(self.remaining(pid), 0)[None]
+
+    def possible(self, pid):
+        return self.weights(pid) > 0
+
+
+class GameSnapshot():
+    # 撤回用的对局快照: 手牌以及计数按值保存(O(手牌数)), 只会向后追加的列表(token, id, 弃牌, 预测)只记录长度
+    __slots__ = ("hands", "Irank", "Hrank", "clue", "score", "mistake", "turn", "active_pid", "round_p", "round",
+                 "final_turns", "current_card_index", "discard_len", "token_lens", "id_lens", "pred_lens", "null_tokens",
+                 "belief")
+
+    def __init__(self, controller):
+        self.hands = tuple((tuple(player.cards), tuple(player.known_cards), tuple(player.online_order))
+                           for player in controller.players)
+        self.Irank = tuple(controller.Irank)
+        self.Hrank = tuple(controller.Hrank)
+        self.clue = controller.clue
+        self.score = controller.score
+        self.mistake = controller.mistake
+        self.turn = controller.turn
+        self.active_pid = controller.active_pid
+        self.round_p = controller.round_p
+        self.round = controller.round
+        self.final_turns = controller.final_turns
+        self.current_card_index = controller.current_card_index
+        self.discard_len = len(controller.discard_cards)
+        self.token_lens = tuple(len(tokens) for tokens in controller.AItokens)
+        self.id_lens = tuple(len(ids) for ids in controller.AIids)
+        self.pred_lens = tuple(len(preds) for preds in controller.AI_pred_cache)
+        self.null_tokens = tuple(controller.AInull)
+        self.belief = controller.belief.state()
 
 
 # I_R_ 表示牌,当表示自己的牌是未知的时候使用 IURU
 class GameController():
+    __slots__ = ("model", "action_dict_toact", "action_dict_toid", "output_action_dict_toact", "output_action_dict_toid",
+                 "device", "ahead_step", "ahead_p", "search_time", "search_batch", "endgame_time", "beam_width",
+                 "beam_prune", "decision_mode", "history_kv", "prediction_cache",
+                 "game_history", "history_prefix", "history_predicts", "history_topk",
+                 "players_count", "players_card_count", "players", "AIplayes", "AItokens", "AImasks", "AIturn",
+                 "AIids", "AInull", "AIcaches", "draw_check_value", "allow_drawback", "ramdom_start", "all_cards",
+                 "discard_cards", "current_card_index", "game_actions", "AI_pred_cache", "action_list_cache",
+                 "op_token", "turn", "clue", "score", "mistake", "active_pid", "round_p", "round", "remain_round",
+                 "variant_name", "last_one_card", "special_dict", "Irank", "Hrank", "total_card",
+                 "options_token_list", "clue_touch", "order_slot", "variant", "discard_count", "belief", "final_turns", "outputs",
+                 "undo_stack")
+
     def start_game(self, gameargs: GameArgs):
         # if not gameargs.random_start:
         #     if gameargs.start_card is None:
@@ -86,6 +181,11 @@ class GameController():
 
         # self.online_card_order = []
         self.game_history = []
+        # 每个视角缓存的 token 前缀, 以及回放分析时预先算好的每一步预测: index -> (action_ids, action_probs)
+        self.history_prefix = {}
+        self.history_predicts = {}
+        self.history_topk = 0
+        self.history_kv.clear()
         self.players_count = gameargs.players
         self.players_card_count = gameargs.players_card
         self.players = []
@@ -93,15 +193,25 @@ class GameController():
         self.AItokens = [[] for _ in range(self.players_count)]
         self.AImasks = [[] for _ in range(self.players_count)]
         self.AIturn = [1 for _ in range(self.players_count)]
+        # 每个座位的 token id(添加 token 时编码一次), 以及对应的 KV cache
+        self.AIids = [[] for _ in range(self.players_count)]
+        # 每个座位第一个不认识的 token(NULL[...]), 出现之后该座位的序列无法输入模型
+        self.AInull = [None for _ in range(self.players_count)]
+        self.AIcaches = [None for _ in range(self.players_count)]
         self.draw_check_value = random.randint(2, 7)
         # 目前默认所有玩法都是普通玩法
 
         self.allow_drawback = gameargs.allow_drawback
+        # 允许撤回时每次 出牌/弃牌/提示 之前保存一个快照, undo() 回到上一个快照而不是重放整局
+        self.undo_stack = []
         # 是否是一把随机发牌的游戏(这说明只存在AI,并且整个游戏是完全自动的)
         self.ramdom_start = gameargs.random_start
         # 所有牌，发牌按照该顺序发牌
         self.all_cards = []
         self.discard_cards = []
+        # 每种牌(整数编码)被弃掉/打出失败的数量, 以及在线对局中 order -> (pid, 手牌位置)
+        self.discard_count = [0] * 100
+        self.order_slot = {}
         # 目前发到的牌的index
         self.current_card_index = 0
 
@@ -119,126 +229,166 @@ class GameController():
         self.round = 0
         # Irank是目前的花色的情况
         self.remain_round = self.players_count
+        # 摸到最后一张牌之后还剩的回合数(包括当前回合), -1 表示牌堆还没有摸完
+        self.final_turns = -1
 
-        variant_one_card = ["Dark Null", "Dark Brown", "Cocoa Rainbow", "Gray", "Black", "Dark Rainbow", "Gray Pink",
-                            "Dark Pink", "Dark Omni"]
-        no_color_rule_variant = ["Null", "White", "Light Pink", "Dark Null", "Gray", "Gray Pink"]
-        all_color_rule_variant = ["Muddy Rainbow", "Rainbow", "Omni", "Cocoa Rainbow", "Dark Rainbow", "Dark Omni"]
-        no_rank_rule_variant = ["Null", "Brown", "Muddy Rainbow", "Dark Null", "Dark Brown", "Cocoa Rainbow"]
-        all_rank_rule_variant = ["Light Pink", "Pink", "Omni", "Gray Pink", "Dark Pink", "Dark Omni"]
-
+        # 玩法规则直接查表(game_variants 中 import 时已经建好)
+        self.variant = get_variant(gameargs.variant)
         self.variant_name = gameargs.variant
-        self.last_one_card = False
-        self.special_dict = SpecialGameArgs()
-
+        self.last_one_card = self.variant.last_one_card
+        self.special_dict = self.variant.special_dict
         # 游戏初始情况
-        if "6 Suits" in self.variant_name:
-            # 6张牌
-            self.Irank = [0, 0, 0, 0, 0, 0]
-            self.Hrank = [5, 5, 5, 5, 5, 5]
-            index_amount = 6
-            self.special_dict.last_special_card = 5
-            self.total_card = 60
-        elif "4 Suits" in self.variant_name:
-            # 4张牌
-            self.Irank = [0, 0, 0, 0]
-            self.Hrank = [5, 5, 5, 5]
-            index_amount = 4
-            self.special_dict.last_special_card = 3
-            self.total_card = 40
-        else:
-            # 5张牌
-            self.Irank = [0, 0, 0, 0, 0]
-            self.Hrank = [5, 5, 5, 5, 5]
-            index_amount = 5
-            self.special_dict.last_special_card = 4
-            self.total_card = 50
-
-        for vstr in variant_one_card:
-            if vstr in self.variant_name:
-                self.last_one_card = True
-                self.total_card -= 5
-                break
-        for vstr in no_color_rule_variant:
-            if vstr in self.variant_name:
-                self.special_dict.no_color_rule = True
-                break
-        for vstr in all_color_rule_variant:
-            if vstr in self.variant_name:
-                self.special_dict.all_color_rule = True
-                break
-        for vstr in no_rank_rule_variant:
-            if vstr in self.variant_name:
-                self.special_dict.no_rank_rule = True
-                break
-        for vstr in all_rank_rule_variant:
-            if vstr in self.variant_name:
-                self.special_dict.all_rank_rule = True
-                break
-
-        self.options_token_list = [f"Players-{self.players_count}", f"Suits-{index_amount}"]
-        last_pos_color = self.variant_name
-        if last_pos_color != "No Variant" and last_pos_color != "6 Suits" and last_pos_color != "4 Suits":
-            last_pos_color = last_pos_color.replace("(5 Suits)", "")
-            last_pos_color = last_pos_color.replace("(6 Suits)", "")
-            last_pos_color = last_pos_color.strip()
-            self.options_token_list.append(f"Special-I{self.special_dict.last_special_card}-{last_pos_color}")
+        self.Irank = [0] * self.variant.suits
+        self.Hrank = [5] * self.variant.suits
+        self.total_card = self.variant.total_card
+        # clue_touch[clue_type][clue_value]: 该提示会触及的牌(以牌的整数编码为位)
+        self.clue_touch = self.variant.clue_touch
+        self.options_token_list = [f"Players-{self.players_count}", *self.variant.options_tokens]
+        # 模型输出的解码表以及该玩法的提示触及表(计算合法动作掩码)
+        self.outputs = OutputTable(self.output_action_dict_toact, self.variant)
+        # 每张手牌的候选牌(只在在线对局的 online_handle_* 中更新)
+        self.belief = CardBelief(self.variant, self.players_count, self.players_card_count)
 
         for pid in range(self.players_count):
             self.players.append(GamePlayer(pid, self))
 
+    def load_history(self, history_data):
+        # 载入回放, 清空按视角缓存的 token 前缀以及预先算好的预测
+        self.game_history = history_data
+        self.history_prefix = {}
+        self.history_predicts = {}
+        self.history_kv.clear()
+
+    def get_histroy_step_tokens(self, index, my_pid):
+        # 第 index 步在 my_pid 视角下的 token
+        # 返回 (step_tokens, tail_tokens): 轮到自己时的行动放在 tail 中, 只有之后的步骤才能看到
+        step_tokens = []
+        tail_tokens = []
+        history_dict = self.game_history[index]
+        action = history_dict["action"]
+        active_pid = history_dict["active_pid"]
+        action_cause = history_dict["action_cause"]
+        if active_pid == my_pid:
+            #轮到本玩家操作
+            cards = history_dict["cards"]
+            kcards = history_dict["kcards"]
+            suits = len(history_dict["Hrank"])
+            varient = history_dict["varient"]
+            #所有人的卡(PRN->PR0)
+            for rpid in range(self.players_count - 1, -1, -1):
+                pid = active_pid + rpid
+                if pid >= self.players_count:
+                    pid -= self.players_count
+                #print("pid,rpid", pid, rpid)
+                token = f"light-PR{rpid}"
+                step_tokens.append(token)
+                for i in range(len(cards[pid])):
+                    lcard = cards[pid][i]
+                    kcard = kcards[pid][i]
+                    if rpid == 0:
+                        token = f"light-myself-{kcard}"
+                    else:
+                        token = f"light-{lcard}-{kcard}"
+                    step_tokens.append(token)
+            #对局信息
+            #"Players-2", "Suits-6", "Special-I5-Rainbow", "myturn-1", "clues-8"
+            step_tokens.append(f"Players-{self.players_count}")
+            step_tokens.append(f"Suits-{suits}")
+            if varient != "No Variant" and varient != "6 Suits" and varient != "4 Suits":
+                step_tokens.append(varient)
+            step_tokens.append(f'myturn-{history_dict["myturn"]}')
+            step_tokens.append(f'clues-{history_dict["clue"]}')
+            #已经行动的步骤要添加到token中
+            tail_tokens.append(action["token"])
+            if action_cause is not None:
+                tail_tokens.append(action_cause)
+        else:
+            #其他玩家操作
+            raction_token = self.get_action_token(action, my_pid)
+            step_tokens.append(raction_token)
+            #有一张牌被弃或打出了
+            if action_cause is not None:
+                step_tokens.append(action_cause)
+        return step_tokens, tail_tokens
+
+    def get_histroy_prefix(self, current_index, my_pid):
+        # 每个视角的 token/id 只按步骤向后追加一次, marks[index] 是第 index 步的前缀长度
+        # 之后任意跳转(包括向前)都只是取前缀
+        prefix = self.history_prefix.get(my_pid)
+        if prefix is None:
+            prefix = {"tokens": [], "marks": [], "ids": [], "id_marks": [], "null": None}
+            self.history_prefix[my_pid] = prefix
+        while len(prefix["marks"]) <= current_index:
+            index = len(prefix["marks"])
+            step_tokens, tail_tokens = self.get_histroy_step_tokens(index, my_pid)
+            for tokens, null_index in ((step_tokens, index), (tail_tokens, index + 1)):
+                prefix["tokens"].extend(tokens)
+                token_ids = encode_actions(tokens, self.action_dict_toid)
+                if isinstance(token_ids, str):
+                    # 不认识的 token: 从这一步开始的前缀都无法输入模型
+                    if prefix["null"] is None:
+                        prefix["null"] = (null_index, token_ids)
+                else:
+                    prefix["ids"].extend(token_ids)
+                if tokens is step_tokens:
+                    prefix["marks"].append(len(prefix["tokens"]))
+                    prefix["id_marks"].append(len(prefix["ids"]))
+        return prefix
+
     def get_histroy_tokens(self, current_index):
-        token_list = []
-        my_pid = self.active_pid
-        #print("my_pid ", my_pid)
-        for index in range(current_index + 1):
-            history_dict = self.game_history[index]
-            action = history_dict["action"]
-            active_pid = history_dict["active_pid"]
-            action_cause = history_dict["action_cause"]
-            if active_pid == my_pid:
-                #轮到本玩家操作
-                cards = history_dict["cards"]
-                kcards = history_dict["kcards"]
-                suits = len(history_dict["Hrank"])
-                varient = history_dict["varient"]
-                #所有人的卡(PRN->PR0)
-                for rpid in range(self.players_count - 1, -1, -1):
-                    pid = active_pid + rpid
-                    if pid >= self.players_count:
-                        pid -= self.players_count
-                    #print("pid,rpid", pid, rpid)
-                    token = f"light-PR{rpid}"
-                    token_list.append(token)
-                    for i in range(len(cards[pid])):
-                        lcard = cards[pid][i]
-                        kcard = kcards[pid][i]
-                        if rpid == 0:
-                            token = f"light-myself-{kcard}"
-                        else:
-                            token = f"light-{lcard}-{kcard}"
-                        token_list.append(token)
-                #对局信息
-                #"Players-2", "Suits-6", "Special-I5-Rainbow", "myturn-1", "clues-8"
-                token_list.append(f"Players-{self.players_count}")
-                token_list.append(f"Suits-{suits}")
-                if varient != "No Variant" and varient != "6 Suits" and varient != "4 Suits":
-                    token_list.append(varient)
-                token_list.append(f'myturn-{history_dict["myturn"]}')
-                token_list.append(f'clues-{history_dict["clue"]}')
-                #已经行动的步骤要添加到token中
-                if index < current_index:
-                    token_list.append(action["token"])
-                    if action_cause is not None:
-                        token_list.append(action_cause)
-            else:
-                #其他玩家操作
-                raction_token = self.get_action_token(action, my_pid)
-                token_list.append(raction_token)
-                #有一张牌被弃或打出了
-                if action_cause is not None:
-                    token_list.append(action_cause)
-        return token_list
+        prefix = self.get_histroy_prefix(current_index, self.active_pid)
+        return prefix["tokens"][:prefix["marks"][current_index]]
+
+    def get_histroy_ids(self, current_index):
+        # 与 encode_actions(get_histroy_tokens(current_index)) 相同, 不认识的 token 返回 NULL 字符串
+        prefix = self.get_histroy_prefix(current_index, self.active_pid)
+        if prefix["null"] is not None and prefix["null"][0] <= current_index:
+            return prefix["null"][1]
+        return prefix["ids"][:prefix["id_marks"][current_index]]
+
+    def get_cached_predict(self, input_id, topk, masked=False):
+        if self.prediction_cache is None:
+            return None
+        return self.prediction_cache.get(input_id, topk, masked)
+
+    def put_cached_predict(self, input_id, topk, action_ids, action_probs, masked=False):
+        if self.prediction_cache is not None:
+            self.prediction_cache.put(input_id, topk, action_ids, action_probs, masked)
+
+    def precompute_history(self, topk):
+        # 模型是 causal 的: 某个座位最后一次决策的序列包含了该座位之前所有决策点的前缀
+        # 每个座位整段前向一次, 取出所有决策点位置的输出
+        self.history_predicts = {}
+        self.history_topk = topk
+        max_seq_len = self.model.params.max_seq_len
+        current_pid = self.active_pid
+        for pid in range(self.players_count):
+            indices = [i for i, history_dict in enumerate(self.game_history) if history_dict["active_pid"] == pid]
+            if len(indices) == 0:
+                continue
+            self.active_pid = pid
+            input_id = self.get_histroy_ids(indices[-1])
+            if isinstance(input_id, str):
+                continue
+            id_marks = self.history_prefix[pid]["id_marks"]
+            positions = []
+            for index in indices:
+                # 超过模型长度的决策点在浏览时单独计算
+                if id_marks[index] > max_seq_len:
+                    break
+                positions.append(id_marks[index] - 1)
+            if len(positions) == 0:
+                continue
+            input_id = input_id[:positions[-1] + 1]
+            cached = [self.get_cached_predict(input_id[:pos + 1], topk) for pos in positions]
+            if any(predict is None for predict in cached):
+                action_ids, action_probs = generate_answer_positions(self.model, input_id, positions, self.device, topk)
+                cached = [(action_ids[k], action_probs[k]) for k in range(len(positions))]
+                for pos, (action_ids, action_probs) in zip(positions, cached):
+                    self.put_cached_predict(input_id[:pos + 1], topk, action_ids, action_probs)
+            for index, predict in zip(indices, cached):
+                self.history_predicts[index] = predict
+        self.active_pid = current_pid
 
     def set_current_history(self, index, topk):
         history_dict = self.game_history[index]
@@ -246,19 +396,33 @@ class GameController():
         self.Hrank = history_dict["Hrank"]
         self.score = sum(self.Irank)
         for i in range(self.players_count):
-            self.players[i].cards = history_dict["cards"][i]
-            self.players[i].known_cards = history_dict["kcards"][i]
+            self.players[i].cards = [card_code(card) for card in history_dict["cards"][i]]
+            self.players[i].known_cards = [card_code(kcard) for kcard in history_dict["kcards"][i]]
         self.clue = history_dict["clue"]
         self.active_pid = history_dict["active_pid"]
         action = history_dict["action"]
-        input_token_list = self.get_histroy_tokens(index)
+        input_id = self.get_histroy_ids(index)
 
         # print("===================")
         # print(self.game_history[index]["AItoken"])
         # print(input_token_list)
         # print("===================")
 
-        action_ids, action_probs = generate_answer(self.model, input_token_list, self.action_dict_toid, self.device, topk)
+        if index in self.history_predicts and self.history_topk >= topk:
+            action_ids, action_probs = self.history_predicts[index]
+            action_ids, action_probs = action_ids[:topk], action_probs[:topk]
+        else:
+            if isinstance(input_id, str):
+                raise ValueError(input_id)
+            cached = self.get_cached_predict(input_id, topk)
+            if cached is not None:
+                action_ids, action_probs = cached
+            else:
+                # 只计算最长缓存前缀之后的部分
+                kv_cache, matched = self.history_kv.match(input_id)
+                action_ids, action_probs = generate_answer_ids(self.model, input_id[matched:], self.device, topk, kv_cache)
+                self.history_kv.insert(input_id, kv_cache)
+                self.put_cached_predict(input_id, topk, action_ids, action_probs)
         action_list = []
         detail_action_list = []
         sum_prob = sum(action_probs)
@@ -288,17 +452,41 @@ class GameController():
             self.output_action_dict_toact = model_data[3]
             self.output_action_dict_toid = model_data[4]
             self.device = model_data[5]
+        if game_config is None:
+            game_config = {}
+        # 向后推演的步数(0 表示不推演)以及每一步的衰减
+        self.ahead_step = game_config.get("ahead_step", 0)
+        self.ahead_p = game_config.get("ahead_p", 0.5)
+        # 信息集蒙特卡洛搜索的时间预算(秒)以及每一批同时模拟的局数
+        self.search_time = game_config.get("search_time", 0)
+        self.search_batch = game_config.get("search_batch", 64)
+        # beam search 推演时每个候选动作保留的后续数量(推演步数以及衰减与 lookahead 共用 ahead_step/ahead_p)
+        self.beam_width = game_config.get("beam_width", 4)
+        # 候选动作最好的累计分数比领先者低 beam_prune(log 概率)以上时不再展开
+        self.beam_prune = game_config.get("beam_prune", 10.0)
+        # 选择动作的方式: greedy(模型 topk), lookahead(沿 top1 推演), beam(beam search 推演), search(信息集蒙特卡洛搜索)
+        # search 的模拟中其他座位从空的 KV cache 开始(看不到根节点之前的历史), 见 README 的 "决策方式"
+        # 没有设置时按旧的配置推断: search_time > 0 为 search, ahead_step > 0 为 lookahead
+        self.decision_mode = game_config.get("decision_mode")
+        if self.decision_mode is None:
+            self.decision_mode = "search" if self.search_time > 0 else "lookahead" if self.ahead_step > 0 else "greedy"
+        if self.decision_mode not in ("greedy", "lookahead", "beam", "search"):
+            print(f"WARNING: 不支持的 decision_mode {self.decision_mode}, 使用 greedy")
+            self.decision_mode = "greedy"
+        # 牌堆摸完之后精确求解残局的时间预算(秒, 0 表示不求解)
+        self.endgame_time = game_config.get("endgame_time", 0)
+        # 回放浏览时的前缀 KV cache 大小上限(MB)
+        self.history_kv = PrefixKVCache(self.model, game_config.get("prefix_cache_mb", 256) * 1024 * 1024)
+        # 预测结果缓存(内存 + 模型目录下的 SQLite), 0 表示不使用
+        self.prediction_cache = None
+        prediction_cache_mb = game_config.get("prediction_cache_mb", 0)
+        if prediction_cache_mb > 0:
+            self.prediction_cache = PredictionCache(self.model.model_id, prediction_cache_path(self.model.model_name),
+                                                    prediction_cache_mb * 1024 * 1024)
 
     def parse_card(self, card):
-        if card[1] == "_":
-            index = 9
-        else:
-            index = int(card[1])
-        if card[3] == "_":
-            rank = 9
-        else:
-            rank = int(card[3])
-        return index, rank
+        # 整数编码 -> (颜色, 数字), 9 表示未知
+        return card // 10, card % 10
 
     def update_AI_token(self, active_pid):
         # 补充所有的玩家目前的手牌情况
@@ -319,27 +507,95 @@ class GameController():
                 light_cards[rpid] = player.get_light_card(rpid)
 
         for i in range(len(light_cards) - 1, -1, -1):
-            self.AItokens[active_pid].extend(light_cards[i])
-            self.AImasks[active_pid].extend([0] * len(light_cards[i]))
+            for light_token in light_cards[i]:
+                self.append_AI_token(active_pid, light_token, 0)
 
         # 给AI们更新游戏状态token
         for options_token in self.options_token_list:
-            self.AItokens[active_pid].append(options_token)
-            self.AImasks[active_pid].append(0)
+            self.append_AI_token(active_pid, options_token, 0)
         # 其余信息
-        self.AItokens[active_pid].append(f"myturn-{self.AIturn[active_pid]}")
-        self.AImasks[active_pid].append(0)
-        self.AItokens[active_pid].append(f"clues-{self.clue}")
-        self.AImasks[active_pid].append(0)
+        self.append_AI_token(active_pid, f"myturn-{self.AIturn[active_pid]}", 0)
+        self.append_AI_token(active_pid, f"clues-{self.clue}", 0)
+
+    def append_AI_token(self, pid, token, mask):
+        # token 只在这里编码一次, 之后预测直接使用 AIids
+        self.AItokens[pid].append(token)
+        self.AImasks[pid].append(mask)
+        token_id = self.action_dict_toid.encode(token)
+        if isinstance(token_id, str):
+            if self.AInull[pid] is None:
+                self.AInull[pid] = token_id
+        elif token_id is not None:
+            self.AIids[pid].append(token_id)
+
+    def hand_arrays(self):
+        # 当前局面的 (手牌编码 (1, P, H), 手牌数 (1, P), 提示数 (1,)), 供 OutputTable 检查动作是否合法
+        hand_len = max(len(player.cards) for player in self.players)
+        hand_codes = np.full((1, self.players_count, max(hand_len, 1)), UNKNOWN_CARD, dtype=np.int64)
+        for player in self.players:
+            hand_codes[0, player.pid, :len(player.cards)] = player.cards
+        hand_lens = np.array([[len(player.cards) for player in self.players]], dtype=np.int64)
+        return hand_codes, hand_lens, np.array([self.clue])
+
+    def legal_output_mask(self, active_pid):
+        # 模型每个输出在当前局面下是否合法(出牌/弃牌的位置, 提示数, 提示是否触及目标的手牌)
+        return self.outputs.legal_mask(active_pid, *self.hand_arrays())[0]
 
     def call_AI_predict(self, active_pid, topk):
-        # AI行动(更新token)
+        # AI行动(更新token), 不合法的动作在 topk 之前屏蔽
         self.update_AI_token(active_pid)
-        action_ids, action_probs = generate_answer(self.model, self.AItokens[active_pid], self.action_dict_toid, self.device, topk)
+        if self.AInull[active_pid] is not None:
+            # 与之前一样不给出预测, 而不是在缺了 token 的序列上预测
+            self.AI_pred_cache[active_pid].append([])
+            raise ValueError(self.AInull[active_pid])
+        logit_mask = self.legal_output_mask(active_pid)
+        # 只把上次预测之后新增的 token 交给模型(编译后的推理后端不支持 KV cache, 这里始终是 eager)
+        if self.AIcaches[active_pid] is None:
+            self.AIcaches[active_pid] = self.model.new_cache()
+        kv_cache = self.AIcaches[active_pid]
+        new_ids = self.AIids[active_pid][kv_cache.seq_len:]
+        if self.decision_mode == "lookahead":
+            # 按推演之后的分数重新排序候选动作
+            action_ids, action_probs, action_scores = generate_answer_lookahead(
+                self.model, new_ids, self.action_dict_toid, self.output_action_dict_toact, self.device, topk,
+                self.ahead_step, self.ahead_p, kv_cache, logit_mask)
+            order = np.argsort(-action_scores, kind="stable")
+            action_ids, action_probs = action_ids[order], action_probs[order]
+        elif self.decision_mode == "beam":
+            action_ids, action_probs, action_scores = generate_answer_beam(
+                self.model, new_ids, self.action_dict_toid, self.output_action_dict_toact, self.device, topk,
+                self.ahead_step, self.beam_width, self.ahead_p, self.beam_prune, kv_cache, logit_mask)
+            order = np.argsort(-action_scores, kind="stable")
+            action_ids, action_probs = action_ids[order], action_probs[order]
+        else:
+            # 命中缓存时不调用模型, 没有喂给 KV cache 的 token 会在下次预测时一起补上
+            cached = self.get_cached_predict(self.AIids[active_pid], topk, True)
+            if cached is not None:
+                action_ids, action_probs = cached
+            else:
+                action_ids, action_probs = generate_answer_ids(self.model, new_ids, self.device, topk, kv_cache,
+                                                               logit_mask)
+                self.put_cached_predict(self.AIids[active_pid], topk, action_ids, action_probs, True)
+        values = None
+        if self.endgame_time > 0 and self.get_current_card() == 0:
+            # 牌堆已空: 按残局求解的得分重新排序候选动作
+            actions = [self.get_action(self.output_action_dict_toact[action_id], active_pid) for action_id in action_ids]
+            values = solve_endgame(self, active_pid, actions, self.endgame_time)
+        if values is None and self.decision_mode == "search":
+            # 按搜索得到的平均分数重新排序候选动作(不合法的动作排在最后)
+            actions = [self.get_action(self.output_action_dict_toact[action_id], active_pid) for action_id in action_ids]
+            values, _ = ismcts_search(self, active_pid, actions, self.search_time, self.search_batch, topk)
+        if values is not None:
+            order = np.argsort(-values, kind="stable")
+            action_ids, action_probs = action_ids[order], action_probs[order]
+        return self.record_AI_predict(active_pid, action_ids, action_probs, topk)
+
+    def record_AI_predict(self, active_pid, action_ids, action_probs, topk):
         action_list = []
         self.AI_pred_cache[active_pid].append([])
         sum_prob = sum(action_probs)
-        for i in range(topk):
+        # 合法动作少于 topk 时只有合法的部分
+        for i in range(len(action_ids)):
             action_token = self.output_action_dict_toact[action_ids[i]]
             action_list.append({"token": action_token, "probs": (action_probs[i] / sum_prob).item()})
             action_info = self.get_action(action_token, active_pid)
@@ -430,6 +686,54 @@ class GameController():
             action_token = "NULL"
         return action_token
 
+    def snapshot(self):
+        return GameSnapshot(self)
+
+    def restore(self, snapshot):
+        # 回到快照时的状态, 之后追加的 token/id/弃牌/预测直接截掉, 每个座位的 KV cache 截到快照时的长度
+        self.order_slot = {}
+        for player, (cards, known_cards, online_order) in zip(self.players, snapshot.hands):
+            player.cards = list(cards)
+            player.known_cards = list(known_cards)
+            player.online_order = list(online_order)
+            for pos, order in enumerate(online_order):
+                if order is not None:
+                    self.order_slot[order] = (player.pid, pos)
+        self.Irank = list(snapshot.Irank)
+        self.Hrank = list(snapshot.Hrank)
+        self.clue = snapshot.clue
+        self.score = snapshot.score
+        self.mistake = snapshot.mistake
+        self.turn = snapshot.turn
+        self.active_pid = snapshot.active_pid
+        self.round_p = snapshot.round_p
+        self.round = snapshot.round
+        self.final_turns = snapshot.final_turns
+        self.current_card_index = snapshot.current_card_index
+        for card in self.discard_cards[snapshot.discard_len:]:
+            self.discard_count[card] -= 1
+        del self.discard_cards[snapshot.discard_len:]
+        for pid in range(self.players_count):
+            del self.AItokens[pid][snapshot.token_lens[pid]:]
+            del self.AImasks[pid][snapshot.token_lens[pid]:]
+            del self.AIids[pid][snapshot.id_lens[pid]:]
+            del self.AI_pred_cache[pid][snapshot.pred_lens[pid]:]
+            if self.AIcaches[pid] is not None:
+                self.AIcaches[pid].truncate(snapshot.id_lens[pid])
+        self.AInull = list(snapshot.null_tokens)
+        self.belief.set_state(snapshot.belief)
+
+    def push_undo(self):
+        if self.allow_drawback:
+            self.undo_stack.append(self.snapshot())
+
+    def undo(self):
+        # 撤回上一次 出牌/弃牌/提示(以及之后的摸牌), 返回是否成功
+        if len(self.undo_stack) == 0:
+            return False
+        self.restore(self.undo_stack.pop())
+        return True
+
     def draw_card(self, to_pid):
         if self.ramdom_start:
             self.draw_next_card(to_pid)
@@ -460,17 +764,21 @@ class GameController():
             index = 9
         if rank == -1:
             rank = 9
-        card = f"I{index}R{rank}"
-        self.players[playerIndex].gain_card(card, order)
+        self.players[playerIndex].gain_card(index * 10 + rank, order)
+        self.belief.draw(playerIndex, index * 10 + rank)
+        if self.final_turns < 0 and self.get_current_card() == 0:
+            # 摸到最后一张牌之后每个人(包括自己)还有一回合
+            self.final_turns = self.players_count + 1
 
     def online_handle_play(self, action_data):
+        self.push_undo()
         pid = action_data["playerIndex"]
         cindex = action_data["suitIndex"]
         crank = action_data["rank"]
         order = action_data["order"]
-        card = f"I{cindex}R{crank}"
+        card = cindex * 10 + crank
         player = self.players[pid]
-        pos = player.online_order.index(order)
+        pos = self.order_slot[order][1]
 
         #判断是AI预测的第几个操作
         ai_rank = "N"
@@ -478,11 +786,12 @@ class GameController():
             if len(self.AI_pred_cache[pid][self.round]) > 0:
                 for i in range(len(self.AI_pred_cache[pid][self.round])):
                     ai_pred = self.AI_pred_cache[pid][self.round][i]
-                    if ai_pred["type"] == "play" and ai_pred["pos"] == pos:
+                    if ai_pred is not None and ai_pred["type"] == "play" and ai_pred["pos"] == pos:
                         ai_rank = i + 1
                         break
 
         action_str = f"P{pid}-出牌:第{len(self.players[pid].cards) - int(pos)}张牌[{ai_rank}]"
+        self.belief.reveal(pid, pos, card, player.cards[pos] == card)
         player.remove_card_at(pos)
         if self.Irank[cindex] + 1 == crank:
             # 成功打牌
@@ -494,31 +803,30 @@ class GameController():
         else:
             # 打牌失败
             self.discard_cards.append(card)
+            self.discard_count[card] += 1
 
         # 给AI们更新token
         for aipid in self.AIplayes:
             if aipid == pid:
-                self.AItokens[aipid].append(f"play-myself-POS{pos}")
-                self.AImasks[aipid].append(1)
+                self.append_AI_token(aipid, f"play-myself-POS{pos}", 1)
             else:
                 rpid = pid - aipid
                 if rpid < 0:
                     rpid += self.players_count
-                self.AItokens[aipid].append(f"play-PR{rpid}-POS{pos}")
-                self.AImasks[aipid].append(0)
-            self.AItokens[aipid].append(f"played-{card}")
-            self.AImasks[aipid].append(0)
+                self.append_AI_token(aipid, f"play-PR{rpid}-POS{pos}", 0)
+            self.append_AI_token(aipid, f"played-{CARD_STR[card]}", 0)
         return action_str
 
     def online_handle_discard(self, action_data):
+        self.push_undo()
         pid = action_data["playerIndex"]
         cindex = action_data["suitIndex"]
         crank = action_data["rank"]
         order = action_data["order"]
         failed = action_data["failed"]
         player = self.players[pid]
-        card = f"I{cindex}R{crank}"
-        pos = player.online_order.index(order)
+        card = cindex * 10 + crank
+        pos = self.order_slot[order][1]
 
         # 判断是AI预测的第几个操作
         ai_rank = "N"
@@ -527,11 +835,11 @@ class GameController():
                 for i in range(len(self.AI_pred_cache[pid][self.round])):
                     ai_pred = self.AI_pred_cache[pid][self.round][i]
                     if failed:
-                        if ai_pred["type"] == "play" and ai_pred["pos"] == pos:
+                        if ai_pred is not None and ai_pred["type"] == "play" and ai_pred["pos"] == pos:
                             ai_rank = i + 1
                             break
                     else:
-                        if ai_pred["type"] == "discard" and ai_pred["pos"] == pos:
+                        if ai_pred is not None and ai_pred["type"] == "discard" and ai_pred["pos"] == pos:
                             ai_rank = i + 1
                             break
 
@@ -539,7 +847,7 @@ class GameController():
             action_str = f"P{pid}-出牌失败:第{len(self.players[pid].cards) - int(pos)}张牌[{ai_rank}]"
         else:
             action_str = f"P{pid}-弃牌:第{len(self.players[pid].cards) - int(pos)}张牌[{ai_rank}]"
-        damounts = self.discard_cards.count(card)
+        damounts = self.discard_count[card]
         if self.Irank[cindex] < crank:
             if crank == 1 and damounts == 2:
                 self.Hrank[cindex] = min(crank - 1, self.Hrank[cindex])
@@ -548,8 +856,10 @@ class GameController():
             elif crank == 5:
                 self.Hrank[cindex] = min(crank - 1, self.Hrank[cindex])
 
+        self.belief.reveal(pid, pos, card, player.cards[pos] == card)
         player.remove_card_at(pos)
         self.discard_cards.append(card)
+        self.discard_count[card] += 1
         # 多一个提示(实际上打牌失败会被算成弃牌)
         if failed:
             self.mistake += 1
@@ -560,65 +870,62 @@ class GameController():
             if aipid == pid:
                 if failed:
                     #失败
-                    self.AItokens[aipid].append(f"play-myself-POS{pos}")
+                    self.append_AI_token(aipid, f"play-myself-POS{pos}", 1)
                 else:
-                    self.AItokens[aipid].append(f"discard-myself-POS{pos}")
-                self.AImasks[aipid].append(1)
+                    self.append_AI_token(aipid, f"discard-myself-POS{pos}", 1)
             else:
                 rpid = pid - aipid
                 if rpid < 0:
                     rpid += self.players_count
                 if failed:
                     #失败
-                    self.AItokens[aipid].append(f"play-PR{rpid}-POS{pos}")
+                    self.append_AI_token(aipid, f"play-PR{rpid}-POS{pos}", 0)
                 else:
-                    self.AItokens[aipid].append(f"discard-PR{rpid}-POS{pos}")
-                self.AImasks[aipid].append(0)
-            self.AItokens[aipid].append(f"lossed-{card}")
-            self.AImasks[aipid].append(0)
+                    self.append_AI_token(aipid, f"discard-PR{rpid}-POS{pos}", 0)
+            self.append_AI_token(aipid, f"lossed-{CARD_STR[card]}", 0)
         return action_str
 
     def online_handle_clue(self, action_data):
+        self.push_undo()
         from_pid = action_data["giver"]
         to_pid = action_data["target"]
         clue_type = action_data['clue']["type"]
         clue_value = action_data['clue']["value"]
         order_list = action_data['list']
         player = self.players[to_pid]
+        self.belief.clue(to_pid, [self.order_slot[order][1] for order in order_list], clue_type, clue_value)
         for order in order_list:
-            pos = player.online_order.index(order)
+            pos = self.order_slot[order][1]
             kcard = player.known_cards[pos]
-            card = player.cards[pos]
-            card_type = int(card[1])
-            kcard_type = kcard[1]
-            kcard_rank = kcard[3]
-            if self.special_dict.last_special_card == card_type:
+            card_type = player.cards[pos] // 10
+            kcard_type = kcard // 10
+            kcard_rank = kcard % 10
+            special_card = self.special_dict.last_special_card
+            if special_card == card_type:
                 # 最后一张牌,可能有特殊规则限制
-                if self.special_dict.all_color_rule and kcard_type != "_" and clue_type == 0:
+                if self.special_dict.all_color_rule and kcard_type != UNKNOWN and clue_type == 0:
                     # 颜色提示
-                    if int(kcard_type) == self.special_dict.last_special_card:
+                    if kcard_type == special_card:
                         # 已经明示,不再额外提醒
                         continue
-                    if int(kcard_type) != clue_value:
+                    if kcard_type != clue_value:
                         # 不同的颜色提示（彰显特殊牌）
-                        player.known_cards[pos] = kcard[:1] + f"{self.special_dict.last_special_card}" + kcard[2:]
-                        # print(target_known_card[index_of_card], variantName)
+                        player.known_cards[pos] = special_card * 10 + kcard_rank
                         continue
-                if self.special_dict.all_rank_rule and kcard_rank != "_" and clue_type == 1:
+                if self.special_dict.all_rank_rule and kcard_rank != UNKNOWN and clue_type == 1:
                     # 数字提示
-                    if kcard_type == f"{self.special_dict.last_special_card}":
+                    if kcard_type == special_card:
                         # 已经明示,不再额外提醒(只提示数字)
-                        player.known_cards[pos] = kcard[:3] + f"{clue_value}" + kcard[4:]
+                        player.known_cards[pos] = kcard_type * 10 + clue_value
                         continue
-                    if int(kcard_rank) != clue_value:
+                    if kcard_rank != clue_value:
                         # 不同的数字提示（彰显特殊牌）
-                        player.known_cards[pos] = f"I{self.special_dict.last_special_card}R{clue_value}"
-                        # print(target_known_card[index_of_card], variantName)
+                        player.known_cards[pos] = special_card * 10 + clue_value
                         continue
             if clue_type == 0:
-                player.known_cards[pos] = kcard[:1] + f"{clue_value}" + kcard[2:]
+                player.known_cards[pos] = clue_value * 10 + kcard_rank
             elif clue_type == 1:
-                player.known_cards[pos] = kcard[:3] + f"{clue_value}" + kcard[4:]
+                player.known_cards[pos] = kcard_type * 10 + clue_value
         self.clue -= 1
 
         clue_info = ""
@@ -633,7 +940,7 @@ class GameController():
             if len(self.AI_pred_cache[from_pid][self.round]) > 0:
                 for i in range(len(self.AI_pred_cache[from_pid][self.round])):
                     ai_pred = self.AI_pred_cache[from_pid][self.round][i]
-                    if ai_pred["type"] == "clue" and ai_pred["to"] == to_pid and ai_pred["clue"] == clue_info:
+                    if ai_pred is not None and ai_pred["type"] == "clue" and ai_pred["to"] == to_pid and ai_pred["clue"] == clue_info:
                         ai_rank = i + 1
                         break
 
@@ -650,15 +957,16 @@ class GameController():
             clue_token = f"clue-PRF{from_rpid}->PRT{to_rpid}-{clue_info}"
             clue_token = clue_token.replace("PRF0", "myself")
             clue_token = clue_token.replace("PRT0", "myself")
-            self.AItokens[aipid].append(clue_token)
             if from_rpid == 0:
-                self.AImasks[aipid].append(1)
+                self.append_AI_token(aipid, clue_token, 1)
             else:
-                self.AImasks[aipid].append(0)
+                self.append_AI_token(aipid, clue_token, 0)
         return action_str
 
     def online_handle_status(self, action_data):
         self.round_p += 1
+        if self.final_turns > 0:
+            self.final_turns -= 1
         self.round = math.floor(self.round_p / self.players_count)
         clues = action_data["clues"]
         score = action_data["score"]
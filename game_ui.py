@@ -4,6 +4,8 @@ from PyQt5.QtCore import QThread, pyqtSignal, Qt
 from PyQt5.QtWidgets import QWidget, QPushButton, QVBoxLayout, QMainWindow, QLabel, QHBoxLayout, QGridLayout, QScrollBar, QFileDialog, QDesktopWidget
 from main import Ui_AIUI
 from game_controller_v2 import GameController, GameArgs
+from game_utils import parse_history_name
+from game_variants import support_variant
 from util_ui import ValueButton, CardButton
 import websocket
 import json
@@ -214,7 +216,7 @@ class ClientThread(QThread):
 
 
 class AIWindow(QMainWindow, Ui_AIUI):
-    def __init__(self, url, cookie, model_data=None):
+    def __init__(self, url, cookie, model_data=None, game_config=None):
         super().__init__()
         self.setupUi(self)
         #self.setFixedSize(1300, 1200)
@@ -232,13 +234,9 @@ class AIWindow(QMainWindow, Ui_AIUI):
             self.worker_thread.table_joined_sig.connect(self.table_joined)
 
         self.enable_active_btn(False)
-        self.game_controller = GameController(model_data)
+        self.game_controller = GameController(model_data, game_config)
         self.current_loss_card = None
-        self.support_variant = [
-            "No Variant", "6 Suits", "Black (5 Suits)", "Black (6 Suits)", "Rainbow (5 Suits)", "Rainbow (6 Suits)",
-            "Brown (5 Suits)", "Brown (6 Suits)", "Dark Rainbow (6 Suits)", "White (5 Suits)", "White (6 Suits)",
-            "Pink (5 Suits)", "Pink (6 Suits)", "Gray (6 Suits)", "Null (5 Suits)", "Null (6 Suits)", "Omni (5 Suits)", "Omni (6 Suits)"
-        ]
+        self.support_variant = support_variant
 
         self.play_btn.clicked.connect(self.play_clicked)
         self.discard_btn.clicked.connect(self.discard_clicked)
@@ -356,15 +354,6 @@ class AIWindow(QMainWindow, Ui_AIUI):
                 "R4": '数字4(R4)',
                 "R5": '数字5(R5)',
             }
-            colors = [
-                (255, 182, 193),  # 淡红
-                (255, 255, 224),  # 淡黄
-                (144, 238, 144),  # 淡绿
-                (173, 216, 230),  # 淡蓝
-                (221, 160, 221),  # 淡紫
-                (173, 216, 230)  # 淡青
-            ]
-            self.index_to_color = [f"background-color: rgb{color}" for color in colors]
             self.history_mode = True
 
             if "history" not in data:
@@ -422,34 +411,10 @@ class AIWindow(QMainWindow, Ui_AIUI):
 
             gameconf = GameArgs(**game_args)
             self.game_controller.start_game(gameconf)
-            special_dict = self.game_controller.special_dict
-            if "Dark Rainbow" in self.varient_name:
-                self.clue_replace[f"I{special_dict.last_special_card}"] = "暗彩虹"
-                self.index_to_color[special_dict.last_special_card] = "background: qlineargradient(x1:0, y1:0, x2:1, y2:0, stop:0 #FF0000, stop:0.17 #FF7F00, stop:0.33 #FFFF00, stop:0.50 #00FF00, stop:0.67 #0000FF, stop:0.83 #4B0082, stop:1 #9400D3);"
-            elif "Rainbow" in self.varient_name:
-                self.clue_replace[f"I{special_dict.last_special_card}"] = "彩虹"
-                self.index_to_color[special_dict.last_special_card] = "background: qlineargradient(x1:0, y1:0, x2:1, y2:0, stop:0 #FFB6C1, stop:0.17 #FFE4C4, stop:0.33 #FFFFE0, stop:0.50 #98FB98, stop:0.67 #ADD8E6, stop:0.83 #E6E6FA, stop:1 #E3E3E3);"
-            elif "Omni" in self.varient_name:
-                self.clue_replace[f"I{special_dict.last_special_card}"] = "恶魔"
-                self.index_to_color[special_dict.last_special_card] = "background: qlineargradient(x1:0, y1:0, x2:1, y2:0, stop:0 #FFB6C1, stop:0.17 #FFE4C4, stop:0.33 #FFFFE0, stop:0.50 #98FB98, stop:0.67 #ADD8E6, stop:0.83 #E6E6FA, stop:1 #E3E3E3);"
-            elif "Brown" in self.varient_name:
-                self.clue_replace[f"I{special_dict.last_special_card}"] = "棕色"
-                self.index_to_color[special_dict.last_special_card] = f"background-color: rgb(205, 133, 63)"
-            elif "Black" in self.varient_name:
-                self.clue_replace[f"I{special_dict.last_special_card}"] = "黑色"
-                self.index_to_color[special_dict.last_special_card] = f"background-color: rgb(64, 64, 64)"
-            elif "White" in self.varient_name:
-                self.clue_replace[f"I{special_dict.last_special_card}"] = "白色"
-                self.index_to_color[special_dict.last_special_card] = f"background-color: rgb(250, 250, 250)"
-            elif "Pink" in self.varient_name:
-                self.clue_replace[f"I{special_dict.last_special_card}"] = "粉色"
-                self.index_to_color[special_dict.last_special_card] = f"background-color: rgb(255, 182, 193)"
-            elif "Gray" in self.varient_name:
-                self.clue_replace[f"I{special_dict.last_special_card}"] = "灰色"
-                self.index_to_color[special_dict.last_special_card] = f"background-color: rgb(220, 220, 220)"
-            elif "Null" in self.varient_name:
-                self.clue_replace[f"I{special_dict.last_special_card}"] = "空白"
-                self.index_to_color[special_dict.last_special_card] = f"background-color: rgb(253, 253, 253)"
+            variant = self.game_controller.variant
+            self.index_to_color = list(variant.ui_colors)
+            if variant.special_name is not None:
+                self.clue_replace[f"I{variant.special_dict.last_special_card}"] = variant.special_name
             self.setup_button_pannel(self.player_count)
 
         except Exception as e:
@@ -468,23 +433,23 @@ class AIWindow(QMainWindow, Ui_AIUI):
                     # 解析JSON内容
                     self.clear_UI()
                     history_data = json.load(file)
-                    file_name = f"{file_name}"
-                    file_name = file_name.replace("ERROR_","")
-                    game_args = file_name.split("_")
-                    print(game_args)
+                    variant, players = parse_history_name(f"{file_name}")
+                    print(variant, players)
                     fake_game_data = {
                         "tableID": 1,
                         "spectating": True,
                         "history": True,
                         "playerNames": ["AI0","AI1","AI2","AI3","AI4","AI5"],
                         "options":{
-                            "numPlayers": int(game_args[1][0]),
-                            "variantName": game_args[0].split("/")[-1],
+                            "numPlayers": players,
+                            "variantName": variant,
                         }
                     }
                     self.game_start(fake_game_data)
                     self.current_history_index = 0
-                    self.game_controller.game_history = history_data
+                    self.game_controller.load_history(history_data)
+                    # 回放分析: 载入时每个座位前向一次, 之后切换步骤只需要查表
+                    self.game_controller.precompute_history(10)
 
                     action, action_predict, action_details = self.game_controller.set_current_history(self.current_history_index, 10)
                     self.update_AI_choice(action_predict, action_details, 10)
@@ -835,7 +800,12 @@ class AIWindow(QMainWindow, Ui_AIUI):
                 #向AI查询预测结果
                 if not self.spectating:
                     self.enable_active_btn(True)
-                action_predict, action_details = self.game_controller.call_AI_predict(active_pid, 10)
+                try:
+                    action_predict, action_details = self.game_controller.call_AI_predict(active_pid, 10)
+                except ValueError as e:
+                    # 序列中有不认识的 token(或者超过模型长度)时不显示预测
+                    print(e)
+                    action_predict, action_details = [], []
                 self.update_AI_choice(action_predict, action_details, 10)
             else:
                 lb = QVBoxLayout()
@@ -852,9 +822,12 @@ class AIWindow(QMainWindow, Ui_AIUI):
 
     def update_AI_choice(self, action_predict, action_details, topk):
         lb = QVBoxLayout()
-        for i in range(topk):
+        # 屏蔽不合法动作之后预测可能少于 topk 个
+        for i in range(min(topk, len(action_predict))):
             action_probs = action_predict[i]["probs"]
             action_detail = action_details[i]
+            if action_detail is None:
+                continue
             action_desc = action_detail["str"]
             for clue_r in self.clue_replace:
                 if clue_r in action_desc:
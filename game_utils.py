@@ -18,6 +18,14 @@ def get_logger(filename, verbosity=1, name=None):
     # logger.addHandler(sh)
     return logger
 
+def parse_history_name(file_name):
+    # 历史对局文件名的格式为 {玩法}_{人数}P_xxx.json
+    file_name = file_name.replace("ERROR_", "")
+    game_args = file_name.split("_")
+    variant = game_args[0].split("/")[-1]
+    players = int(game_args[1][0])
+    return variant, players
+
 @dataclass
 class GameArgs:
     players: int = 2
@@ -0,0 +1,164 @@
+from dataclasses import dataclass
+
+# 玩法规则表: 每种玩法的颜色数量、牌堆组成、提示规则(触及表)、对局信息 token 以及 UI 颜色
+# import 时为所有已知玩法建好, 之后按名字直接查表; 不在表中的名字按同样的规则解析一次后加入表中
+
+# 牌以及已知信息都用一个整数表示: 颜色 * 10 + 数字, 9 表示未知(I3R2 -> 32, I_R4 -> 94, I_R_ -> 99)
+# 只有在生成 token 以及 UI 显示时才转换成字符串
+UNKNOWN = 9
+UNKNOWN_CARD = UNKNOWN * 10 + UNKNOWN
+CARD_STR = [f"I{'_' if code // 10 == UNKNOWN else code // 10}R{'_' if code % 10 == UNKNOWN else code % 10}"
+            for code in range(100)]
+
+
+def card_code(card):
+    # "I3R2"/"I_R_" 形式的字符串 -> 整数编码
+    index = UNKNOWN if card[1] == "_" else int(card[1])
+    rank = UNKNOWN if card[3] == "_" else int(card[3])
+    return index * 10 + rank
+
+
+@dataclass(frozen=True)
+class SpecialGameArgs:
+    no_color_rule: bool = False
+    all_color_rule: bool = False
+    no_rank_rule: bool = False
+    all_rank_rule: bool = False
+    last_special_card: int = 4
+
+
+@dataclass(frozen=True)
+class VariantInfo:
+    name: str
+    suits: int
+    special_dict: SpecialGameArgs
+    # 特殊颜色每个数字只有一张(暗色玩法)
+    last_one_card: bool
+    total_card: int
+    # 牌堆中所有的牌 (颜色, 数字), 按颜色、数字排列
+    deck: tuple
+    # 可以提示的颜色数量(彩虹/白色等特殊颜色没有自己的颜色提示)
+    color_clue_count: int
+    # clue_touch[clue_type][clue_value]: 该提示会触及的牌, 以牌的整数编码(颜色 * 10 + 数字)为位
+    clue_touch: tuple
+    options_tokens: tuple
+    # UI 中特殊颜色的名字以及每种颜色的样式
+    special_name: str
+    ui_colors: tuple
+
+
+variant_one_card = ["Dark Null", "Dark Brown", "Cocoa Rainbow", "Gray", "Black", "Dark Rainbow", "Gray Pink",
+                    "Dark Pink", "Dark Omni"]
+no_color_rule_variant = ["Null", "White", "Light Pink", "Dark Null", "Gray", "Gray Pink"]
+all_color_rule_variant = ["Muddy Rainbow", "Rainbow", "Omni", "Cocoa Rainbow", "Dark Rainbow", "Dark Omni"]
+no_rank_rule_variant = ["Null", "Brown", "Muddy Rainbow", "Dark Null", "Dark Brown", "Cocoa Rainbow"]
+all_rank_rule_variant = ["Light Pink", "Pink", "Omni", "Gray Pink", "Dark Pink", "Dark Omni"]
+
+rainbow_style = "background: qlineargradient(x1:0, y1:0, x2:1, y2:0, stop:0 #FFB6C1, stop:0.17 #FFE4C4, stop:0.33 #FFFFE0, stop:0.50 #98FB98, stop:0.67 #ADD8E6, stop:0.83 #E6E6FA, stop:1 #E3E3E3);"
+# 按顺序匹配, 第一个包含在玩法名字中的决定特殊颜色的名字和样式
+special_styles = [
+    ("Dark Rainbow", "暗彩虹", "background: qlineargradient(x1:0, y1:0, x2:1, y2:0, stop:0 #FF0000, stop:0.17 #FF7F00, stop:0.33 #FFFF00, stop:0.50 #00FF00, stop:0.67 #0000FF, stop:0.83 #4B0082, stop:1 #9400D3);"),
+    ("Rainbow", "彩虹", rainbow_style),
+    ("Omni", "恶魔", rainbow_style),
+    ("Brown", "棕色", "background-color: rgb(205, 133, 63)"),
+    ("Black", "黑色", "background-color: rgb(64, 64, 64)"),
+    ("White", "白色", "background-color: rgb(250, 250, 250)"),
+    ("Pink", "粉色", "background-color: rgb(255, 182, 193)"),
+    ("Gray", "灰色", "background-color: rgb(220, 220, 220)"),
+    ("Null", "空白", "background-color: rgb(253, 253, 253)"),
+]
+suit_colors = [
+    (255, 182, 193),  # 淡红
+    (255, 255, 224),  # 淡黄
+    (144, 238, 144),  # 淡绿
+    (173, 216, 230),  # 淡蓝
+    (221, 160, 221),  # 淡紫
+    (173, 216, 230)  # 淡青
+]
+
+# AI 支持的玩法(只有这些玩法会给出 AI 预测)
+support_variant = [
+    "No Variant", "6 Suits", "Black (5 Suits)", "Black (6 Suits)", "Rainbow (5 Suits)", "Rainbow (6 Suits)",
+    "Brown (5 Suits)", "Brown (6 Suits)", "Dark Rainbow (6 Suits)", "White (5 Suits)", "White (6 Suits)",
+    "Pink (5 Suits)", "Pink (6 Suits)", "Gray (6 Suits)", "Null (5 Suits)", "Null (6 Suits)", "Omni (5 Suits)", "Omni (6 Suits)"
+]
+
+
+def build_variant(name):
+    if "6 Suits" in name:
+        suits = 6
+    elif "4 Suits" in name:
+        suits = 4
+    else:
+        suits = 5
+    total_card = suits * 10
+
+    last_one_card = any(vstr in name for vstr in variant_one_card)
+    if last_one_card:
+        total_card -= 5
+    special_dict = SpecialGameArgs(no_color_rule=any(vstr in name for vstr in no_color_rule_variant),
+                                   all_color_rule=any(vstr in name for vstr in all_color_rule_variant),
+                                   no_rank_rule=any(vstr in name for vstr in no_rank_rule_variant),
+                                   all_rank_rule=any(vstr in name for vstr in all_rank_rule_variant),
+                                   last_special_card=suits - 1)
+
+    # 每种颜色 1x3, 2/3/4x2, 5x1; 暗色玩法的特殊颜色每个数字只有一张
+    deck = []
+    for suit in range(suits):
+        if last_one_card and suit == special_dict.last_special_card:
+            counts = (1, 1, 1, 1, 1)
+        else:
+            counts = (3, 2, 2, 2, 1)
+        for rank, count in zip(range(1, 6), counts):
+            deck += [(suit, rank)] * count
+
+    clue_touch = [[0] * 10 for _ in range(2)]
+    for suit in range(suits):
+        special = suit == special_dict.last_special_card
+        for rank in range(1, 6):
+            bit = 1 << (suit * 10 + rank)
+            for clue_value in range(10):
+                if (suit == clue_value and not (special and special_dict.no_color_rule)) or \
+                        (special and special_dict.all_color_rule):
+                    clue_touch[0][clue_value] |= bit
+                if (rank == clue_value and not (special and special_dict.no_rank_rule)) or \
+                        (special and special_dict.all_rank_rule):
+                    clue_touch[1][clue_value] |= bit
+
+    options_tokens = [f"Suits-{suits}"]
+    if name != "No Variant" and name != "6 Suits" and name != "4 Suits":
+        last_pos_color = name.replace("(5 Suits)", "").replace("(6 Suits)", "").strip()
+        options_tokens.append(f"Special-I{special_dict.last_special_card}-{last_pos_color}")
+
+    special_name = None
+    ui_colors = [f"background-color: rgb{color}" for color in suit_colors]
+    for vstr, vname, style in special_styles:
+        if vstr in name:
+            special_name = vname
+            ui_colors[special_dict.last_special_card] = style
+            break
+
+    color_clue_count = suits
+    if special_dict.no_color_rule or special_dict.all_color_rule:
+        color_clue_count -= 1
+    return VariantInfo(name, suits, special_dict, last_one_card, total_card, tuple(deck), color_clue_count,
+                       tuple(tuple(masks) for masks in clue_touch), tuple(options_tokens), special_name,
+                       tuple(ui_colors))
+
+
+variants = {}
+for suit_name in ["No Variant", "6 Suits", "4 Suits"]:
+    variants[suit_name] = build_variant(suit_name)
+for special in ["Rainbow", "Pink", "White", "Brown", "Black", "Omni", "Null", "Muddy Rainbow", "Light Pink",
+                "Dark Rainbow", "Dark Pink", "Gray", "Dark Brown", "Dark Omni", "Dark Null", "Cocoa Rainbow", "Gray Pink"]:
+    for suit_count in (5, 6):
+        name = f"{special} ({suit_count} Suits)"
+        variants[name] = build_variant(name)
+
+
+def get_variant(name):
+    variant = variants.get(name)
+    if variant is None:
+        variant = build_variant(name)
+        variants[name] = variant
+    return variant
@@ -0,0 +1,107 @@
+import numpy as np
+
+from game_variants import UNKNOWN
+
+# 合法动作: 模型输出 id -> 动作的解码表, 以及动作是否合法(出牌/弃牌/提示规则只在这里实现一次)
+# selfplay.is_legal、BatchHanabiEnv.legal、残局求解以及每回合的合法输出掩码都调用 OutputTable.action_legal
+# 提示会触及哪些牌直接查玩法的 clue_touch 表(彩虹/粉色/棕色/空白等特殊颜色的规则已经在表中)
+
+ACTION_PLAY = 0
+ACTION_DISCARD = 1
+ACTION_CLUE = 2
+ACTION_TYPES = {"play": ACTION_PLAY, "discard": ACTION_DISCARD, "clue": ACTION_CLUE}
+
+
+def action_arrays(actions):
+    # GameController.get_action 的结果列表 -> (类型, 位置, 目标玩家, 提示类型, 提示值) 数组, None 的类型为 -1
+    actions = [action if action is not None else {"type": None} for action in actions]
+    action_type = np.array([ACTION_TYPES.get(action["type"], -1) for action in actions], dtype=np.int64)
+    pos = np.array([action.get("pos", 0) for action in actions], dtype=np.int64)
+    to_pid = np.array([action.get("to", -1) for action in actions], dtype=np.int64)
+    clue_type = np.array([action.get("clue_type", 0) for action in actions], dtype=np.int64)
+    clue_value = np.array([action.get("clue_value", 0) for action in actions], dtype=np.int64)
+    return action_type, pos, to_pid, clue_type, clue_value
+
+
+class OutputTable:
+    def __init__(self, output_action_dict_toact, variant):
+        # 与 GameController.get_action 的解析方式相同, 不是动作的输出(如 NULL)类型为 -1
+        n_out = len(output_action_dict_toact)
+        self.type = np.full(n_out, -1, dtype=np.int64)
+        self.pos = np.zeros(n_out, dtype=np.int64)
+        self.to_rpid = np.zeros(n_out, dtype=np.int64)
+        self.clue_type = np.zeros(n_out, dtype=np.int64)
+        self.clue_value = np.zeros(n_out, dtype=np.int64)
+        for out_id, token in enumerate(output_action_dict_toact):
+            try:
+                if token.startswith("clue"):
+                    self.to_rpid[out_id] = int(token[-4])
+                    self.clue_type[out_id] = 0 if token[-2] == "I" else 1
+                    self.clue_value[out_id] = int(token[-1])
+                    self.type[out_id] = ACTION_CLUE
+                elif token.startswith("play"):
+                    self.pos[out_id] = int(token[-1])
+                    self.type[out_id] = ACTION_PLAY
+                elif token.startswith("discard"):
+                    self.pos[out_id] = int(token[-1])
+                    self.type[out_id] = ACTION_DISCARD
+            except ValueError:
+                self.type[out_id] = -1
+
+        codes = np.arange(100)
+        # touch[clue_type, clue_value, code]: 该提示是否触及这张牌
+        self.touch = np.array([[(mask >> codes) & 1 == 1 for mask in masks] for masks in variant.clue_touch])
+        # clue_valid[clue_type, clue_value]: 该玩法中可以给出的提示(彩虹/白色等特殊颜色没有自己的颜色提示)
+        self.clue_valid = np.zeros((2, 10), dtype=bool)
+        self.clue_valid[0, :variant.color_clue_count] = True
+        self.clue_valid[1, 1:6] = True
+        # 能被至少一种提示触及的牌
+        self.cluable = (self.touch & self.clue_valid[:, :, None]).any(axis=(0, 1))
+
+    def decode(self, pid, players, out_ids):
+        # 模型输出 id -> 动作数组, 目标玩家的换算与 GameController.get_action 相同
+        # 相对位置超过人数的提示(如 3 人局中的 PRT4)没有对应的玩家, 目标记为 -1
+        to_rpid = self.to_rpid[out_ids]
+        to_pid = to_rpid + pid
+        to_pid = np.where(to_pid >= players, to_pid - players, to_pid)
+        to_pid = np.where(to_rpid < players, to_pid, -1)
+        return self.type[out_ids], self.pos[out_ids], to_pid, self.clue_type[out_ids], self.clue_value[out_ids]
+
+    def touched(self, codes, hand_len, clue_type, clue_value):
+        # codes: (N, H) 手牌编码, hand_len: (N,), clue_type/clue_value: (N,); 返回 (N, H) 被提示触及的牌
+        clue_type = np.clip(clue_type, 0, 1)[:, None]
+        clue_value = np.clip(clue_value, 0, 9)[:, None]
+        return self.touch[clue_type, clue_value, codes] & (np.arange(codes.shape[1])[None] < hand_len[:, None])
+
+    def action_legal(self, pid, action, hand_codes, hand_len, clue, rows=None):
+        # action: 动作数组, hand_codes: (N, P, H) 每局每个玩家的手牌编码, hand_len: (N, P), clue: (N,)
+        # rows: 每个动作属于哪一局(默认第 i 个动作属于第 i 局); pid 为行动的玩家
+        action_type, pos, to_pid, clue_type, clue_value = action
+        N, P, H = hand_codes.shape
+        if rows is None:
+            rows = np.arange(len(action_type))
+        clue = clue[rows]
+        in_hand = (pos >= 0) & (pos < hand_len[rows, pid])
+        play_ok = (action_type == ACTION_PLAY) & in_hand
+        discard_ok = (action_type == ACTION_DISCARD) & in_hand & (clue < 8)
+
+        target = np.clip(to_pid, 0, P - 1)
+        valid_clue = self.clue_valid[np.clip(clue_type, 0, 1), np.clip(clue_value, 0, 9)] & \
+            (clue_value >= 0) & (clue_value <= 9) & ((clue_type == 0) | (clue_type == 1))
+        clue_ok = (action_type == ACTION_CLUE) & (clue > 0) & (to_pid >= 0) & (to_pid < P) & (to_pid != pid) & valid_clue
+        codes = hand_codes[rows, target]
+        lens = hand_len[rows, target]
+        # 看不到的牌(在线对局中替别人预测时)可能被任何提示触及
+        valid = np.arange(H)[None] < lens[:, None]
+        unknown = valid & ((codes // 10 == UNKNOWN) | (codes % 10 == UNKNOWN))
+        clue_ok &= (self.touched(codes, lens, clue_type, clue_value) | unknown).any(axis=1)
+        return play_ok | discard_ok | clue_ok
+
+    def legal_mask(self, pid, hand_codes, hand_len, clue):
+        # 返回 (N, 输出数量) 的合法掩码, 每个输出按 decode 解码之后用 action_legal 检查
+        N, P, H = hand_codes.shape
+        n_out = len(self.type)
+        out_ids = np.tile(np.arange(n_out), N)
+        rows = np.repeat(np.arange(N), n_out)
+        legal = self.action_legal(pid, self.decode(pid, P, out_ids), hand_codes, hand_len, clue, rows)
+        return legal.reshape(N, n_out)
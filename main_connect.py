@@ -66,9 +66,12 @@ def main():
     password = user_args["password"]
     model_name = user_args["model"]
     online = user_args["online"]
+    quantize = user_args.get("quantize", False)
+    backend = user_args.get("backend", "eager")
+    engine = user_args.get("engine", "torch")
 
     printf("Load Model")
-    model, action_dict_toact, action_dict_toid, output_action_dict_toact, output_action_dict_toid, device = load_model(model_name)
+    model, action_dict_toact, action_dict_toid, output_action_dict_toact, output_action_dict_toid, device = load_model(model_name, quantize, backend, engine)
 
     ws_url = None
     cookie = None
@@ -79,7 +82,7 @@ def main():
     printf("Launch UI")
     #QtCore.QCoreApplication.setAttribute(QtCore.Qt.AA_EnableHighDpiScaling)
     app = QtWidgets.QApplication(sys.argv)
-    MyUiStart = AIWindow(ws_url, cookie, [model, action_dict_toact, action_dict_toid, output_action_dict_toact, output_action_dict_toid, device])
+    MyUiStart = AIWindow(ws_url, cookie, [model, action_dict_toact, action_dict_toid, output_action_dict_toact, output_action_dict_toid, device], user_args)
     MyUiStart.show()
 
     sys.exit(app.exec_())
@@ -0,0 +1,110 @@
+import os
+import time
+import traceback
+
+import torch
+
+# 推理后端: 每个后端把 Transformer 包装成一个接收 (tokens, positions) 的前向函数, 返回 positions 处的输出
+# eager 直接使用模型本身(支持 KV cache), 其余后端只在没有 KV cache 的整段前向中使用:
+# v1 的逐回合预测、quant_check 以及 v2 回放时的 precompute_history(play_topk_positions)
+# v2 对局中的逐回合预测以及 beam/search 都带 KV cache, 始终是 eager
+# artifact: 后端可以保存到磁盘、下次启动直接读取的文件路径(目前只有 export 使用)
+
+INFERENCE_BACKENDS = {}
+
+
+class PositionForward(torch.nn.Module):
+    # 编译/导出的对象: 固定只走没有 KV cache 的分支, 输出 positions 处的 logits
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, tokens, positions):
+        return self.model(tokens, logits_pos=positions)
+
+
+def register_backend(name):
+    def wrapper(build):
+        INFERENCE_BACKENDS[name] = build
+        return build
+    return wrapper
+
+
+@register_backend("eager")
+def eager_backend(model, example, artifact=None):
+    return None
+
+
+@register_backend("compile")
+def compile_backend(model, example, artifact=None):
+    return torch.compile(PositionForward(model), dynamic=True)
+
+
+@register_backend("script")
+def script_backend(model, example, artifact=None):
+    return torch.jit.trace(PositionForward(model), example, check_trace=False)
+
+
+@register_backend("export")
+def export_backend(model, example, artifact=None):
+    if not hasattr(torch, "export"):
+        raise RuntimeError("export backend requires torch>=2.1")
+    if artifact is not None and os.path.exists(artifact):
+        try:
+            return torch.export.load(artifact).module()
+        except Exception:
+            traceback.print_exc()
+            print(f"WARNING: 无法读取 {artifact}, 重新导出")
+    seq = torch.export.Dim("seq", min=2, max=model.params.max_seq_len)
+    npos = torch.export.Dim("npos", min=1, max=model.params.max_seq_len)
+    program = torch.export.export(PositionForward(model), example,
+                                  dynamic_shapes={"tokens": {1: seq}, "positions": {0: npos}})
+    if artifact is not None:
+        try:
+            torch.export.save(program, artifact)
+            print(f"wrote {artifact}")
+        except OSError as e:
+            print(f"WARNING: 无法保存导出的模型 {artifact}: {e}")
+    return program.module()
+
+
+def _timed(fn, example):
+    start = time.perf_counter()
+    with torch.no_grad():
+        fn(*example)
+    return time.perf_counter() - start
+
+
+def set_backend(model, name, artifact=None, example_len=64, warmup=3):
+    # 构建后端并预热, 编译的耗时算在加载阶段; 失败时退回 eager
+    # eager 不需要构建, 也不做预热和计时, 保持启动速度
+    if name not in INFERENCE_BACKENDS:
+        print(f"WARNING: 未知的推理后端 {name}, 使用 eager")
+        name = "eager"
+    if name == "eager":
+        model.set_runner(None)
+        model.backend_stats = {"backend": name, "first_call": None, "steady": None}
+        return model.backend_stats
+    example_len = min(example_len, model.params.max_seq_len)
+    device = model.freqs_cos.device
+    # 位置取多个, 避免导出时把 positions 的长度固定成 1
+    example = (torch.randint(1, model.vocab_size, (1, example_len), device=device),
+               torch.arange(example_len // 2, example_len, device=device))
+    start = time.perf_counter()
+    try:
+        runner = INFERENCE_BACKENDS[name](model, example, artifact)
+    except Exception:
+        traceback.print_exc()
+        print(f"WARNING: 推理后端 {name} 构建失败, 使用 eager")
+        model.set_runner(None)
+        model.backend_stats = {"backend": "eager", "first_call": None, "steady": None}
+        return model.backend_stats
+    model.set_runner(runner)
+    infer = lambda tokens, positions: model.infer(tokens, positions=positions)
+    first_call = time.perf_counter() - start + _timed(infer, example)
+    steady = sum(_timed(infer, example) for _ in range(warmup)) / warmup
+    model.backend_stats = {"backend": name, "first_call": first_call, "steady": steady}
+    print(f"backend {name}: first call {first_call * 1000:.1f} ms, steady {steady * 1000:.1f} ms")
+    print(f"WARNING: 推理后端 {name} 只用于没有 KV cache 的整段前向(v1 预测, 回放预计算), "
+          f"v2 对局中的逐回合预测仍使用 eager + KV cache")
+    return model.backend_stats
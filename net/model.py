@@ -1,7 +1,7 @@
 import math
 import struct
 import inspect
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict
 from typing import Any, Optional, Tuple
 
 import threading
@@ -11,6 +11,8 @@ import torch
 import torch.nn.functional as F
 from torch import nn
 
+from net.model_file import write_model_file
+
 
 @dataclass
 class ModelArgs:
@@ -52,6 +54,10 @@ def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
 
 def reshape_for_broadcast(freqs_cis: torch.Tensor, x: torch.Tensor):
     ndim = x.ndim
+    if freqs_cis.ndim == 3:
+        # 每个样本有自己的位置 (bs, seqlen, head_dim // 2), 用于 padding 之后的 batch
+        assert freqs_cis.shape == (x.shape[0], x.shape[1], x.shape[-1])
+        return freqs_cis.view(x.shape[0], x.shape[1], 1, x.shape[-1])
     assert 0 <= 1 < ndim
     assert freqs_cis.shape == (x.shape[1], x.shape[-1])
     shape = [d if i == 1 or i == ndim - 1 else 1 for i, d in enumerate(x.shape)]
@@ -97,6 +103,80 @@ def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
     )
 
 
+class KVCache:
+    """逐层保存已经算过的 key/value, 每个座位一份, 用于逐回合增量推理"""
+
+    def __init__(self, n_layers: int):
+        self.cache_k = [None] * n_layers
+        self.cache_v = [None] * n_layers
+        self.seq_len = 0
+        # (bs, seq_len) 的 bool, 标记缓存中哪些位置是 padding, 没有 padding 时为 None
+        self.key_mask = None
+
+    def update(self, layer_id: int, xk: torch.Tensor, xv: torch.Tensor):
+        # xk/xv: (bs, seqlen, n_local_kv_heads, head_dim), 已经加过 RoPE
+        if self.cache_k[layer_id] is not None:
+            xk = torch.cat((self.cache_k[layer_id], xk), dim=1)
+            xv = torch.cat((self.cache_v[layer_id], xv), dim=1)
+        self.cache_k[layer_id] = xk
+        self.cache_v[layer_id] = xv
+        return xk, xv
+
+    def fork(self, n: int) -> "KVCache":
+        # 把 batch 为 1 的缓存复制成 n 份共享前缀(expand 不会拷贝数据)
+        forked = KVCache(len(self.cache_k))
+        forked.cache_k = [None if k is None else k.expand(n, *k.shape[1:]) for k in self.cache_k]
+        forked.cache_v = [None if v is None else v.expand(n, *v.shape[1:]) for v in self.cache_v]
+        forked.seq_len = self.seq_len
+        if self.key_mask is not None:
+            forked.key_mask = self.key_mask.expand(n, -1)
+        return forked
+
+    def select(self, rows):
+        # 按 rows 重新排列 batch 中的样本(beam search 中每一步只保留部分序列, 同一行可以出现多次)
+        self.cache_k = [None if k is None else k[rows] for k in self.cache_k]
+        self.cache_v = [None if v is None else v[rows] for v in self.cache_v]
+        if self.key_mask is not None:
+            self.key_mask = self.key_mask[rows]
+
+    def segment(self, start: int, end: int):
+        # 拷贝出 [start, end) 这一段的 key/value (前缀缓存中保存), 返回 (ks, vs, nbytes)
+        ks = [k[:, start:end].clone() for k in self.cache_k]
+        vs = [v[:, start:end].clone() for v in self.cache_v]
+        nbytes = sum(t.element_size() * t.numel() for t in ks + vs)
+        return ks, vs, nbytes
+
+    def extend(self, segments):
+        # 把多段 segment 依次接到缓存后面, 每层只拼接一次
+        if len(segments) == 0:
+            return
+        for layer_id in range(len(self.cache_k)):
+            ks = [] if self.cache_k[layer_id] is None else [self.cache_k[layer_id]]
+            vs = [] if self.cache_v[layer_id] is None else [self.cache_v[layer_id]]
+            self.cache_k[layer_id] = torch.cat(ks + [seg[0][layer_id] for seg in segments], dim=1)
+            self.cache_v[layer_id] = torch.cat(vs + [seg[1][layer_id] for seg in segments], dim=1)
+        self.seq_len += sum(seg[0][0].shape[1] for seg in segments)
+
+    def truncate(self, n: int):
+        # 只保留前 n 个位置(撤回时回到之前的序列长度)
+        if n >= self.seq_len:
+            return
+        if n == 0:
+            self.reset()
+            return
+        self.cache_k = [None if k is None else k[:, :n] for k in self.cache_k]
+        self.cache_v = [None if v is None else v[:, :n] for v in self.cache_v]
+        if self.key_mask is not None:
+            self.key_mask = self.key_mask[:, :n]
+        self.seq_len = n
+
+    def reset(self):
+        self.cache_k = [None] * len(self.cache_k)
+        self.cache_v = [None] * len(self.cache_v)
+        self.seq_len = 0
+        self.key_mask = None
+
+
 class Attention(nn.Module):
     def __init__(self, args: ModelArgs):
         super().__init__()
@@ -127,6 +207,9 @@ class Attention(nn.Module):
             x: torch.Tensor,
             freqs_cos: torch.Tensor,
             freqs_sin: torch.Tensor,
+            kv_cache: Optional[KVCache] = None,
+            layer_id: int = 0,
+            attn_mask: Optional[torch.Tensor] = None,
     ):
         bsz, seqlen, _ = x.shape
 
@@ -139,6 +222,12 @@ class Attention(nn.Module):
         # RoPE relative positional embeddings
         xq, xk = apply_rotary_emb(xq, xk, freqs_cos, freqs_sin)
 
+        # 拼接之前回合缓存的 key/value; 有缓存又没有 attn_mask 时只会输入单个新 token, 不需要 causal
+        is_causal = attn_mask is None
+        if kv_cache is not None:
+            is_causal = is_causal and kv_cache.cache_k[layer_id] is None
+            xk, xv = kv_cache.update(layer_id, xk, xv)
+
         # grouped multiquery attention: expand out keys and values
         xk = repeat_kv(xk, self.n_rep)  # (bs, seqlen, n_local_heads, head_dim)
         xv = repeat_kv(xv, self.n_rep)  # (bs, seqlen, n_local_heads, head_dim)
@@ -150,14 +239,17 @@ class Attention(nn.Module):
 
         # flash implementation
         if self.flash:
-            output = torch.nn.functional.scaled_dot_product_attention(xq, xk, xv, attn_mask=None,
+            output = torch.nn.functional.scaled_dot_product_attention(xq, xk, xv, attn_mask=attn_mask,
                                                                       dropout_p=self.dropout if self.training else 0.0,
-                                                                      is_causal=True)
+                                                                      is_causal=is_causal)
         else:
             # manual implementation
             scores = torch.matmul(xq, xk.transpose(2, 3)) / math.sqrt(self.head_dim)
-            assert hasattr(self, 'mask')
-            scores = scores + self.mask[:, :, :seqlen, :seqlen]  # (bs, n_local_heads, seqlen, cache_len + seqlen)
+            if attn_mask is not None:
+                scores = scores.masked_fill(~attn_mask, float("-inf"))
+            elif is_causal:
+                assert hasattr(self, 'mask')
+                scores = scores + self.mask[:, :, :seqlen, :seqlen]  # (bs, n_local_heads, seqlen, cache_len + seqlen)
             scores = F.softmax(scores.float(), dim=-1).type_as(xq)
             scores = self.attn_dropout(scores)
             output = torch.matmul(scores, xv)  # (bs, n_local_heads, seqlen, head_dim)
@@ -210,19 +302,19 @@ class MoEFeedForward(nn.Module):
         routing_weights /= routing_weights.sum(dim=-1, keepdim=True)
         routing_weights = routing_weights.to(x.dtype)
 
-        full_routing_weights = torch.zeros((batch_size, sequence_length, self.number_experts),
-                                           dtype=x.dtype, device=x.device)
-        for i in range(batch_size):
-            for j in range(sequence_length):
-                full_routing_weights[i, j, selected_experts[i, j]] = routing_weights[i, j]
-
-        final_hidden_states = torch.zeros(
-            (batch_size, sequence_length, hidden_dim), dtype=x.dtype, device=x.device
-        )
+        # 每个 token 只送给被选中的 top_k 个专家, 算完再按权重加回原位置
+        x_flat = x.reshape(-1, hidden_dim)
+        selected_flat = selected_experts.view(-1, self.top_k)
+        weights_flat = routing_weights.view(-1, self.top_k)
+        final_hidden_states = torch.zeros_like(x_flat)
         for expert_idx in range(self.number_experts):
-            ch = self.ffn_experts[f"expert{expert_idx}"](x)
-            final_hidden_states += ch * full_routing_weights[:, :, expert_idx:expert_idx + 1]
-        return final_hidden_states
+            token_idx, slot_idx = torch.nonzero(selected_flat == expert_idx, as_tuple=True)
+            if token_idx.numel() == 0:
+                continue
+            ch = self.ffn_experts[f"expert{expert_idx}"](x_flat[token_idx])
+            ch = ch * weights_flat[token_idx, slot_idx].unsqueeze(-1)
+            final_hidden_states.index_add_(0, token_idx, ch)
+        return final_hidden_states.view(batch_size, sequence_length, hidden_dim)
 
 
 class TransformerBlock(nn.Module):
@@ -247,8 +339,8 @@ class TransformerBlock(nn.Module):
         self.attention_norm = RMSNorm(args.dim, eps=args.norm_eps)
         self.ffn_norm = RMSNorm(args.dim, eps=args.norm_eps)
 
-    def forward(self, x, freqs_cos, freqs_sin):
-        h = x + self.attention.forward(self.attention_norm(x), freqs_cos, freqs_sin)
+    def forward(self, x, freqs_cos, freqs_sin, kv_cache=None, attn_mask=None):
+        h = x + self.attention.forward(self.attention_norm(x), freqs_cos, freqs_sin, kv_cache, self.layer_id, attn_mask)
         moe_out = self.feed_forward.forward(self.ffn_norm(h))
         out = h + moe_out
         return out
@@ -289,6 +381,19 @@ class Transformer(nn.Module):
 
         # Initialize attribute for the loss of the last forward call. This will be set if the forward is called with a targets tensor.
         self.last_loss = None
+        # 推理后端编译好的前向(只接收 tokens), 为 None 时使用 eager 前向
+        self.runner = None
+        self.backend_stats = None
+
+    def init_buffers(self, device=None):
+        # 在 meta device 上构建的模型加载权重之后, 重新计算不在 checkpoint 里的 buffer
+        freqs_cos, freqs_sin = precompute_freqs_cis(self.params.dim // self.params.n_heads, self.params.max_seq_len)
+        self.freqs_cos = freqs_cos.to(device)
+        self.freqs_sin = freqs_sin.to(device)
+        for layer in self.layers:
+            if not layer.attention.flash:
+                mask = torch.full((1, 1, self.params.max_seq_len, self.params.max_seq_len), float("-inf"))
+                layer.attention.mask = torch.triu(mask, diagonal=1).to(device)
 
     def _init_weights(self, module):
         if isinstance(module, nn.Linear):
@@ -298,21 +403,83 @@ class Transformer(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, tokens: torch.Tensor, targets: Optional[torch.Tensor] = None) -> torch.Tensor:
-        _bsz, seqlen = tokens.shape
+    def new_cache(self) -> KVCache:
+        return KVCache(self.n_layers)
+
+    def set_runner(self, runner):
+        # 用闭包保存, 避免编译后的模块被注册成子模块
+        self.runner = None if runner is None else (lambda tokens, positions: runner(tokens, positions))
+
+    def infer(self, tokens: torch.Tensor, kv_cache: Optional[KVCache] = None,
+              positions: Optional[torch.Tensor] = None) -> torch.Tensor:
+        # 没有 KV cache 的整段前向(v1 预测, 回放时一次算出所有决策点)交给推理后端
+        # positions 为 None 时只输出最后一个位置
+        if kv_cache is None and self.runner is not None:
+            if positions is None:
+                positions = torch.tensor([tokens.shape[1] - 1], device=tokens.device)
+            return self.runner(tokens, positions)
+        return self(tokens, kv_cache=kv_cache, logits_pos=positions)
+
+    def forward(self, tokens: torch.Tensor, targets: Optional[torch.Tensor] = None,
+                kv_cache: Optional[KVCache] = None, pad_mask: Optional[torch.Tensor] = None,
+                logits_pos: Optional[torch.Tensor] = None) -> torch.Tensor:
+        bsz, seqlen = tokens.shape
+        start_pos = 0 if kv_cache is None else kv_cache.seq_len
         h = self.tok_embeddings(tokens)
         h = self.dropout(h)
-        freqs_cos = self.freqs_cos[:seqlen]
-        freqs_sin = self.freqs_sin[:seqlen]
+
+        attn_mask = None
+        if pad_mask is None and (kv_cache is None or kv_cache.key_mask is None):
+            # RoPE 表只有 max_seq_len 个位置, KV cache 不会自动截断, 超出时直接报错
+            if start_pos + seqlen > self.params.max_seq_len:
+                raise ValueError(f"序列长度 {start_pos + seqlen} 超过模型的 max_seq_len {self.params.max_seq_len}")
+            freqs_cos = self.freqs_cos[start_pos:start_pos + seqlen]
+            freqs_sin = self.freqs_sin[start_pos:start_pos + seqlen]
+            # 有缓存并且一次输入多个新 token 时, 新 token 之间仍然是 causal, 但可以看到全部缓存
+            if start_pos > 0 and seqlen > 1:
+                attn_mask = torch.ones((seqlen, start_pos + seqlen), dtype=torch.bool, device=tokens.device)
+                attn_mask = attn_mask.tril(diagonal=start_pos)
+        else:
+            # 有 padding 的 batch: pad_mask 为 (bs, seqlen), True 表示真实 token
+            if pad_mask is None:
+                pad_mask = torch.ones((bsz, seqlen), dtype=torch.bool, device=tokens.device)
+            if kv_cache is None or start_pos == 0:
+                key_mask = pad_mask
+            elif kv_cache.key_mask is None:
+                prev_mask = torch.ones((bsz, start_pos), dtype=torch.bool, device=tokens.device)
+                key_mask = torch.cat((prev_mask, pad_mask), dim=1)
+            else:
+                key_mask = torch.cat((kv_cache.key_mask, pad_mask), dim=1)
+            # 每个样本按自己的真实 token 数计算 RoPE 位置, padding 不占位置
+            positions = (key_mask.long().cumsum(dim=1)[:, start_pos:] - 1).clamp(min=0)
+            if positions.numel() > 0 and int(positions.max()) >= self.params.max_seq_len:
+                raise ValueError(f"序列长度 {int(positions.max()) + 1} 超过模型的 max_seq_len {self.params.max_seq_len}")
+            freqs_cos = self.freqs_cos[positions]
+            freqs_sin = self.freqs_sin[positions]
+            # causal 并且不看 padding; 每个位置总能看到自己, 避免 padding 行 softmax 全是 -inf
+            total_len = start_pos + seqlen
+            causal = torch.ones((seqlen, total_len), dtype=torch.bool, device=tokens.device).tril(diagonal=start_pos)
+            diag = torch.zeros((seqlen, total_len), dtype=torch.bool, device=tokens.device)
+            diag[:, start_pos:] = torch.eye(seqlen, dtype=torch.bool, device=tokens.device)
+            attn_mask = (causal[None] & key_mask[:, None, :]) | diag[None]
+            attn_mask = attn_mask[:, None]  # (bs, 1, seqlen, cache_len + seqlen)
+            if kv_cache is not None:
+                kv_cache.key_mask = key_mask
 
         for layer in self.layers:
-            h = layer(h, freqs_cos, freqs_sin)
+            h = layer(h, freqs_cos, freqs_sin, kv_cache, attn_mask)
         h = self.norm(h)
+        if kv_cache is not None:
+            kv_cache.seq_len += seqlen
 
         if targets is not None:
             # if we are given some desired targets also calculate the loss
             logits = self.output(h)
             self.last_loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
+        elif logits_pos is not None:
+            # 只计算指定位置的输出(回放分析时一次前向得到所有决策点)
+            logits = self.output(h[:, logits_pos, :])
+            self.last_loss = None
         else:
             # inference-time mini-optimization: only forward the output on the very last position
             logits = self.output(h[:, [-1], :])  # note: using list [-1] to preserve the time dim
@@ -377,62 +544,48 @@ class Transformer(nn.Module):
         return idx.item(), idx_k3.tolist(), idx_k5.tolist(), ava_idx
 
     @torch.no_grad()
-    def play_topk(self, input, topk):
-        logits = self(input)
+    def play_topk(self, input, topk, kv_cache=None, logit_mask=None):
+        # 传入 kv_cache 时 input 只需要包含上次预测之后新增的 token
+        # logit_mask 为 False 的输出(不合法的动作)在 topk 之前设为 -inf
+        logits = self.infer(input, kv_cache)
         logits = logits[:, -1, :]
+        if logit_mask is not None:
+            logits = logits.masked_fill(~logit_mask, float("-inf"))
         prob, idx = torch.topk(logits, k=topk, dim=-1)
         if topk == 1:
             return idx.item(), prob.item()
         return idx[0], prob[0]
 
-    # def export(self, filepath='model.bin'):
-    #     """export the model weights in fp32 into .bin file to be read from C"""
-    #     f = open(filepath, 'wb')
-
-    #     def serialize(t):
-    #         d = t.detach().cpu().view(-1).numpy().astype(np.float32)
-    #         b = struct.pack(f'{len(d)}f', *d)
-    #         f.write(b)
-
-    #     # first write out the header
-    #     hidden_dim = self.layers[0].feed_forward.w1.weight.shape[0]
-    #     p = self.params
-    #     n_kv_heads = p.n_heads if p.n_kv_heads is None else p.n_kv_heads
-    #     header = struct.pack('iiiiiii', p.dim, hidden_dim, p.n_layers, p.n_heads,
-    #                                    n_kv_heads, p.vocab_size, p.max_seq_len)
-    #     f.write(header)
-
-    #     # next write out the embedding weights
-    #     serialize(self.tok_embeddings.weight)
-
-    #     # now all the layers
-    #     # attention weights
-    #     for layer in self.layers:
-    #         serialize(layer.attention_norm.weight)
-    #     for layer in self.layers:
-    #         serialize(layer.attention.wq.weight)
-    #     for layer in self.layers:
-    #         serialize(layer.attention.wk.weight)
-    #     for layer in self.layers:
-    #         serialize(layer.attention.wv.weight)
-    #     for layer in self.layers:
-    #         serialize(layer.attention.wo.weight)
-    #     # ffn weights
-    #     for layer in self.layers:
-    #         serialize(layer.ffn_norm.weight)
-    #     for layer in self.layers:
-    #         serialize(layer.feed_forward.w1.weight)
-    #     for layer in self.layers:
-    #         serialize(layer.feed_forward.w2.weight)
-    #     for layer in self.layers:
-    #         serialize(layer.feed_forward.w3.weight)
-    #     # final rmsnorm
-    #     serialize(self.norm.weight)
-    #     # note: no need to write final classifier weights due to weight sharing
-    #     # freqs_cis
-    #     serialize(self.freqs_cos[:p.max_seq_len])
-    #     serialize(self.freqs_sin[:p.max_seq_len])
-
-    #     # write to binary file
-    #     f.close()
-    #     print(f"wrote {filepath}")
\ No newline at end of file
+    @torch.no_grad()
+    def play_topk_batch(self, input, pad_mask, topk, kv_cache=None, logit_mask=None):
+        # input 为左侧 padding 的 (bs, seqlen), 返回每个样本最后一个位置的 topk: (bs, topk)
+        logits = self(input, kv_cache=kv_cache, pad_mask=pad_mask)
+        logits = logits[:, -1, :]
+        if logit_mask is not None:
+            logits = logits.masked_fill(~logit_mask, float("-inf"))
+        prob, idx = torch.topk(logits, k=topk, dim=-1)
+        return idx, prob
+
+    @torch.no_grad()
+    def play_logprob_topk_batch(self, input, pad_mask, topk, kv_cache=None, logit_mask=None):
+        # 与 play_topk_batch 相同, 但返回 log_softmax 之后的值(不同样本之间可以比较)
+        logits = self(input, kv_cache=kv_cache, pad_mask=pad_mask)
+        logits = logits[:, -1, :].float()
+        if logit_mask is not None:
+            logits = logits.masked_fill(~logit_mask, float("-inf"))
+        logprob = F.log_softmax(logits, dim=-1)
+        prob, idx = torch.topk(logprob, k=topk, dim=-1)
+        return idx, prob
+
+    @torch.no_grad()
+    def play_topk_positions(self, input, positions, topk):
+        # input 为 (1, seqlen), 返回 positions 中每个位置的 topk: (len(positions), topk)
+        logits = self.infer(input, positions=positions)[0]
+        prob, idx = torch.topk(logits, k=topk, dim=-1)
+        return idx, prob
+
+    def export(self, filepath='model.bin'):
+        """export the model weights in fp32 into a versioned .bin file, see net/model_file.py"""
+        tensors = {name: p.detach().float().cpu().numpy() for name, p in self.named_parameters()}
+        write_model_file(filepath, asdict(self.params), tensors)
+        print(f"wrote {filepath}")
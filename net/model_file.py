@@ -0,0 +1,70 @@
+import json
+import struct
+
+import numpy as np
+
+# 模型文件格式(不依赖 torch, numpy 推理也可以直接读取):
+#   magic(4 字节) | version(uint32) | header 长度(uint32) | header(json, utf-8) | 按 ALIGN 对齐的 tensor 数据
+# header 中记录模型参数, 词表大小, MoE 结构以及每个 tensor 的 dtype/shape/offset(相对文件开头)
+# 读取时用 np.memmap 映射整个文件, tensor 只是其中的切片视图, 多个进程共享同一份 page cache
+
+MODEL_FILE_MAGIC = b"HNBM"
+MODEL_FILE_VERSION = 1
+ALIGN = 64
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def write_model_file(filepath, model_args, tensors):
+    # tensors: name -> np.ndarray
+    tensors = {name: np.ascontiguousarray(t) for name, t in tensors.items()}
+    table = []
+    offset = 0
+    for name, t in tensors.items():
+        table.append({"name": name, "dtype": t.dtype.str, "shape": list(t.shape), "offset": offset})
+        offset = _align(offset + t.nbytes)
+    header = {
+        "model_args": model_args,
+        "vocab_size": model_args.get("vocab_size"),
+        "output_vocab_size": model_args.get("output_vocab_size"),
+        "moe": model_args.get("moe_config"),
+        "tensors": table,
+    }
+    header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    data_start = _align(len(MODEL_FILE_MAGIC) + 8 + len(header_bytes))
+    with open(filepath, "wb") as f:
+        f.write(MODEL_FILE_MAGIC)
+        f.write(struct.pack("<II", MODEL_FILE_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for entry, t in zip(table, tensors.values()):
+            f.write(b"\0" * (data_start + entry["offset"] - f.tell()))
+            f.write(t.tobytes())
+    return filepath
+
+
+def read_model_header(filepath):
+    with open(filepath, "rb") as f:
+        magic = f.read(len(MODEL_FILE_MAGIC))
+        if magic != MODEL_FILE_MAGIC:
+            raise ValueError(f"{filepath} 不是模型文件")
+        version, header_len = struct.unpack("<II", f.read(8))
+        if version > MODEL_FILE_VERSION:
+            raise ValueError(f"{filepath} 的版本 {version} 高于支持的版本 {MODEL_FILE_VERSION}")
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    header["data_start"] = _align(len(MODEL_FILE_MAGIC) + 8 + header_len)
+    return header
+
+
+def read_model_file(filepath, mode="r"):
+    # mode="r" 只读映射; torch 需要可写的 array 时使用 "c"(写时复制, 未修改的页仍然共享)
+    header = read_model_header(filepath)
+    mm = np.memmap(filepath, dtype=np.uint8, mode=mode)
+    tensors = {}
+    for entry in header["tensors"]:
+        dtype = np.dtype(entry["dtype"])
+        start = header["data_start"] + entry["offset"]
+        nbytes = dtype.itemsize * int(np.prod(entry["shape"], dtype=np.int64))
+        tensors[entry["name"]] = mm[start:start + nbytes].view(dtype).reshape(entry["shape"])
+    return header, tensors
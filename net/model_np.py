@@ -0,0 +1,311 @@
+import json
+import math
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+from net.model_file import read_model_file
+
+# 纯 numpy 实现的 Transformer 前向, 结构与 net/model.py 完全一致, 不需要 torch
+# 权重由 play_util.export_numpy_weights 导出, 或者直接读取 Transformer.export 写出的模型文件
+
+
+@dataclass
+class NumpyModelArgs:
+    dim: int = 4096
+    n_layers: int = 32
+    n_heads: int = 32
+    n_kv_heads: Optional[int] = None
+    vocab_size: int = -1
+    output_vocab_size: int = -1
+    multiple_of: int = 256
+    norm_eps: float = 1e-5
+    max_seq_len: int = 2048
+    dropout: float = 0.0
+    moe_config: Optional[dict] = None
+
+
+def rms_norm(x, weight, eps):
+    x = x.astype(np.float32)
+    return x / np.sqrt(np.mean(x * x, axis=-1, keepdims=True) + eps) * weight
+
+
+def silu(x):
+    return x / (1.0 + np.exp(-x))
+
+
+def softmax(x, axis=-1):
+    x = x - np.max(x, axis=axis, keepdims=True)
+    e = np.exp(x)
+    return e / np.sum(e, axis=axis, keepdims=True)
+
+
+def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
+    freqs = 1.0 / (theta ** (np.arange(0, dim, 2)[: (dim // 2)].astype(np.float32) / dim))
+    t = np.arange(end, dtype=np.float32)
+    freqs = np.outer(t, freqs).astype(np.float32)
+    return np.cos(freqs), np.sin(freqs)
+
+
+def apply_rotary_emb(x, freqs_cos, freqs_sin):
+    # x: (bs, seqlen, heads, head_dim); freqs: (seqlen, head_dim // 2) 或 (bs, seqlen, head_dim // 2)
+    if freqs_cos.ndim == 2:
+        freqs_cos = freqs_cos[None, :, None, :]
+        freqs_sin = freqs_sin[None, :, None, :]
+    else:
+        freqs_cos = freqs_cos[:, :, None, :]
+        freqs_sin = freqs_sin[:, :, None, :]
+    x_r = x[..., 0::2]
+    x_i = x[..., 1::2]
+    out = np.empty_like(x)
+    out[..., 0::2] = x_r * freqs_cos - x_i * freqs_sin
+    out[..., 1::2] = x_r * freqs_sin + x_i * freqs_cos
+    return out
+
+
+class NumpyKVCache:
+    """与 net.model.KVCache 相同的接口"""
+
+    def __init__(self, n_layers: int):
+        self.cache_k = [None] * n_layers
+        self.cache_v = [None] * n_layers
+        self.seq_len = 0
+        self.key_mask = None
+
+    def update(self, layer_id, xk, xv):
+        if self.cache_k[layer_id] is not None:
+            xk = np.concatenate((self.cache_k[layer_id], xk), axis=1)
+            xv = np.concatenate((self.cache_v[layer_id], xv), axis=1)
+        self.cache_k[layer_id] = xk
+        self.cache_v[layer_id] = xv
+        return xk, xv
+
+    def fork(self, n: int) -> "NumpyKVCache":
+        forked = NumpyKVCache(len(self.cache_k))
+        forked.cache_k = [None if k is None else np.broadcast_to(k, (n,) + k.shape[1:]) for k in self.cache_k]
+        forked.cache_v = [None if v is None else np.broadcast_to(v, (n,) + v.shape[1:]) for v in self.cache_v]
+        forked.seq_len = self.seq_len
+        if self.key_mask is not None:
+            forked.key_mask = np.broadcast_to(self.key_mask, (n, self.key_mask.shape[1]))
+        return forked
+
+    def select(self, rows):
+        self.cache_k = [None if k is None else k[rows] for k in self.cache_k]
+        self.cache_v = [None if v is None else v[rows] for v in self.cache_v]
+        if self.key_mask is not None:
+            self.key_mask = self.key_mask[rows]
+
+    def segment(self, start, end):
+        ks = [k[:, start:end].copy() for k in self.cache_k]
+        vs = [v[:, start:end].copy() for v in self.cache_v]
+        return ks, vs, sum(t.nbytes for t in ks + vs)
+
+    def extend(self, segments):
+        if len(segments) == 0:
+            return
+        for layer_id in range(len(self.cache_k)):
+            ks = [] if self.cache_k[layer_id] is None else [self.cache_k[layer_id]]
+            vs = [] if self.cache_v[layer_id] is None else [self.cache_v[layer_id]]
+            self.cache_k[layer_id] = np.concatenate(ks + [seg[0][layer_id] for seg in segments], axis=1)
+            self.cache_v[layer_id] = np.concatenate(vs + [seg[1][layer_id] for seg in segments], axis=1)
+        self.seq_len += sum(seg[0][0].shape[1] for seg in segments)
+
+    def truncate(self, n: int):
+        if n >= self.seq_len:
+            return
+        if n == 0:
+            self.reset()
+            return
+        self.cache_k = [None if k is None else k[:, :n] for k in self.cache_k]
+        self.cache_v = [None if v is None else v[:, :n] for v in self.cache_v]
+        if self.key_mask is not None:
+            self.key_mask = self.key_mask[:, :n]
+        self.seq_len = n
+
+    def reset(self):
+        self.cache_k = [None] * len(self.cache_k)
+        self.cache_v = [None] * len(self.cache_v)
+        self.seq_len = 0
+        self.key_mask = None
+
+
+class NumpyTransformer:
+    is_numpy = True
+
+    def __init__(self, params: NumpyModelArgs, weights):
+        self.params = params
+        self.weights = weights
+        self.vocab_size = params.vocab_size
+        self.n_layers = params.n_layers
+        self.n_heads = params.n_heads
+        self.n_kv_heads = params.n_heads if params.n_kv_heads is None else params.n_kv_heads
+        self.head_dim = params.dim // params.n_heads
+        self.moe_config = params.moe_config
+        self.freqs_cos, self.freqs_sin = precompute_freqs_cis(self.head_dim, params.max_seq_len)
+        # numpy 推理没有编译后端, 始终可以使用 KV cache
+        self.runner = None
+        self.backend_stats = None
+
+    @classmethod
+    def load(cls, path):
+        weights = dict(np.load(path))
+        model_args = json.loads(str(weights.pop("__model_args__")))
+        weights = {k: v.astype(np.float32) for k, v in weights.items()}
+        return cls(NumpyModelArgs(**model_args), weights)
+
+    @classmethod
+    def load_model_file(cls, path):
+        # fp32 的权重直接使用 memmap 视图, 不复制
+        header, weights = read_model_file(path)
+        weights = {k: v.astype(np.float32, copy=False) for k, v in weights.items()}
+        return cls(NumpyModelArgs(**header["model_args"]), weights)
+
+    def new_cache(self) -> NumpyKVCache:
+        return NumpyKVCache(self.n_layers)
+
+    def linear(self, x, name):
+        return x @ self.weights[name].T
+
+    def attention(self, x, layer_id, freqs_cos, freqs_sin, kv_cache, attn_mask):
+        bsz, seqlen, _ = x.shape
+        prefix = f"layers.{layer_id}.attention."
+        xq = self.linear(x, prefix + "wq.weight").reshape(bsz, seqlen, self.n_heads, self.head_dim)
+        xk = self.linear(x, prefix + "wk.weight").reshape(bsz, seqlen, self.n_kv_heads, self.head_dim)
+        xv = self.linear(x, prefix + "wv.weight").reshape(bsz, seqlen, self.n_kv_heads, self.head_dim)
+        xq = apply_rotary_emb(xq, freqs_cos, freqs_sin)
+        xk = apply_rotary_emb(xk, freqs_cos, freqs_sin)
+
+        is_causal = attn_mask is None
+        if kv_cache is not None:
+            is_causal = is_causal and kv_cache.cache_k[layer_id] is None
+            xk, xv = kv_cache.update(layer_id, xk, xv)
+
+        n_rep = self.n_heads // self.n_kv_heads
+        if n_rep > 1:
+            xk = np.repeat(xk, n_rep, axis=2)
+            xv = np.repeat(xv, n_rep, axis=2)
+
+        xq = xq.transpose(0, 2, 1, 3)
+        xk = xk.transpose(0, 2, 1, 3)
+        xv = xv.transpose(0, 2, 1, 3)
+        scores = xq @ xk.transpose(0, 1, 3, 2) / math.sqrt(self.head_dim)
+        if attn_mask is not None:
+            scores = np.where(attn_mask, scores, -np.inf)
+        elif is_causal and seqlen > 1:
+            scores = scores + np.triu(np.full((seqlen, seqlen), -np.inf, dtype=np.float32), k=1)
+        output = softmax(scores) @ xv
+        output = output.transpose(0, 2, 1, 3).reshape(bsz, seqlen, -1)
+        return self.linear(output, prefix + "wo.weight")
+
+    def feed_forward(self, x, prefix):
+        return self.linear(silu(self.linear(x, prefix + "w1.weight")) * self.linear(x, prefix + "w3.weight"),
+                           prefix + "w2.weight")
+
+    def moe_feed_forward(self, x, layer_id):
+        batch_size, sequence_length, hidden_dim = x.shape
+        prefix = f"layers.{layer_id}.feed_forward."
+        top_k = self.moe_config["top_k"]
+        x_flat = x.reshape(-1, hidden_dim)
+        routing_weights = softmax(self.linear(x_flat, prefix + "router.weight"))
+        selected = np.argsort(-routing_weights, axis=-1, kind="stable")[:, :top_k]
+        weights = np.take_along_axis(routing_weights, selected, axis=-1)
+        weights = weights / weights.sum(axis=-1, keepdims=True)
+        final_hidden_states = np.zeros_like(x_flat)
+        for expert_idx in range(self.moe_config["experts"]):
+            token_idx, slot_idx = np.nonzero(selected == expert_idx)
+            if len(token_idx) == 0:
+                continue
+            ch = self.feed_forward(x_flat[token_idx], prefix + f"ffn_experts.expert{expert_idx}.")
+            np.add.at(final_hidden_states, token_idx, ch * weights[token_idx, slot_idx][:, None])
+        return final_hidden_states.reshape(batch_size, sequence_length, hidden_dim)
+
+    def forward(self, tokens, kv_cache=None, pad_mask=None, logits_pos=None):
+        bsz, seqlen = tokens.shape
+        start_pos = 0 if kv_cache is None else kv_cache.seq_len
+        h = self.weights["tok_embeddings.weight"][tokens]
+
+        attn_mask = None
+        if pad_mask is None and (kv_cache is None or kv_cache.key_mask is None):
+            if start_pos + seqlen > self.params.max_seq_len:
+                raise ValueError(f"序列长度 {start_pos + seqlen} 超过模型的 max_seq_len {self.params.max_seq_len}")
+            freqs_cos = self.freqs_cos[start_pos:start_pos + seqlen]
+            freqs_sin = self.freqs_sin[start_pos:start_pos + seqlen]
+            if start_pos > 0 and seqlen > 1:
+                attn_mask = np.tril(np.ones((seqlen, start_pos + seqlen), dtype=bool), k=start_pos)
+        else:
+            if pad_mask is None:
+                pad_mask = np.ones((bsz, seqlen), dtype=bool)
+            if kv_cache is None or start_pos == 0:
+                key_mask = pad_mask
+            elif kv_cache.key_mask is None:
+                key_mask = np.concatenate((np.ones((bsz, start_pos), dtype=bool), pad_mask), axis=1)
+            else:
+                key_mask = np.concatenate((kv_cache.key_mask, pad_mask), axis=1)
+            positions = np.maximum(np.cumsum(key_mask, axis=1)[:, start_pos:] - 1, 0)
+            if positions.size > 0 and positions.max() >= self.params.max_seq_len:
+                raise ValueError(f"序列长度 {positions.max() + 1} 超过模型的 max_seq_len {self.params.max_seq_len}")
+            freqs_cos = self.freqs_cos[positions]
+            freqs_sin = self.freqs_sin[positions]
+            total_len = start_pos + seqlen
+            causal = np.tril(np.ones((seqlen, total_len), dtype=bool), k=start_pos)
+            diag = np.zeros((seqlen, total_len), dtype=bool)
+            diag[:, start_pos:] = np.eye(seqlen, dtype=bool)
+            attn_mask = ((causal[None] & key_mask[:, None, :]) | diag[None])[:, None]
+            if kv_cache is not None:
+                kv_cache.key_mask = key_mask
+
+        eps = self.params.norm_eps
+        for layer_id in range(self.n_layers):
+            prefix = f"layers.{layer_id}."
+            h = h + self.attention(rms_norm(h, self.weights[prefix + "attention_norm.weight"], eps),
+                                   layer_id, freqs_cos, freqs_sin, kv_cache, attn_mask)
+            x = rms_norm(h, self.weights[prefix + "ffn_norm.weight"], eps)
+            if self.moe_config is None:
+                h = h + self.feed_forward(x, prefix + "feed_forward.")
+            else:
+                h = h + self.moe_feed_forward(x, layer_id)
+        h = rms_norm(h, self.weights["norm.weight"], eps)
+        if kv_cache is not None:
+            kv_cache.seq_len += seqlen
+        if logits_pos is not None:
+            return self.linear(h[:, logits_pos, :], "output.weight")
+        # 只计算最后一个位置的输出
+        return self.linear(h[:, [-1], :], "output.weight")
+
+    def infer(self, tokens, kv_cache=None, positions=None):
+        return self.forward(tokens, kv_cache, logits_pos=positions)
+
+    def play_topk(self, input, topk, kv_cache=None, logit_mask=None):
+        logits = self.infer(input, kv_cache)[0, -1]
+        if logit_mask is not None:
+            logits = np.where(logit_mask, logits, -np.inf)
+        idx = np.argsort(-logits, kind="stable")[:topk]
+        prob = logits[idx]
+        if topk == 1:
+            return int(idx[0]), float(prob[0])
+        return idx, prob
+
+    def play_topk_batch(self, input, pad_mask, topk, kv_cache=None, logit_mask=None):
+        logits = self.forward(input, kv_cache, pad_mask)[:, -1]
+        if logit_mask is not None:
+            logits = np.where(logit_mask, logits, -np.inf)
+        idx = np.argsort(-logits, axis=-1, kind="stable")[:, :topk]
+        prob = np.take_along_axis(logits, idx, axis=-1)
+        return idx, prob
+
+    def play_logprob_topk_batch(self, input, pad_mask, topk, kv_cache=None, logit_mask=None):
+        logits = self.forward(input, kv_cache, pad_mask)[:, -1]
+        if logit_mask is not None:
+            logits = np.where(logit_mask, logits, -np.inf)
+        logprob = logits - logits.max(axis=-1, keepdims=True)
+        logprob -= np.log(np.exp(logprob).sum(axis=-1, keepdims=True))
+        idx = np.argsort(-logprob, axis=-1, kind="stable")[:, :topk]
+        prob = np.take_along_axis(logprob, idx, axis=-1)
+        return idx, prob
+
+    def play_topk_positions(self, input, positions, topk):
+        logits = self.infer(input, positions=positions)[0]
+        idx = np.argsort(-logits, axis=-1, kind="stable")[:, :topk]
+        prob = np.take_along_axis(logits, idx, axis=-1)
+        return idx, prob
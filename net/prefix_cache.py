@@ -0,0 +1,119 @@
+# 回放浏览用的前缀 KV cache: 以 token id 序列为 key 的 radix tree
+# 每个节点保存自己这一段(edge)的 key/value, 从根到节点的路径拼起来就是该前缀的完整缓存
+# 超过 max_bytes 时按 LRU 淘汰叶子节点; 与 KVCache/NumpyKVCache 的 segment/extend 配合, 不依赖 torch
+
+
+def _copy(t):
+    # torch.Tensor / np.ndarray 的拷贝
+    return t.clone() if hasattr(t, "clone") else t.copy()
+
+
+class PrefixNode:
+    def __init__(self, ids=(), ks=None, vs=None, nbytes=0, parent=None):
+        self.ids = ids
+        self.ks = ks
+        self.vs = vs
+        self.nbytes = nbytes
+        self.parent = parent
+        self.children = {}
+        self.last_used = 0
+
+    def split(self, n):
+        # 把 edge 在 n 处拆成两段, 前半段留在新的父节点上
+        # 两段都拷贝出来: 切片是共享整段存储的 view, 淘汰其中一段时什么都不会释放, nbytes 也会重复计算
+        head = PrefixNode(self.ids[:n], [_copy(k[:, :n]) for k in self.ks], [_copy(v[:, :n]) for v in self.vs],
+                          self.nbytes * n // len(self.ids), self.parent)
+        head.last_used = self.last_used
+        self.parent.children[self.ids[0]] = head
+        head.children[self.ids[n]] = self
+        self.parent = head
+        self.ks = [_copy(k[:, n:]) for k in self.ks]
+        self.vs = [_copy(v[:, n:]) for v in self.vs]
+        self.nbytes -= head.nbytes
+        self.ids = self.ids[n:]
+        return head
+
+
+def _common_len(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class PrefixKVCache:
+    def __init__(self, model, max_bytes=256 * 1024 * 1024):
+        self.model = model
+        self.max_bytes = max_bytes
+        self.root = PrefixNode()
+        self.total_bytes = 0
+        self.tick = 0
+
+    def touch(self, node):
+        self.tick += 1
+        node.last_used = self.tick
+
+    def match(self, ids):
+        # 返回 (kv_cache, 命中长度); 最后一个 token 总是留给模型计算, 这样才能得到输出
+        limit = len(ids) - 1
+        segments = []
+        node = self.root
+        pos = 0
+        while pos < limit:
+            child = node.children.get(ids[pos])
+            if child is None:
+                break
+            n = _common_len(child.ids, ids[pos:limit])
+            self.touch(child)
+            if n == len(child.ids):
+                segments.append((child.ks, child.vs))
+            else:
+                segments.append(([k[:, :n] for k in child.ks], [v[:, :n] for v in child.vs]))
+            pos += n
+            if n < len(child.ids):
+                break
+            node = child
+        kv_cache = self.model.new_cache()
+        kv_cache.extend(segments)
+        return kv_cache, pos
+
+    def insert(self, ids, kv_cache):
+        # kv_cache 中是 ids 全部 token 的缓存, 只保存树中还没有的部分
+        node = self.root
+        pos = 0
+        while pos < len(ids):
+            child = node.children.get(ids[pos])
+            if child is None:
+                ks, vs, nbytes = kv_cache.segment(pos, len(ids))
+                child = PrefixNode(tuple(ids[pos:]), ks, vs, nbytes, node)
+                node.children[ids[pos]] = child
+                self.total_bytes += nbytes
+                self.touch(child)
+                break
+            n = _common_len(child.ids, ids[pos:])
+            if n < len(child.ids):
+                child = child.split(n)
+            self.touch(child)
+            pos += n
+            node = child
+        self.evict()
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes:
+            leaves = []
+            stack = [self.root]
+            while stack:
+                node = stack.pop()
+                if len(node.children) == 0 and node is not self.root:
+                    leaves.append(node)
+                stack.extend(node.children.values())
+            if len(leaves) == 0:
+                break
+            leaf = min(leaves, key=lambda node: node.last_used)
+            del leaf.parent.children[leaf.ids[0]]
+            self.total_bytes -= leaf.nbytes
+
+    def clear(self):
+        self.root = PrefixNode()
+        self.total_bytes = 0
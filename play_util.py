@@ -1,16 +1,104 @@
 
 import sys
 type = sys.getfilesystemencoding()
+import os
 import json
-import torch
-from net.model import ModelArgs, Transformer
+import hashlib
+import inspect
 import numpy as np
+from net.model_np import NumpyTransformer
+from net.model_file import read_model_file
+try:
+    import torch
+    from net.model import ModelArgs, Transformer
+    from net.backends import set_backend
+except ImportError:
+    # 没有安装 torch 时只能使用 numpy 推理
+    torch = None
 
-def load_model(model_name=None):
-    #device = 'cuda' if torch.cuda.is_available() else 'cpu'  # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
-    device = 'cpu'
+class ActionVocab(dict):
+    # token -> id 的字典, 另外负责把单个 token 编码成 id, 控制器在添加 token 时调用一次即可
+    def __init__(self):
+        super().__init__()
+        self.output_to_input = None
+
+    def set_output_dict(self, output_acition_dict):
+        # 输出动作 id -> 输入 token id, 用于把预测的动作接回输入序列(推演时使用)
+        self.output_to_input = [self.get(action, 0) for action in output_acition_dict]
+
+    def encode(self, action):
+        # 不需要输入模型的 token 返回 None, 不认识的 token 与 encode_actions 相同返回 NULL 字符串
+        idx = self.get(action)
+        if idx is not None:
+            return idx
+        if len(action) < 1 or not any(char.isalpha() for char in action):
+            return None
+        action = action.strip()
+        if action not in self:
+            action = action.replace("light-myself", "light_myself")
+        if action not in self:
+            print(f"NULL[{action}]")
+            return f"NULL[{action}]"
+        return self[action]
 
-    acition_dict_toid = {}
+def quantize_model(model):
+    # 动态 int8 量化 Attention/FeedForward 以及输出层的 nn.Linear, MoE 的 router 保持 fp32
+    linear_names = {name for name, module in model.named_modules()
+                    if isinstance(module, torch.nn.Linear) and not name.endswith("router")}
+    return torch.ao.quantization.quantize_dynamic(model, linear_names, dtype=torch.qint8)
+
+def checkpoint_paths(model_name=None):
+    # 原始 checkpoint 以及转换之后(key 已经规范化)的权重文件
+    if model_name is None:
+        return 'best_valid.pth', 'best_valid_mmap.pth'
+    return f'{model_name}/model.pth', f'{model_name}/model_mmap.pth'
+
+def _mmap_load_args():
+    # torch>=2.1 才支持 mmap 读取
+    load_args = {}
+    if "mmap" in inspect.signature(torch.load).parameters:
+        load_args["mmap"] = True
+        load_args["weights_only"] = True
+    return load_args
+
+def read_checkpoint(model_name=None, device='cpu'):
+    # 读取原始 checkpoint 并去掉 torch.compile 留下的 _orig_mod. 前缀
+    ckpt_path, _ = checkpoint_paths(model_name)
+    state_dict = torch.load(ckpt_path, map_location=device)
+    unwanted_prefix = '_orig_mod.'
+    for k, v in list(state_dict.items()):
+        if k.startswith(unwanted_prefix):
+            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+    return state_dict
+
+def convert_checkpoint(model_name=None, device='cpu'):
+    # 由 convert_model.py 显式调用: 规范化 key 之后另存一份, 之后启动直接 mmap 读取转换后的文件
+    _, converted_path = checkpoint_paths(model_name)
+    state_dict = read_checkpoint(model_name, device)
+    try:
+        torch.save(state_dict, converted_path)
+    except OSError as e:
+        print(f"WARNING: 无法保存转换后的权重 {converted_path}: {e}")
+    return state_dict
+
+def build_model(gptconf, state_dict, device):
+    # 在 meta device 上构建模型, 跳过随机初始化, 直接使用 checkpoint 中的权重
+    with torch.device("meta"):
+        model = Transformer(gptconf)
+    if "assign" in inspect.signature(model.load_state_dict).parameters:
+        result = model.load_state_dict(state_dict, strict=False, assign=True)
+    else:
+        model.to_empty(device=device)
+        result = model.load_state_dict(state_dict, strict=False)
+    # attention mask 不一定保存在权重文件里, 由 init_buffers 重新计算
+    missing_keys = [k for k in result.missing_keys if not k.endswith(".mask")]
+    if len(missing_keys) > 0:
+        print(f"WARNING: checkpoint 缺少权重 {missing_keys}")
+    model.init_buffers(device)
+    return model
+
+def load_dicts(model_name=None):
+    acition_dict_toid = ActionVocab()
     if model_name is None:
         dict_path = 'dict.json'
     else:
@@ -23,7 +111,6 @@ def load_model(model_name=None):
             acition_dict_toid[action] = ind
             #print(action, ind)
             ind += 1
-        n_vacabs = len(acition_dict)
     output_acition_dict_toid = {}
     if model_name is None:
         output_dict_path = 'output_dict.json'
@@ -37,8 +124,10 @@ def load_model(model_name=None):
             output_acition_dict_toid[action] = ind
             #print(action, ind)
             ind += 1
-        n_vacabs_out = len(output_acition_dict)
+    acition_dict_toid.set_output_dict(output_acition_dict)
+    return acition_dict, acition_dict_toid, output_acition_dict, output_acition_dict_toid
 
+def load_model_args(model_name, n_vacabs, n_vacabs_out):
     if model_name is None:
         max_seq_len = 900
         dim = 384
@@ -61,6 +150,82 @@ def load_model(model_name=None):
         with open(f'{model_name}/config.json', 'r') as json_file:
             model_config = json.load(json_file)
             model_args = model_config["model_args"]
+    return model_args
+
+def load_state_dict(model_name=None, device='cpu'):
+    ckpt_path, converted_path = checkpoint_paths(model_name)
+    if os.path.exists(converted_path):
+        # 已经转换过的权重: key 已经规范化, 可以直接 mmap 读取
+        return torch.load(converted_path, map_location=device, **_mmap_load_args())
+    # 不会自动在模型目录里写文件, 需要加速启动时先运行 convert_model.py
+    print(f"没有找到转换后的权重 {converted_path}, 读取原始 checkpoint (python convert_model.py 可以加快之后的启动)")
+    return read_checkpoint(model_name, device)
+
+def numpy_weights_path(model_name=None):
+    if model_name is None:
+        return 'best_valid_np.npz'
+    return f'{model_name}/model_np.npz'
+
+def export_numpy_weights(model_name=None):
+    # 导出 numpy 推理使用的权重(fp32), 模型参数一起写入, 部署时不再需要 torch
+    acition_dict, _, output_acition_dict, _ = load_dicts(model_name)
+    model_args = load_model_args(model_name, len(acition_dict), len(output_acition_dict))
+    state_dict = load_state_dict(model_name)
+    arrays = {k: v.detach().float().cpu().numpy() for k, v in state_dict.items()}
+    arrays["__model_args__"] = np.array(json.dumps(model_args))
+    np.savez(numpy_weights_path(model_name), **arrays)
+    return numpy_weights_path(model_name)
+
+def model_file_path(model_name=None):
+    # Transformer.export 写出的模型文件, 存在时优先使用
+    if model_name is None:
+        return 'best_valid.bin'
+    return f'{model_name}/model.bin'
+
+def load_model_file(model_name=None):
+    # 写时复制映射, 权重与文件共享 page cache, 多个进程只占一份内存
+    header, tensors = read_model_file(model_file_path(model_name), mode="c")
+    state_dict = {k: torch.from_numpy(v) for k, v in tensors.items()}
+    return header["model_args"], state_dict
+
+def model_identity(model_name=None, quantize=False, engine="torch"):
+    # 预测缓存使用的模型标识: 权重文件变化(重新训练/转换)或者推理方式不同时缓存失效
+    stats = []
+    for path in checkpoint_paths(model_name)[:1] + (model_file_path(model_name), numpy_weights_path(model_name)):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stats.append(f"{path}:{stat.st_size}:{int(stat.st_mtime)}")
+    return f"{model_name}|{engine}|{quantize}|{'|'.join(stats)}"
+
+def export_program_path(model_name=None, model_id=""):
+    # export 后端保存的计算图(包含权重), 文件名带模型标识以及 torch 版本的 hash, 权重变化后不会读到旧的文件
+    # positions: 计算图接收 (tokens, positions), 与只接收 tokens 的旧文件区分
+    digest = hashlib.sha1(f"{model_id}|{torch.__version__}|positions".encode("utf-8")).hexdigest()[:12]
+    if model_name is None:
+        return f'best_valid_export_{digest}.pt2'
+    return f'{model_name}/model_export_{digest}.pt2'
+
+def prediction_cache_path(model_name=None):
+    if model_name is None:
+        return 'predictions.sqlite'
+    return f'{model_name}/predictions.sqlite'
+
+def load_model(model_name=None, quantize=False, backend="eager", engine="torch"):
+    #device = 'cuda' if torch.cuda.is_available() else 'cpu'  # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+    device = 'cpu'
+
+    acition_dict, acition_dict_toid, output_acition_dict, output_acition_dict_toid = load_dicts(model_name)
+    if torch is None and engine != "numpy":
+        print("WARNING: 没有安装 torch, 使用 numpy 推理")
+        engine = "numpy"
+    if engine == "numpy":
+        if os.path.exists(model_file_path(model_name)):
+            model = NumpyTransformer.load_model_file(model_file_path(model_name))
+        else:
+            model = NumpyTransformer.load(numpy_weights_path(model_name))
+        model.model_name = model_name
+        model.model_id = model_identity(model_name, False, engine)
+        return model, acition_dict, acition_dict_toid, output_acition_dict, output_acition_dict_toid, device
 
     seed = 1337
     torch.manual_seed(seed)
@@ -69,79 +234,154 @@ def load_model(model_name=None):
     torch.backends.cudnn.allow_tf32 = True  # allow tf32 on cudnn
 
     # init from a model saved in a specific directory
-    if model_name is None:
-        ckpt_path = 'best_valid.pth'
+    if os.path.exists(model_file_path(model_name)):
+        model_args, state_dict = load_model_file(model_name)
     else:
-        ckpt_path = f'{model_name}/model.pth'
-    state_dict = torch.load(ckpt_path, map_location=device)
+        model_args = load_model_args(model_name, len(acition_dict), len(output_acition_dict))
+        state_dict = load_state_dict(model_name, device)
     gptconf = ModelArgs(**model_args)
-    model = Transformer(gptconf)
-    unwanted_prefix = '_orig_mod.'
-    for k, v in list(state_dict.items()):
-        if k.startswith(unwanted_prefix):
-            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict, strict=False)
+    model = build_model(gptconf, state_dict, device)
     model.eval()
     model.to(device)
+    if quantize:
+        model = quantize_model(model)
+    model.model_name = model_name
+    model.model_id = model_identity(model_name, quantize, engine)
+    set_backend(model, backend, export_program_path(model_name, model.model_id))
     return model, acition_dict, acition_dict_toid, output_acition_dict, output_acition_dict_toid, device
 
-def generate_answer(model, input_actions, acition_dict_toid, device, topk):
+def encode_actions(input_actions, acition_dict_toid):
     input_id = []
     for action in input_actions:
         if len(action) < 1:
             continue
         if any(char.isalpha() for char in action):
             action = action.strip()
+            if action not in acition_dict_toid:
+                action = action.replace("light-myself", "light_myself")
             if action not in acition_dict_toid:
                 print(f"NULL[{action}]")
                 return f"NULL[{action}]"
             input_id.append(acition_dict_toid[action])
+    return input_id
+
+def output_to_input_ids(output_ids, acition_dict_toid, output_action_dict_toact):
+    if getattr(acition_dict_toid, "output_to_input", None) is not None:
+        return [acition_dict_toid.output_to_input[ava_id] for ava_id in output_ids]
+    return [acition_dict_toid[output_action_dict_toact[ava_id]] for ava_id in output_ids]
+
+def to_model_input(model, array, device):
+    # numpy 推理直接使用 numpy 数组, torch 推理转换成 tensor
+    if getattr(model, "is_numpy", False):
+        return array
+    return torch.from_numpy(array).to(device)
+
+def drop_masked(idx, probs):
+    # 合法的输出少于 topk 时, 去掉排在最后的被屏蔽(-inf)的输出
+    keep = int((np.array(probs.tolist()) > -np.inf).sum())
+    return idx[:keep], probs[:keep]
+
+def generate_answer_ids(model, input_id, device, topk, kv_cache=None, logit_mask=None):
+    # input_id 是已经编码好的 id 列表; 传入 kv_cache 时只需要是该座位上次预测之后新增的 id
+    # logit_mask: 每个输出是否合法, 不合法的输出不会出现在结果中
+    input_id = to_model_input(model, np.array([input_id], dtype=np.int64), device)
+    if logit_mask is None:
+        return model.play_topk(input_id, topk, kv_cache)
+    idx, probs = model.play_topk(input_id, topk, kv_cache, to_model_input(model, logit_mask, device))
+    if topk == 1:
+        return idx, probs
+    return drop_masked(idx, probs)
+
+def generate_answer_positions(model, input_id, positions, device, topk):
+    # 一次前向得到 input_id 中多个位置(每个位置只看到它之前的 token)的预测
+    input_id = to_model_input(model, np.array([input_id], dtype=np.int64), device)
+    positions = to_model_input(model, np.array(positions, dtype=np.int64), device)
+    return model.play_topk_positions(input_id, positions, topk)
+
+def generate_answer(model, input_actions, acition_dict_toid, device, topk, kv_cache=None):
+    input_id = encode_actions(input_actions, acition_dict_toid)
+    if isinstance(input_id, str):
+        return input_id
     #print(input_id)
-    input_id = np.array([input_id])
-    input_id = torch.from_numpy(input_id)
-    input_id = input_id.to(device)
-    idx, probs = model.play_topk(input_id, topk)
-    return idx, probs
+    return generate_answer_ids(model, input_id, device, topk, kv_cache)
 
-def generate_answer_ahead(model, input_actions, input_pos, acition_dict_toid, output_action_dict_toact, device, topk, ahead_step, ahead_p):
-    input_id = []
-    for action in input_actions:
-        if len(action) < 1:
-            continue
-        if any(char.isalpha() for char in action):
-            action = action.replace("light-myself","light_myself")
-            action = action.strip()
-            if action not in acition_dict_toid:
-                #print(f"NULL[{action}]")
-                return f"NULL[{action}]"
-            input_id.append(acition_dict_toid[action])
-    input_id = np.array([input_id])
-    input_id = torch.from_numpy(input_id)
-    input_id = input_id.to(device)
-    idx, probs = model.play_topk(input_id, topk)
-    max_prob = 0
-    return_idx = None
-    ind = 0
-    for ava_id in idx:
-        input_next_id = input_id
-        current_prob = probs[ind]
-        current_action = output_action_dict_toact[ava_id]
-        # current_action = current_action.replace("light-myself","light_myself")
-        next_id = acition_dict_toid[current_action]
-        next_id = torch.tensor(np.array([[next_id]])).to(device)
-        # print(current_action)
-        ind += 1
+def generate_answer_lookahead(model, input_id, acition_dict_toid, output_action_dict_toact, device, topk, ahead_step, ahead_p, kv_cache=None, logit_mask=None):
+    # 前缀只算一次, 然后把缓存复制成 topk 份, 所有候选动作作为一个 batch 一起向后推演 ahead_step 步
+    # logit_mask 只作用于第一步(自己的动作), 之后推演的是其他玩家的动作
+    if kv_cache is None:
+        kv_cache = model.new_cache()
+    idx, probs = generate_answer_ids(model, input_id, device, topk, kv_cache, logit_mask)
+    if topk == 1:
+        # play_topk 在 topk == 1 时返回标量, 这里统一成长度为 1 的数组
+        idx = to_model_input(model, np.array([idx], dtype=np.int64), device)
+        probs = to_model_input(model, np.array([probs], dtype=np.float32), device)
+    scores = np.array(probs.tolist(), dtype=np.float32)
+    if ahead_step > 0:
+        ahead_cache = kv_cache.fork(len(idx))
+        next_id = output_to_input_ids(idx.tolist(), acition_dict_toid, output_action_dict_toact)
         for step in range(ahead_step):
-            input_next_id = torch.cat((input_next_id, next_id), dim=1)
-            next_id, prob = model.play_topk(input_next_id, 1)
-            next_action = output_action_dict_toact[next_id]
-            # print(next_action)
-            next_id = acition_dict_toid[next_action]
-            next_id = torch.tensor(np.array([[next_id]])).to(device)
-            current_prob += prob * pow(ahead_p, step + 1)
-        if current_prob > max_prob:
-            max_prob = current_prob
-            return_idx = ava_id
-        # print(ava_id, current_prob)
-    return return_idx, max_prob
+            next_id = to_model_input(model, np.array(next_id, dtype=np.int64)[:, None], device)
+            next_idx, prob = model.play_topk_batch(next_id, None, 1, ahead_cache)
+            scores += np.array(prob[:, 0].tolist(), dtype=np.float32) * pow(ahead_p, step + 1)
+            next_id = output_to_input_ids(next_idx[:, 0].tolist(), acition_dict_toid, output_action_dict_toact)
+    return idx, probs, scores
+
+def owner_best(n, owner, row_scores):
+    # 每个候选动作的分数为它最好的一行; 没有行的(已经剪掉)为 -inf
+    # 剪掉时的分数只推演到更浅的一层, 与推演到底的分数不可比, 不能保留
+    best = np.full(n, -np.inf)
+    np.maximum.at(best, owner, row_scores)
+    return best
+
+def generate_answer_beam(model, input_id, acition_dict_toid, output_action_dict_toact, device, topk, ahead_step, beam_width, ahead_p=1.0, prune=10.0, kv_cache=None, logit_mask=None):
+    # beam search 向后推演: 每个候选动作保留累计 log 概率最高的 beam_width 条后续, 每一层所有序列一次 batch 前向
+    # 候选动作的分数 = 自身的 log 概率 + 最好的一条后续的累计 log 概率(第 d 步乘以 ahead_p^d)
+    # 某个候选动作最好的累计分数比领先者低 prune 以上时不再展开(log 概率只会越加越小), 排在所有推演到底的候选之后
+    # 每一层最多 topk * beam_width 行
+    if kv_cache is None:
+        kv_cache = model.new_cache()
+    root_id = to_model_input(model, np.array([input_id], dtype=np.int64), device)
+    if logit_mask is not None:
+        logit_mask = to_model_input(model, logit_mask, device)
+    idx, logprob = model.play_logprob_topk_batch(root_id, None, topk, kv_cache, logit_mask)
+    idx, logprob = drop_masked(np.array(idx[0].tolist(), dtype=np.int64), np.array(logprob[0].tolist(), dtype=np.float64))
+    topk = len(idx)
+    # 每一行: 属于哪个候选动作, 累计分数, 下一步输入的 output id
+    owner = np.arange(topk)
+    row_scores = logprob.copy()
+    row_out = idx.copy()
+    beam_cache = kv_cache.fork(topk)
+    for step in range(ahead_step):
+        alive = row_scores >= row_scores.max() - prune
+        if not alive.all():
+            owner, row_scores, row_out = owner[alive], row_scores[alive], row_out[alive]
+            beam_cache.select(to_model_input(model, np.nonzero(alive)[0], device))
+        next_id = output_to_input_ids(row_out.tolist(), acition_dict_toid, output_action_dict_toact)
+        next_id = to_model_input(model, np.array(next_id, dtype=np.int64)[:, None], device)
+        next_idx, next_logprob = model.play_logprob_topk_batch(next_id, None, beam_width, beam_cache)
+        next_idx = np.array(next_idx.tolist(), dtype=np.int64)
+        child_scores = row_scores[:, None] + np.array(next_logprob.tolist(), dtype=np.float64) * pow(ahead_p, step + 1)
+        # 每个候选动作只保留自己最好的 beam_width 个子序列: 按分数排序后, 再按候选动作稳定排序得到每行在组内的名次
+        flat = np.argsort(-child_scores, axis=None, kind="stable")
+        parent, child = np.unravel_index(flat, child_scores.shape)
+        child_owner = owner[parent]
+        group = np.argsort(child_owner, kind="stable")
+        grouped = child_owner[group]
+        rank = np.empty(len(flat), dtype=np.int64)
+        rank[group] = np.arange(len(flat)) - np.searchsorted(grouped, grouped)
+        keep = rank < beam_width
+        parent, child = parent[keep], child[keep]
+        owner = owner[parent]
+        row_scores = child_scores[parent, child]
+        row_out = next_idx[parent, child]
+        beam_cache.select(to_model_input(model, parent, device))
+    return idx, np.exp(logprob), owner_best(topk, owner, row_scores)
 
+def generate_answer_ahead(model, input_actions, input_pos, acition_dict_toid, output_action_dict_toact, device, topk, ahead_step, ahead_p, kv_cache=None):
+    input_id = encode_actions(input_actions, acition_dict_toid)
+    if isinstance(input_id, str):
+        return input_id
+    idx, probs, scores = generate_answer_lookahead(model, input_id, acition_dict_toid, output_action_dict_toact, device,
+                                                   topk, ahead_step, ahead_p, kv_cache)
+    best = int(np.argmax(scores))
+    return idx[best].item(), scores[best].item()
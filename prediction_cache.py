@@ -0,0 +1,118 @@
+import json
+import time
+import atexit
+import sqlite3
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+# 预测结果缓存: 内存 LRU + 模型目录下的 SQLite
+# key 是 (模型标识, topk, 是否屏蔽不合法动作, 编码之后的 token id) 的 hash, 重复分析同一局面时不再调用模型
+# SQLite 使用 WAL + synchronous=NORMAL, 每次写入立即提交(不 fsync, 写事务不会一直占着数据库, 多个进程/实例可以共用)
+# 数据库出错(例如被其他进程锁住超过 busy_timeout)时只打印警告, 之后只使用内存缓存
+
+
+class PredictionCache:
+    def __init__(self, model_id, db_path=None, max_bytes=64 * 1024 * 1024, mem_entries=4096, busy_timeout=0.5):
+        self.model_id = model_id
+        self.max_bytes = max_bytes
+        self.mem_entries = mem_entries
+        self.memory = OrderedDict()
+        self.db = None
+        self.db_bytes = 0
+        if db_path is not None:
+            try:
+                self.db = sqlite3.connect(db_path, timeout=busy_timeout, check_same_thread=False)
+                self.db.execute("PRAGMA journal_mode=WAL")
+                self.db.execute("PRAGMA synchronous=NORMAL")
+                self.db.execute("CREATE TABLE IF NOT EXISTS predictions "
+                                "(key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL)")
+                self.db.commit()
+                self.db_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()[0]
+                atexit.register(self.close)
+            except sqlite3.Error as e:
+                print(f"WARNING: 无法打开预测缓存 {db_path}: {e}")
+                self.db = None
+
+    def make_key(self, input_id, topk, masked=False):
+        h = hashlib.sha1(f"{self.model_id}|{topk}|{'legal|' if masked else ''}".encode("utf-8"))
+        h.update(np.asarray(input_id, dtype=np.int32).tobytes())
+        return h.hexdigest()
+
+    def get(self, input_id, topk, masked=False):
+        key = self.make_key(input_id, topk, masked)
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory.move_to_end(key)
+        else:
+            value = self.get_db(key)
+            if value is None:
+                return None
+            self.put_memory(key, value)
+        return np.array(value[0], dtype=np.int64), np.array(value[1], dtype=np.float32)
+
+    def put(self, input_id, topk, action_ids, action_probs, masked=False):
+        key = self.make_key(input_id, topk, masked)
+        value = [[int(i) for i in action_ids], [float(p) for p in action_probs]]
+        self.put_memory(key, value)
+        if self.db is None:
+            return
+        text = json.dumps(value)
+        try:
+            with self.db:
+                row = self.db.execute("SELECT size FROM predictions WHERE key = ?", (key,)).fetchone()
+                self.db.execute("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)",
+                                (key, text, len(text), time.time()))
+                removed = self.evict(len(text) - (0 if row is None else row[0]))
+            self.db_bytes += len(text) - (0 if row is None else row[0]) - removed
+        except sqlite3.Error as e:
+            self.db_error(e)
+
+    def get_db(self, key):
+        if self.db is None:
+            return None
+        try:
+            row = self.db.execute("SELECT value FROM predictions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            with self.db:
+                self.db.execute("UPDATE predictions SET last_used = ? WHERE key = ?", (time.time(), key))
+            return json.loads(row[0])
+        except sqlite3.Error as e:
+            self.db_error(e)
+            return None
+
+    def db_error(self, e):
+        print(f"WARNING: 预测缓存数据库出错, 之后只使用内存缓存: {e}")
+        self.close()
+
+    def close(self):
+        if self.db is not None:
+            try:
+                self.db.close()
+            except sqlite3.Error:
+                pass
+            self.db = None
+
+    def put_memory(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.mem_entries:
+            self.memory.popitem(last=False)
+
+    def evict(self, added):
+        # 加上这次写入超过大小上限时删除最久没有使用的记录, 删到上限的 90%, 返回删掉的字节数
+        db_bytes = self.db_bytes + added
+        if db_bytes <= self.max_bytes:
+            return 0
+        target = db_bytes - self.max_bytes * 0.9
+        removed = 0
+        keys = []
+        for key, size in self.db.execute("SELECT key, size FROM predictions ORDER BY last_used"):
+            keys.append((key,))
+            removed += size
+            if removed >= target:
+                break
+        self.db.executemany("DELETE FROM predictions WHERE key = ?", keys)
+        return removed
@@ -0,0 +1,83 @@
+import sys
+import json
+import time
+import argparse
+
+from game_controller_v2 import GameController
+from game_utils import GameArgs, parse_history_name
+from play_util import load_model, generate_answer
+
+# 对比 fp32 模型和 int8 量化模型在历史对局上的速度以及预测是否一致
+# 用法: python quant_check.py history/No Variant_2P_xxx.json ... [--model model/xxx] [--topk 10]
+
+
+def history_inputs(controller, file_name):
+    variant, players = parse_history_name(file_name)
+    with open(file_name, 'r') as file:
+        history_data = json.load(file)
+    game_args = dict(
+        players=players,
+        players_card=5 if players <= 3 else 4,
+        AIplayer=[],
+        variant=variant,
+        random_start=False,
+        start_card=None,
+        allow_drawback=False
+    )
+    controller.start_game(GameArgs(**game_args))
+    controller.load_history(history_data)
+    for index in range(len(history_data)):
+        controller.active_pid = history_data[index]["active_pid"]
+        yield controller.get_histroy_tokens(index)
+
+
+def timed_answer(model_data, input_tokens, topk):
+    model, _, action_dict_toid, _, _, device = model_data
+    start = time.perf_counter()
+    action_ids, _ = generate_answer(model, input_tokens, action_dict_toid, device, topk)
+    return action_ids.tolist(), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--topk", type=int, default=10)
+    args = parser.parse_args()
+
+    model_name = args.model
+    if model_name is None:
+        with open(f'user_config.json', 'r') as json_file:
+            model_name = json.load(json_file)["model"]
+
+    fp32_data = load_model(model_name)
+    int8_data = load_model(model_name, quantize=True)
+    controller = GameController(fp32_data)
+
+    steps = 0
+    top1_same = 0
+    topk_overlap = 0
+    fp32_time = 0
+    int8_time = 0
+    for file_name in args.files:
+        for input_tokens in history_inputs(controller, file_name):
+            fp32_ids, fp32_dt = timed_answer(fp32_data, input_tokens, args.topk)
+            int8_ids, int8_dt = timed_answer(int8_data, input_tokens, args.topk)
+            steps += 1
+            fp32_time += fp32_dt
+            int8_time += int8_dt
+            top1_same += fp32_ids[0] == int8_ids[0]
+            topk_overlap += len(set(fp32_ids) & set(int8_ids)) / args.topk
+
+    if steps == 0:
+        print("没有可以对比的步骤")
+        sys.exit(1)
+    print(f"steps: {steps}")
+    print(f"fp32 latency: {fp32_time / steps * 1000:.2f} ms/step")
+    print(f"int8 latency: {int8_time / steps * 1000:.2f} ms/step (x{fp32_time / int8_time:.2f})")
+    print(f"top-1 agreement: {top1_same / steps * 100:.2f}%")
+    print(f"top-{args.topk} overlap: {topk_overlap / steps * 100:.2f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import math
+import time
+
+import numpy as np
+
+from batch_env import BatchHanabiEnv, policy_actions
+from legal_actions import action_arrays
+from game_variants import UNKNOWN
+from play_util import generate_answer_ids
+
+# 决策时的信息集蒙特卡洛搜索(只在根节点展开, 每次模拟一个确定化的世界):
+# 1. 按 controller.belief(提示以及已经公开/看得到的牌)抽出自己的手牌以及剩余牌堆(其他玩家的手牌是已知的)
+# 2. 先执行根节点的候选动作, 之后所有座位都按模型策略(topk 中第一个合法动作)走到终局, 终局分数就是这次模拟的价值
+#    自己的座位从真实的 KV cache 分叉; 其他座位从空的 cache 开始, 只看到根节点之后的行动, 策略比真实对局中弱
+#    到达模型长度上限被截断的模拟不计入
+# 所有模拟放在同一个 BatchHanabiEnv 里同步进行, 每一步只需要一次 batch 前向
+# 按 UCB 把每一批模拟分配给候选动作, 在时间预算内重复
+
+
+def hidden_cards(controller, pid):
+    # 其他玩家的手牌中有看不到的牌(例如在线对局中替别人预测)时无法确定化
+    return any(card // 10 == UNKNOWN or card % 10 == UNKNOWN
+               for player in controller.players if player.pid != pid for card in player.cards)
+
+
+def sample_world(belief, pid, rng, tries=20):
+    # 按 belief 的候选牌以及剩余数量依次抽出自己的每张手牌(顺序随机), 剩下的牌打乱作为牌堆
+    # 返回 (自己的手牌, 剩余牌堆), 抽不出一致的手牌时忽略提示信息随机发牌
+    remaining = np.maximum(belief.remaining(pid), 0)
+    masks = belief.masks[pid, :belief.hand_len[pid]]
+    for _ in range(tries):
+        counts = remaining.copy()
+        hand = [0] * len(masks)
+        for pos in rng.permutation(len(masks)):
+            weights = masks[pos] * counts
+            total = weights.sum()
+            if total == 0:
+                break
+            card = rng.choice(100, p=weights / total)
+            counts[card] -= 1
+            hand[pos] = int(card)
+        else:
+            deck = np.repeat(np.arange(100), counts)
+            rng.shuffle(deck)
+            return hand, deck.tolist()
+    cards = np.repeat(np.arange(100), remaining)
+    rng.shuffle(cards)
+    return cards[:len(masks)].tolist(), cards[len(masks):].tolist()
+
+
+def env_action(actions, n):
+    # GameController.get_action 的结果 -> BatchHanabiEnv 的动作数组(循环填满 n 局)
+    return tuple(np.resize(array, n) for array in action_arrays(actions))
+
+
+class ISMCTS:
+    def __init__(self, controller, pid, batch_size=64, topk=5, max_depth=0, exploration=0.5, seed=None):
+        self.controller = controller
+        self.pid = pid
+        self.batch_size = batch_size
+        self.topk = topk
+        # rollout 的最大步数, 0 表示走到终局
+        self.max_depth = max_depth
+        self.exploration = exploration
+        self.rng = np.random.default_rng(seed)
+        self.env = BatchHanabiEnv(controller, controller.variant.name, controller.players_count,
+                                  list(range(batch_size)))
+        self.max_score = 5 * controller.variant.suits
+        # 摸完最后一张牌之后剩余的回合数(牌堆还没摸完时为 -1), 与 BatchHanabiEnv 的计数方式相同
+        self.final_turns = controller.final_turns
+        self.root_cache = self.sync_cache()
+
+    def sync_cache(self):
+        # 自己座位的 KV cache 需要包含 AIids 中的全部 token(命中预测缓存时可能还没有喂给模型)
+        controller = self.controller
+        kv_cache = controller.AIcaches[self.pid]
+        if kv_cache is None:
+            kv_cache = controller.model.new_cache()
+            controller.AIcaches[self.pid] = kv_cache
+        new_ids = controller.AIids[self.pid][kv_cache.seq_len:]
+        if len(new_ids) > 0:
+            generate_answer_ids(controller.model, new_ids, controller.device, 1, kv_cache)
+        return kv_cache
+
+    def legal_mask(self, actions):
+        # 在真实局面(自己的手牌不影响合法性)上检查候选动作
+        controller = self.controller
+        rows = np.zeros(len(actions), dtype=np.int64)
+        return controller.outputs.action_legal(self.pid, action_arrays(actions), *controller.hand_arrays(), rows=rows)
+
+    def rollout(self, root_actions, deadline):
+        # 每一局抽一个世界, 执行 root_actions 中对应的动作后按策略走到终局, 返回 (每局的分数, 是否可以计入)
+        # 超过 deadline 时还没有结束的局、以及到达模型长度上限被截断的局都不是终局分数, 不计入
+        # 达到 max_depth 时按当前分数计入
+        controller, env = self.controller, self.env
+        N, P = env.n_games, env.players
+        hands, decks = [], []
+        for _ in range(N):
+            hand, deck = sample_world(controller.belief, self.pid, self.rng)
+            hands.append([hand if pid == self.pid else list(player.cards)
+                          for pid, player in enumerate(controller.players)])
+            decks.append(deck)
+        env.set_state(controller, self.pid, hands, decks, self.final_turns)
+        # 自己座位从真实的 KV cache 分叉, 其他座位看不到自己的牌, 从空的 cache 开始
+        caches = [controller.model.new_cache() for _ in range(P)]
+        caches[self.pid] = self.root_cache.fork(N)
+        # 这一回合的 token 已经在 cache 中了
+        env.observe()
+        env.seq_len[:, self.pid] = len(controller.AIids[self.pid])
+        env.step(root_actions)
+        depth = 0
+        while self.max_depth == 0 or depth < self.max_depth:
+            pid = env.active_pid
+            ids, mask = env.observe()
+            if env.done.all():
+                break
+            if time.perf_counter() >= deadline:
+                return np.where(env.mistake >= 3, 0, env.score), env.done & ~env.truncated
+            chosen, _ = policy_actions(env, controller.model, controller.device, caches[pid], ids, mask, self.topk)
+            env.step(chosen)
+            depth += 1
+        return np.where(env.mistake >= 3, 0, env.score), ~env.truncated
+
+    def search(self, actions, time_budget):
+        # 返回每个候选动作的平均分数(不合法的动作为 -inf)以及模拟次数
+        values = np.full(len(actions), -np.inf)
+        visits = np.zeros(len(actions), dtype=np.int64)
+        legal = np.nonzero(self.legal_mask(actions))[0]
+        if len(legal) == 0:
+            return values, visits
+        n = np.zeros(len(legal))
+        total = np.zeros(len(legal))
+        start = time.perf_counter()
+        while True:
+            # 同一批里已经分配的模拟按当前平均值计入(virtual visit), 避免整批都给同一个动作
+            vn, vt = n.copy(), total.copy()
+            assign = []
+            for _ in range(self.batch_size):
+                if (vn == 0).any():
+                    k = int(np.argmin(vn))
+                else:
+                    ucb = vt / vn / self.max_score + self.exploration * np.sqrt(math.log(vn.sum()) / vn)
+                    k = int(np.argmax(ucb))
+                vt[k] += vt[k] / vn[k] if vn[k] > 0 else 0
+                vn[k] += 1
+                assign.append(k)
+            batch_start = time.perf_counter()
+            root_actions = env_action([actions[legal[k]] for k in assign], self.batch_size)
+            scores, finished = self.rollout(root_actions, start + time_budget)
+            batch_seconds = time.perf_counter() - batch_start
+            for k, score, ok in zip(assign, scores, finished):
+                if ok:
+                    n[k] += 1
+                    total[k] += score
+            if time.perf_counter() - start + batch_seconds > time_budget:
+                break
+        values[legal] = np.where(n > 0, total / np.maximum(n, 1), -np.inf)
+        visits[legal] = n
+        return values, visits
+
+
+def ismcts_search(controller, pid, actions, time_budget, batch_size=64, topk=5, max_depth=0, seed=None):
+    # 看不到其他玩家的牌, 或者时间预算内有合法动作一次完整的模拟都没有时返回 None(保持模型的顺序)
+    if hidden_cards(controller, pid):
+        return None, None
+    searcher = ISMCTS(controller, pid, batch_size, topk, max_depth, seed=seed)
+    values, visits = searcher.search(actions, time_budget)
+    if (visits[searcher.legal_mask(actions)] == 0).any():
+        return None, None
+    return values, visits
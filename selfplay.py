@@ -0,0 +1,248 @@
+import sys
+import json
+import time
+import random
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+import play_util
+from play_util import load_model
+from game_controller_v2 import GameController
+from game_utils import GameArgs
+from batch_env import run_batch
+from legal_actions import action_arrays
+
+# 离线自我对局: 在 game_controller_v2 之上发牌并执行 出牌/弃牌/提示, 规则与 online_handle_* 完全一致
+# 每个座位都是 AI, 从 topk 预测中选择第一个合法的动作
+# 用法: python selfplay.py --variant "Rainbow (5 Suits)" --players 2 3 --games 500 --workers 4
+# --batch N: 使用 batch_env 同时进行 N 局, 每一步一次 batch 前向(结果与逐局进行相同)
+
+_worker_model = None
+_worker_controller = None
+
+
+def clue_orders(controller, to_pid, clue_type, clue_value):
+    player = controller.players[to_pid]
+    codes = np.array([player.cards], dtype=np.int64).reshape(1, -1)
+    touched = controller.outputs.touched(codes, np.array([len(player.cards)]), np.array([clue_type]), np.array([clue_value]))
+    return [player.online_order[pos] for pos in np.nonzero(touched[0])[0]]
+
+
+def is_legal(controller, action, pid):
+    # 规则在 OutputTable.action_legal 中, 与合法输出掩码以及 batch_env 相同
+    if action is None:
+        return False
+    if action["type"] in ("play", "discard") and action["pid"] != pid:
+        return False
+    return bool(controller.outputs.action_legal(pid, action_arrays([action]), *controller.hand_arrays())[0])
+
+
+def fallback_action(controller, pid):
+    # topk 中没有合法动作时: 能弃牌就弃最老的牌, 否则给下家一个合法提示, 都不行就出最老的牌
+    if controller.clue < 8:
+        return controller.get_action("discard-myself-POS0", pid)
+    to_rpid = 1
+    for clue_type, clue_values in ((1, range(1, 6)), (0, range(controller.variant.color_clue_count))):
+        for clue_value in clue_values:
+            clue = f"{'R' if clue_type == 1 else 'I'}{clue_value}"
+            action = controller.get_action(f"clue-myself->PRT{to_rpid}-{clue}", pid)
+            if is_legal(controller, action, pid):
+                return action
+    return controller.get_action("play-myself-POS0", pid)
+
+
+def context_full(controller, pid):
+    # 轮到 pid 时会追加所有人的手牌以及对局信息 token, 超过模型长度时无法继续预测
+    next_tokens = sum(1 + len(player.cards) for player in controller.players) + len(controller.options_token_list) + 2
+    return len(controller.AIids[pid]) + next_tokens > controller.model.params.max_seq_len
+
+
+def play_game(model_data, variant, players, seed, topk=5, controller=None):
+    start = time.perf_counter()
+    rnd = random.Random(seed)
+    if controller is None:
+        controller = GameController(model_data)
+    players_card = 5 if players <= 3 else 4
+    controller.start_game(GameArgs(players=players, players_card=players_card, AIplayer=list(range(players)),
+                                   variant=variant, random_start=True))
+    deck = list(controller.variant.deck)
+    rnd.shuffle(deck)
+    order = 0
+
+    def draw(pid):
+        nonlocal order
+        suit, rank = deck.pop()
+        controller.online_handle_draw({"playerIndex": pid, "order": order, "suitIndex": suit, "rank": rank})
+        order += 1
+
+    for pid in range(players):
+        for _ in range(players_card):
+            draw(pid)
+
+    max_score = 5 * len(controller.Irank)
+    final_turns = None
+    turn = 0
+    ai_rank = []
+    truncated = False
+    while True:
+        pid = turn % players
+        if context_full(controller, pid):
+            truncated = True
+            break
+        _, action_details = controller.call_AI_predict(pid, topk)
+        action = None
+        for rank, action_detail in enumerate(action_details):
+            if is_legal(controller, action_detail, pid):
+                action = action_detail
+                ai_rank.append(rank)
+                break
+        if action is None:
+            action = fallback_action(controller, pid)
+            ai_rank.append(topk)
+
+        if action["type"] == "clue":
+            controller.online_handle_clue({
+                "giver": pid, "target": action["to"],
+                "clue": {"type": action["clue_type"], "value": action["clue_value"]},
+                "list": clue_orders(controller, action["to"], action["clue_type"], action["clue_value"]),
+            })
+        else:
+            player = controller.players[pid]
+            card_order = player.online_order[action["pos"]]
+            suit, rank = controller.parse_card(player.cards[action["pos"]])
+            action_data = {"playerIndex": pid, "order": card_order, "suitIndex": suit, "rank": rank}
+            if action["type"] == "play" and controller.Irank[suit] + 1 == rank:
+                controller.online_handle_play(action_data)
+            else:
+                action_data["failed"] = action["type"] == "play"
+                controller.online_handle_discard(action_data)
+            if len(deck) > 0:
+                draw(pid)
+                if len(deck) == 0:
+                    # 摸到最后一张牌之后每个人(包括自己)还有一回合
+                    final_turns = players + 1
+        controller.online_handle_status({"clues": controller.clue, "score": controller.score,
+                                         "maxScore": sum(controller.Hrank)})
+        turn += 1
+        if final_turns is not None:
+            final_turns -= 1
+        if controller.mistake >= 3 or controller.score == max_score or final_turns == 0:
+            break
+
+    strikeout = controller.mistake >= 3
+    return {
+        "seed": seed,
+        "variant": variant,
+        "players": players,
+        "score": 0 if strikeout else controller.score,
+        "raw_score": controller.score,
+        "strikeout": strikeout,
+        "truncated": truncated,
+        "turns": turn,
+        "ai_rank": float(np.mean(ai_rank)) if len(ai_rank) > 0 else 0.0,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def _init_worker(model_name, engine, quantize, threads):
+    global _worker_model, _worker_controller
+    if play_util.torch is not None and threads > 0:
+        play_util.torch.set_num_threads(threads)
+    _worker_model = load_model(model_name, quantize, "eager", engine)
+    _worker_controller = GameController(_worker_model)
+
+
+def _worker_play(args):
+    variant, players, seed, topk = args
+    return [play_game(_worker_model, variant, players, seed, topk, _worker_controller)]
+
+
+def _worker_play_batch(args):
+    variant, players, seeds, topk = args
+    return run_batch(_worker_controller, variant, players, seeds, topk)
+
+
+def run_selfplay(model_name, variant, players, games, workers=1, topk=5, seed=0, engine="torch", quantize=False,
+                 batch=0):
+    if batch > 0:
+        worker = _worker_play_batch
+        jobs = [(variant, players, list(range(seed + i, seed + min(i + batch, games))), topk)
+                for i in range(0, games, batch)]
+    else:
+        worker = _worker_play
+        jobs = [(variant, players, seed + i, topk) for i in range(games)]
+    start = time.perf_counter()
+    if workers <= 1:
+        _init_worker(model_name, engine, quantize, 0)
+        results = [result for job in jobs for result in worker(job)]
+    else:
+        # 每个进程单线程推理, 进程之间并行
+        with Pool(workers, initializer=_init_worker, initargs=(model_name, engine, quantize, 1)) as pool:
+            results = [result for results in pool.imap_unordered(worker, jobs, chunksize=1 if batch > 0 else 4)
+                       for result in results]
+    return summarize(results, time.perf_counter() - start, workers)
+
+
+def summarize(results, elapsed, workers=1):
+    scores = np.array([result["score"] for result in results])
+    max_score = 5 * (6 if "6 Suits" in results[0]["variant"] else 4 if "4 Suits" in results[0]["variant"] else 5)
+    # games/sec 只统计对局本身(不含各进程加载模型的时间)
+    play_seconds = sum(result["seconds"] for result in results) / min(max(workers, 1), len(results))
+    return {
+        "variant": results[0]["variant"],
+        "players": results[0]["players"],
+        "games": len(results),
+        "mean": float(scores.mean()),
+        "std": float(scores.std()),
+        "perfect": float(np.mean(scores == max_score)),
+        "strikeout": float(np.mean([result["strikeout"] for result in results])),
+        "truncated": float(np.mean([result["truncated"] for result in results])),
+        "distribution": {int(score): int(count) for score, count in zip(*np.unique(scores, return_counts=True))},
+        "games_per_sec": len(results) / play_seconds,
+        "elapsed": elapsed,
+        "results": sorted(results, key=lambda result: result["seed"]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="headless self-play")
+    parser.add_argument("--model", default=None, help="模型目录, 不填时使用 user_config.json 中的 model")
+    parser.add_argument("--variant", nargs="+", default=["No Variant"])
+    parser.add_argument("--players", nargs="+", type=int, default=[2])
+    parser.add_argument("--games", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--topk", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", default="torch")
+    parser.add_argument("--quantize", action="store_true")
+    parser.add_argument("--batch", type=int, default=0, help="同时进行的对局数, 0 表示逐局进行")
+    parser.add_argument("--output", default=None, help="把每局结果写入 json 文件")
+    args = parser.parse_args()
+
+    model_name = args.model
+    if model_name is None:
+        with open(f'user_config.json', 'r') as json_file:
+            model_name = json.load(json_file)["model"]
+
+    summaries = []
+    for variant in args.variant:
+        for players in args.players:
+            summary = run_selfplay(model_name, variant, players, args.games, args.workers, args.topk, args.seed,
+                                   args.engine, args.quantize, args.batch)
+            summaries.append(summary)
+            distribution = " ".join(f"{score}:{count}" for score, count in summary["distribution"].items())
+            print(f"{variant} {players}P: {summary['games']} games, mean {summary['mean']:.2f} ± {summary['std']:.2f}, "
+                  f"perfect {summary['perfect'] * 100:.1f}%, strikeout {summary['strikeout'] * 100:.1f}%, "
+                  f"truncated {summary['truncated'] * 100:.1f}%, "
+                  f"{summary['games_per_sec']:.2f} games/s ({summary['elapsed']:.1f}s total)")
+            print(f"  scores {distribution}")
+            sys.stdout.flush()
+    if args.output is not None:
+        with open(args.output, 'w') as json_file:
+            json.dump(summaries, json_file, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
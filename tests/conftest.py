@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 测试用的小模型: 词表覆盖 2-5 人、最多 6 种颜色的全部 token, 权重随机(固定种子)
+
+
+def build_vocab():
+    suits = [str(i) for i in range(6)] + ["_"]
+    ranks = [str(i) for i in range(1, 6)] + ["_"]
+    tokens = [f"light-PR{i}" for i in range(5)]
+    tokens += [f"light-I{s}R{r}-I{ks}R{kr}" for s in suits for r in ranks for ks in suits for kr in ranks]
+    tokens += [f"light-myself-I{ks}R{kr}" for ks in suits for kr in ranks]
+    tokens += [f"Players-{i}" for i in range(2, 6)] + [f"Suits-{i}" for i in (4, 5, 6)]
+    for special in ["Rainbow", "Black", "Brown", "White", "Pink", "Gray", "Null", "Omni", "Dark Rainbow"]:
+        for last in (3, 4, 5):
+            tokens.append(f"Special-I{last}-{special}")
+    tokens += ["myturn-1"] + [f"clues-{i}" for i in range(9)]
+    for action in ("play", "discard"):
+        tokens += [f"{action}-myself-POS{p}" for p in range(5)]
+        tokens += [f"{action}-PR{r}-POS{p}" for r in range(1, 5) for p in range(5)]
+    tokens += [f"played-I{s}R{r}" for s in suits for r in ranks] + [f"lossed-I{s}R{r}" for s in suits for r in ranks]
+    clues = [f"I{i}" for i in range(6)] + [f"R{i}" for i in range(1, 6)]
+    tokens += [f"clue-myself->PRT{t}-{c}" for t in range(1, 5) for c in clues]
+    tokens += [f"clue-PRF{f}->myself-{c}" for f in range(1, 5) for c in clues]
+    tokens += [f"clue-PRF{f}->PRT{t}-{c}" for f in range(1, 5) for t in range(1, 5) if f != t for c in clues]
+    outputs = [f"play-myself-POS{p}" for p in range(5)] + [f"discard-myself-POS{p}" for p in range(5)]
+    outputs += [f"clue-myself->PRT{t}-{c}" for t in range(1, 5) for c in clues]
+    return tokens, outputs
+
+
+def write_model(path, moe=False, seed=1):
+    torch = pytest.importorskip("torch")
+    from net.model import ModelArgs, Transformer
+    os.makedirs(path, exist_ok=True)
+    tokens, outputs = build_vocab()
+    with open(f"{path}/dict.json", "w") as file:
+        json.dump(tokens, file)
+    with open(f"{path}/output_dict.json", "w") as file:
+        json.dump(outputs, file)
+    model_args = dict(dim=64, n_layers=2, n_heads=4, n_kv_heads=4, vocab_size=len(tokens) + 1,
+                      output_vocab_size=len(outputs) + 1, multiple_of=16, max_seq_len=900, dropout=0.0)
+    if moe:
+        model_args["moe_config"] = {"top_k": 2, "experts": 4, "rdim": 1}
+    with open(f"{path}/config.json", "w") as file:
+        json.dump({"model_args": model_args}, file)
+    torch.manual_seed(seed)
+    model = Transformer(ModelArgs(**model_args))
+    # 与训练时 torch.compile 保存的 checkpoint 一样带 _orig_mod. 前缀
+    torch.save({"_orig_mod." + k: v for k, v in model.state_dict().items()}, f"{path}/model.pth")
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def model_dir(tmp_path_factory):
+    return write_model(tmp_path_factory.mktemp("model"))
+
+
+@pytest.fixture(scope="session")
+def moe_model_dir(tmp_path_factory):
+    return write_model(tmp_path_factory.mktemp("moe"), moe=True)
+
+
+@pytest.fixture(scope="session")
+def model_data(model_dir):
+    from play_util import load_model
+    return load_model(model_dir)
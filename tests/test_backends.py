@@ -0,0 +1,25 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from net.backends import set_backend
+from play_util import load_model
+
+
+@pytest.mark.parametrize("backend", ["script", "export"])
+def test_backend_matches_eager(model_dir, tmp_path, backend):
+    # 没有 KV cache 的整段前向(最后一个位置以及回放时的多个决策点)都交给后端, 结果与 eager 相同
+    model = load_model(model_dir)[0]
+    ids = torch.randint(1, model.vocab_size, (1, 150), generator=torch.Generator().manual_seed(0))
+    positions = torch.tensor([10, 50, 149])
+    expected = model.play_topk(ids, 5), model.play_topk_positions(ids, positions, 5)
+    set_backend(model, backend, str(tmp_path / "model_export.pt2"))
+    assert model.runner is not None
+    calls = []
+    runner = model.runner
+    model.runner = lambda tokens, positions: calls.append(len(positions)) or runner(tokens, positions)
+    results = model.play_topk(ids, 5), model.play_topk_positions(ids, positions, 5)
+    assert calls == [1, 3]
+    for (idx, probs), (expected_idx, expected_probs) in zip(results, expected):
+        assert idx.tolist() == expected_idx.tolist()
+        torch.testing.assert_close(probs, expected_probs, atol=1e-4, rtol=1e-4)
@@ -0,0 +1,119 @@
+import random
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from batch_env import BatchHanabiEnv, run_batch
+from game_controller_v2 import GameController
+from game_variants import UNKNOWN
+from legal_actions import ACTION_PLAY, ACTION_DISCARD, ACTION_CLUE
+from selfplay import play_game
+
+
+@pytest.fixture(scope="module")
+def controller(model_data):
+    return GameController(model_data)
+
+
+def set_hand(env, g, pid, cards):
+    env.hand_suit[g, pid, :len(cards)] = [card // 10 for card in cards]
+    env.hand_rank[g, pid, :len(cards)] = [card % 10 for card in cards]
+    env.known_suit[g, pid] = UNKNOWN
+    env.known_rank[g, pid] = UNKNOWN
+    env.hand_size[g, pid] = len(cards)
+
+
+def action(n, action_type, pos=0, to_pid=0, clue_type=0, clue_value=0):
+    full = lambda value: np.full(n, value, dtype=np.int64)
+    return full(action_type), full(pos), full(to_pid), full(clue_type), full(clue_value)
+
+
+def test_deal_follows_seeded_deck(controller):
+    # 与 selfplay.play_game 一样: 玩法的牌堆经 random.Random(seed).shuffle, 从末尾开始依次发给每个玩家
+    env = BatchHanabiEnv(controller, "Rainbow (5 Suits)", 3, [0, 3])
+    for g, seed in enumerate([0, 3]):
+        deck = list(env.variant.deck)
+        random.Random(seed).shuffle(deck)
+        for pid in range(3):
+            expected = [suit * 10 + rank for suit, rank in (deck.pop() for _ in range(5))]
+            assert env.hand_codes()[g, pid].tolist() == expected
+        assert env.deck_pos[g] == 15
+    assert env.clue.tolist() == [8, 8] and env.active_pid == 0
+
+
+def test_play_and_discard(controller):
+    env = BatchHanabiEnv(controller, "No Variant", 2, [0, 1, 2])
+    for g in range(3):
+        set_hand(env, g, 0, [1, 3, 11, 2, 5])
+    env.clue[2] = 7
+    drawn = env.deck[np.arange(3), env.deck_pos].tolist()
+    types = np.array([ACTION_PLAY, ACTION_PLAY, ACTION_DISCARD])
+    env.step((types, np.array([0, 1, 4]), np.zeros(3, dtype=np.int64), np.zeros(3, dtype=np.int64),
+              np.zeros(3, dtype=np.int64)))
+    # 第 0 局打出 1, 第 1 局打出 3 出错, 第 2 局弃掉唯一的 5(这种颜色最多只能到 4), 恢复一个提示
+    assert env.score.tolist() == [1, 0, 0] and env.mistake.tolist() == [0, 1, 0]
+    assert env.Irank[:, 0].tolist() == [1, 0, 0] and env.Hrank[:, 0].tolist() == [5, 5, 4]
+    assert env.discard_count[1, 0, 3] == 1 and env.discard_count[2, 0, 5] == 1
+    assert env.clue.tolist() == [8, 8, 8]
+    # 后面的牌向前移动, 新摸的牌放在最后
+    hands = env.hand_codes()[:, 0].tolist()
+    assert hands[0] == [3, 11, 2, 5, drawn[0][0] * 10 + drawn[0][1]]
+    assert hands[1] == [1, 11, 2, 5, drawn[1][0] * 10 + drawn[1][1]]
+    assert hands[2] == [1, 3, 11, 2, drawn[2][0] * 10 + drawn[2][1]]
+    assert env.active_pid == 1 and env.turns.tolist() == [1, 1, 1]
+
+
+def test_rainbow_clue_marks_known_cards(controller):
+    env = BatchHanabiEnv(controller, "Rainbow (5 Suits)", 2, [0])
+    set_hand(env, 0, 1, [42, 13, 22, 4, 31])
+    env.step(action(1, ACTION_CLUE, to_pid=1, clue_type=0, clue_value=1))
+    # 彩虹和 I1R3 都被颜色 1 触及, 先标记为颜色 1
+    assert env.known_suit[0, 1].tolist() == [1, 1, UNKNOWN, UNKNOWN, UNKNOWN]
+    env.turn = 2
+    env.step(action(1, ACTION_CLUE, to_pid=1, clue_type=0, clue_value=2))
+    # 之前标记为颜色 1 的彩虹又被颜色 2 触及, 标记为彩虹
+    assert env.known_suit[0, 1].tolist() == [4, 1, 2, UNKNOWN, UNKNOWN]
+    env.turn = 4
+    env.step(action(1, ACTION_CLUE, to_pid=1, clue_type=1, clue_value=4))
+    assert env.known_rank[0, 1].tolist() == [UNKNOWN, UNKNOWN, UNKNOWN, 4, UNKNOWN]
+    assert env.clue.tolist() == [5]
+
+
+def test_final_round_after_last_card(controller):
+    # 摸到最后一张牌之后每个人(包括自己)还有一回合
+    env = BatchHanabiEnv(controller, "No Variant", 2, [0])
+    env.deck_pos[0] = env.deck_size - 1
+    env.clue[0] = 0
+    env.step(action(1, ACTION_DISCARD))
+    assert env.deck_pos[0] == env.deck_size and env.final_turns.tolist() == [2]
+    env.step(action(1, ACTION_DISCARD))
+    assert not env.done[0] and env.hand_size[0].tolist() == [5, 4]
+    env.step(action(1, ACTION_DISCARD))
+    assert env.done[0] and env.turns.tolist() == [3]
+    # 结束的对局不再有合法动作, 也不再变化
+    assert not env.legal(action(1, ACTION_PLAY)).any()
+    env.step(action(1, ACTION_DISCARD))
+    assert env.turns.tolist() == [3] and env.hand_size[0].tolist() == [4, 4]
+
+
+def test_context_limit_truncates(controller):
+    env = BatchHanabiEnv(controller, "No Variant", 2, [0, 1])
+    env.max_seq_len = 10
+    ids, mask = env.observe()
+    assert env.done.all() and env.truncated.all()
+    assert not mask.any()
+    assert all(result["truncated"] for result in env.results())
+
+
+@pytest.mark.parametrize("variant,players", [("No Variant", 2), ("Rainbow (5 Suits)", 3),
+                                             ("Null (5 Suits)", 4), ("Brown (6 Suits)", 5)])
+def test_run_batch_matches_play_game(model_data, controller, variant, players):
+    # 同样的种子, 同步进行的 N 局与逐局的 play_game 结果相同
+    seeds = [0, 1, 2]
+    refs = [play_game(model_data, variant, players, seed, 5, controller) for seed in seeds]
+    results = run_batch(controller, variant, players, seeds, 5)
+    for result, ref in zip(results, refs):
+        for key in ("score", "raw_score", "strikeout", "truncated", "turns", "ai_rank"):
+            assert result[key] == ref[key], key
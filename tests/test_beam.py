@@ -0,0 +1,61 @@
+import numpy as np
+
+from play_util import generate_answer_beam
+
+# 脚本化的模型: 第一次(根节点)输出固定的候选动作, 之后每行下一步的 log 概率只取决于这一行最后输入的 id
+ROOT = (np.array([0, 1, 2]), np.array([-0.1, -1.0, -3.0]))
+NEXT = {
+    0: (np.array([0, 1, 2]), np.array([-5.0, -6.0, -7.0])),
+    1: (np.array([2, 0, 1]), np.array([-1.5, -4.0, -5.0])),
+    2: (np.array([2, 0, 1]), np.array([-1.0, -4.0, -5.0])),
+}
+
+
+class ScriptedCache:
+    def __init__(self):
+        self.seq_len = 0
+
+    def fork(self, n):
+        cache = ScriptedCache()
+        cache.seq_len = self.seq_len
+        return cache
+
+    def select(self, rows):
+        pass
+
+
+class ScriptedModel:
+    is_numpy = True
+
+    def new_cache(self):
+        return ScriptedCache()
+
+    def play_logprob_topk_batch(self, input, pad_mask, topk, kv_cache=None, logit_mask=None):
+        first = kv_cache.seq_len == 0
+        kv_cache.seq_len += input.shape[1]
+        if first:
+            return ROOT[0][None, :topk], ROOT[1][None, :topk]
+        idx = np.stack([NEXT[i][0][:topk] for i in input[:, -1]])
+        logprob = np.stack([NEXT[i][1][:topk] for i in input[:, -1]])
+        return idx, logprob
+
+
+def beam(ahead_step, prune):
+    outputs = ["o0", "o1", "o2"]
+    return generate_answer_beam(ScriptedModel(), [5], {name: i for i, name in enumerate(outputs)}, outputs, "cpu",
+                                3, ahead_step, 1, 1.0, prune)
+
+
+def test_scores_without_pruning():
+    idx, probs, scores = beam(2, 100.0)
+    assert idx.tolist() == [0, 1, 2]
+    np.testing.assert_allclose(probs, np.exp(ROOT[1]))
+    np.testing.assert_allclose(scores, [-0.1 - 5.0 - 5.0, -1.0 - 1.5 - 1.0, -3.0 - 1.0 - 1.0])
+
+
+def test_pruned_candidates_rank_last():
+    # 第 0 层剪掉 C(-3.0), 第 1 层剪掉 A(-5.1); 只推演了更浅的 C 的分数比推演到底的 B(-3.5) 高, 但不能排在 B 前面
+    _, _, scores = beam(2, 2.0)
+    assert scores[0] == -np.inf and scores[2] == -np.inf
+    np.testing.assert_allclose(scores[1], -3.5)
+    assert np.argmax(scores) == 1
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from game_controller_v2 import CardBelief
+from game_variants import get_variant
+
+
+def test_clue_keeps_touched_and_removes_untouched():
+    belief = CardBelief(get_variant("No Variant"), 2, 5)
+    for card in (1, 12, 23):
+        belief.draw(0, card)
+    belief.clue(0, [0], 1, 1)
+    possible = belief.possible(0)
+    assert possible.shape == (3, 100)
+    # 被 1 提示触及的只能是 1, 没有被触及的不可能是 1
+    assert set(np.nonzero(possible[0])[0]) == {1, 11, 21, 31, 41}
+    assert not possible[1, [1, 11, 21, 31, 41]].any() and possible[1, 12]
+    # P1 看得到 P0 的牌, 自己剩余的候选中要减掉
+    belief.draw(1, 2)
+    assert belief.remaining(1)[1] == 2 and belief.remaining(0)[1] == 3
+
+
+def test_reveal_shifts_hand():
+    belief = CardBelief(get_variant("No Variant"), 2, 5)
+    for card in (1, 12, 23):
+        belief.draw(0, card)
+    belief.clue(0, [1], 0, 1)
+    belief.reveal(0, 0, 1, True)
+    assert belief.hand_len[0] == 2 and belief.unseen[1] == 2
+    # 原来第二张(被颜色 1 触及)移动到了第一张
+    assert set(np.nonzero(belief.possible(0)[0])[0]) == {11, 12, 13, 14, 15}
+
+
+def touched_and_untouched(variant, clue_type, clue_value):
+    # P0 两张牌: 第一张被提示触及, 第二张没有; 返回两张牌的候选集合
+    belief = CardBelief(get_variant(variant), 2, 5)
+    belief.draw(0, 99)
+    belief.draw(0, 99)
+    belief.clue(0, [0], clue_type, clue_value)
+    possible = belief.possible(0)
+    return set(np.nonzero(possible[0])[0]), set(np.nonzero(possible[1])[0])
+
+
+SUIT1 = {11, 12, 13, 14, 15}
+SPECIAL = {41, 42, 43, 44, 45}
+ALL = {suit * 10 + rank for suit in range(5) for rank in range(1, 6)}
+
+
+@pytest.mark.parametrize("variant,clue_type,clue_value,touched", [
+    # 彩虹被所有颜色提示触及
+    ("Rainbow (5 Suits)", 0, 1, SUIT1 | SPECIAL),
+    # 白色/Null 不被颜色提示触及
+    ("White (5 Suits)", 0, 1, SUIT1),
+    ("Null (5 Suits)", 0, 1, SUIT1),
+    # 粉色/恶魔被所有数字提示触及
+    ("Pink (5 Suits)", 1, 2, {2, 12, 22, 32} | SPECIAL),
+    ("Omni (5 Suits)", 1, 2, {2, 12, 22, 32} | SPECIAL),
+    ("Omni (5 Suits)", 0, 1, SUIT1 | SPECIAL),
+    # 棕色/Null 不被数字提示触及
+    ("Brown (5 Suits)", 1, 2, {2, 12, 22, 32}),
+    ("Null (5 Suits)", 1, 2, {2, 12, 22, 32}),
+])
+def test_special_suit_clues(variant, clue_type, clue_value, touched):
+    possible, untouched = touched_and_untouched(variant, clue_type, clue_value)
+    assert possible == touched
+    assert untouched == ALL - touched
+
+
+def test_one_card_suit_counts():
+    # 暗色玩法的特殊颜色每个数字只有一张: 别人手中有黑色 1 时, 自己的牌不可能是黑色 1
+    belief = CardBelief(get_variant("Black (6 Suits)"), 2, 5)
+    assert belief.unseen[51] == 1 and belief.unseen[1] == 3
+    belief.draw(0, 99)
+    assert belief.possible(0)[0, 51]
+    belief.draw(1, 51)
+    assert not belief.possible(0)[0, 51] and belief.possible(1)[0, 51]
+    # 弃掉之后所有人都知道它不在任何人手中
+    belief.reveal(1, 0, 51, True)
+    assert belief.remaining(1)[51] == 0 and belief.remaining(0)[1] == 3
@@ -0,0 +1,108 @@
+import time
+import random
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from conftest import build_vocab
+from endgame import EndgameSolver
+from game_variants import get_variant
+from legal_actions import OutputTable
+
+_, OUTPUTS = build_vocab()
+
+
+def position(variant, Irank, clue=8, mistake=0):
+    # EndgameSolver 只读取 controller 的这些属性
+    variant = get_variant(variant)
+    return SimpleNamespace(variant=variant, players_count=2, Irank=list(Irank), score=sum(Irank), clue=clue,
+                           mistake=mistake, outputs=OutputTable(OUTPUTS, variant))
+
+
+def solve(controller, hands, pid, turns):
+    controller.players_count = len(hands)
+    return EndgameSolver(controller, hands, time.perf_counter() + 60).value(pid, turns)
+
+
+def test_plays_in_order():
+    controller = position("No Variant", [3, 4, 4, 4, 4])
+    assert solve(controller, [[4], [5]], 0, 2) == 21
+    assert solve(controller, [[4], [5]], 0, 1) == 20
+
+
+def test_waits_for_partner():
+    # P0 的 5 要等 P1 先打出 4, 没有提示时先弃一张没用的牌
+    controller = position("No Variant", [3, 4, 4, 4, 4], clue=1)
+    assert solve(controller, [[5], [4]], 0, 2) == 20
+    assert solve(controller, [[5], [4]], 0, 3) == 21
+    controller = position("No Variant", [3, 4, 4, 4, 4], clue=0)
+    assert solve(controller, [[5, 22], [4]], 0, 3) == 21
+
+
+def test_third_mistake_scores_zero():
+    controller = position("No Variant", [3, 4, 4, 4, 4], clue=8, mistake=2)
+    # 提示已满不能弃牌, 手里只有打不出的牌时只能出错(或者提示)
+    assert solve(controller, [[5], [13]], 0, 1) == 19
+    assert solve(controller, [[5], [4]], 0, 2) == 20
+
+
+def test_root_values():
+    controller = position("Null (5 Suits)", [3, 4, 4, 4, 0], clue=8)
+    hands = [[4, 41], [44]]
+    solver = EndgameSolver(controller, hands, time.perf_counter() + 60)
+    actions = [
+        {"type": "play", "pid": 0, "pos": 0},
+        {"type": "play", "pid": 0, "pos": 1},
+        {"type": "discard", "pid": 0, "pos": 0},
+        {"type": "clue", "from": 0, "to": 1, "clue_type": 1, "clue_value": 4},
+        None,
+    ]
+    values = solver.root_values(0, 2, actions)
+    # 提示已满不能弃牌, Null 不被任何提示触及
+    assert values[:2] == [16, 16] and values[2:] == [-np.inf] * 3
+    values = solver.root_values(0, 4, actions)
+    assert values[:2] == [17, 17]
+
+
+def brute_force(controller, hands, Irank, clue, mistake, pid, turns):
+    # 不做任何剪枝以及合并的参考实现
+    if mistake >= 3:
+        return 0
+    if turns == 0 or sum(Irank) == 5 * len(Irank):
+        return sum(Irank)
+    P = len(hands)
+    next_pid = (pid + 1) % P
+    best = -1
+    for i, code in enumerate(hands[pid]):
+        rest = [list(hand) for hand in hands]
+        rest[pid].pop(i)
+        suit, rank = code // 10, code % 10
+        if Irank[suit] + 1 == rank:
+            played = list(Irank)
+            played[suit] = rank
+            gain = rank == 5 and clue < 8
+            best = max(best, brute_force(controller, rest, played, clue + gain, mistake, next_pid, turns - 1))
+        else:
+            best = max(best, brute_force(controller, rest, Irank, clue, mistake + 1, next_pid, turns - 1))
+        if clue < 8:
+            best = max(best, brute_force(controller, rest, Irank, clue + 1, mistake, next_pid, turns - 1))
+    if clue > 0 and any(controller.outputs.cluable[code] for to_pid in range(P) if to_pid != pid
+                        for code in hands[to_pid]):
+        best = max(best, brute_force(controller, hands, Irank, clue - 1, mistake, next_pid, turns - 1))
+    if best < 0:
+        best = brute_force(controller, hands, Irank, clue, mistake, next_pid, turns - 1)
+    return best
+
+
+@pytest.mark.parametrize("variant", ["No Variant", "Rainbow (5 Suits)", "Null (5 Suits)"])
+def test_matches_brute_force(variant):
+    rnd = random.Random(0)
+    for _ in range(20):
+        players = rnd.choice([2, 3])
+        Irank = [rnd.randint(2, 5) for _ in range(5)]
+        controller = position(variant, Irank, clue=rnd.randint(0, 8), mistake=rnd.randint(0, 2))
+        hands = [[rnd.randrange(5) * 10 + rnd.randint(1, 5) for _ in range(rnd.randint(1, 3))] for _ in range(players)]
+        turns = rnd.randint(1, players + 1)
+        expected = brute_force(controller, hands, Irank, controller.clue, controller.mistake, 0, turns)
+        assert solve(controller, hands, 0, turns) == expected, (hands, Irank, controller.clue, turns)
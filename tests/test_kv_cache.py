@@ -0,0 +1,84 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from play_util import load_model
+
+# KV cache 增量推理(逐段输入、fork/select、segment/extend、truncate)的输出与整段前向相同
+# 动态量化按每次输入的数值范围量化激活, 增量与整段的结果只能近似相等
+
+
+@pytest.fixture(scope="module", params=["plain", "quantized", "moe"])
+def model(request, model_dir, moe_model_dir):
+    if request.param == "moe":
+        return load_model(moe_model_dir)[0], 1e-4
+    if request.param == "quantized":
+        return load_model(model_dir, quantize=True)[0], 2e-2
+    return load_model(model_dir)[0], 1e-4
+
+
+def random_ids(model, length, seed=0):
+    return torch.randint(1, model.vocab_size, (1, length), generator=torch.Generator().manual_seed(seed))
+
+
+def full_logits(model, ids):
+    with torch.no_grad():
+        return model(ids)[:, -1]
+
+
+def step(model, ids, kv_cache):
+    with torch.no_grad():
+        return model(ids, kv_cache=kv_cache)[:, -1]
+
+
+def test_incremental_matches_full_forward(model):
+    model, atol = model
+    ids = random_ids(model, 80)
+    kv_cache = model.new_cache()
+    for start, end in ((0, 40), (40, 41), (41, 42), (42, 80)):
+        logits = step(model, ids[:, start:end], kv_cache)
+        torch.testing.assert_close(logits, full_logits(model, ids[:, :end]), atol=atol, rtol=0)
+    assert kv_cache.seq_len == 80
+
+
+def test_fork_and_select(model):
+    model, atol = model
+    ids = random_ids(model, 30, seed=1)
+    conts = random_ids(model, 3 * 6, seed=2).view(3, 6)
+    kv_cache = model.new_cache()
+    step(model, ids, kv_cache)
+    forked = kv_cache.fork(3)
+    logits = step(model, conts[:, :4], forked)
+    for row in range(3):
+        expected = full_logits(model, torch.cat((ids, conts[row:row + 1, :4]), dim=1))
+        torch.testing.assert_close(logits[row:row + 1], expected, atol=atol, rtol=0)
+    # 只保留第 2 行以及两份第 0 行, 每行继续输入不同的 token
+    rows = [2, 0, 0]
+    forked.select(torch.tensor(rows))
+    logits = step(model, conts[:, 4:], forked)
+    for i, row in enumerate(rows):
+        expected = full_logits(model, torch.cat((ids, conts[row:row + 1, :4], conts[i:i + 1, 4:]), dim=1))
+        torch.testing.assert_close(logits[i:i + 1], expected, atol=atol, rtol=0)
+    # fork 之后原来的缓存不受影响
+    assert kv_cache.seq_len == 30
+    torch.testing.assert_close(step(model, conts[:1, :1], kv_cache),
+                               full_logits(model, torch.cat((ids, conts[:1, :1]), dim=1)), atol=atol, rtol=0)
+
+
+def test_segment_extend_and_truncate(model):
+    model, atol = model
+    ids = random_ids(model, 70, seed=3)
+    kv_cache = model.new_cache()
+    step(model, ids[:, :50], kv_cache)
+    # 前缀缓存: 拷贝出的多段依次接到另一份只算了前 20 个位置的缓存后面
+    segments = [kv_cache.segment(20, 35), kv_cache.segment(35, 50)]
+    other = model.new_cache()
+    step(model, ids[:, :20], other)
+    other.extend(segments)
+    assert other.seq_len == 50
+    torch.testing.assert_close(step(model, ids[:, 50:70], other), full_logits(model, ids), atol=atol, rtol=0)
+    # 撤回: 截到前 30 个位置之后重新输入
+    kv_cache.truncate(30)
+    assert kv_cache.seq_len == 30
+    torch.testing.assert_close(step(model, ids[:, 30:45], kv_cache), full_logits(model, ids[:, :45]),
+                               atol=atol, rtol=0)
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from conftest import build_vocab
+from game_variants import get_variant, UNKNOWN_CARD
+from legal_actions import OutputTable
+
+_, OUTPUTS = build_vocab()
+
+
+def legal_tokens(variant, pid, hands, clue):
+    outputs = OutputTable(OUTPUTS, get_variant(variant))
+    hand_len = max(len(hand) for hand in hands)
+    hand_codes = np.zeros((1, len(hands), hand_len), dtype=np.int64)
+    for to_pid, hand in enumerate(hands):
+        hand_codes[0, to_pid, :len(hand)] = hand
+    hand_lens = np.array([[len(hand) for hand in hands]])
+    mask = outputs.legal_mask(pid, hand_codes, hand_lens, np.array([clue]))[0]
+    return {token for token, legal in zip(OUTPUTS, mask) if legal}
+
+
+def test_play_discard_and_clue_counts():
+    hands = [[1, 2, 3], [1, 13]]
+    legal = legal_tokens("No Variant", 0, hands, 8)
+    assert {f"play-myself-POS{pos}" for pos in range(3)} <= legal
+    # 提示数已满时不能弃牌, 手牌之外的位置不能出
+    assert not any(token.startswith("discard") for token in legal)
+    assert "play-myself-POS3" not in legal
+    clues = {token for token in legal if token.startswith("clue")}
+    assert clues == {"clue-myself->PRT1-R1", "clue-myself->PRT1-R3", "clue-myself->PRT1-I0", "clue-myself->PRT1-I1"}
+
+    legal = legal_tokens("No Variant", 0, hands, 0)
+    assert "discard-myself-POS2" in legal
+    assert not any(token.startswith("clue") for token in legal)
+
+
+def test_target_seat_is_relative():
+    # 3 人局中 P2 的下家是 P0, 相对位置超过人数的提示不合法
+    hands = [[1], [2], [3]]
+    clues = {token for token in legal_tokens("No Variant", 2, hands, 4) if token.startswith("clue")}
+    assert clues == {"clue-myself->PRT1-R1", "clue-myself->PRT1-I0", "clue-myself->PRT2-R2", "clue-myself->PRT2-I0"}
+
+
+def test_special_suit_clues():
+    # 彩虹没有自己的颜色提示, 但被所有颜色提示触及
+    legal = legal_tokens("Rainbow (5 Suits)", 0, [[1], [44]], 4)
+    assert {"clue-myself->PRT1-I0", "clue-myself->PRT1-I3", "clue-myself->PRT1-R4"} <= legal
+    assert "clue-myself->PRT1-I4" not in legal
+    # Null 不被任何提示触及
+    legal = legal_tokens("Null (5 Suits)", 0, [[1], [44]], 4)
+    assert not any(token.startswith("clue") for token in legal)
+
+
+def test_unknown_cards_may_be_touched():
+    legal = legal_tokens("No Variant", 0, [[1], [UNKNOWN_CARD]], 4)
+    assert {"clue-myself->PRT1-R5", "clue-myself->PRT1-I4"} <= legal
+    assert "clue-myself->PRT1-I5" not in legal
+
+
+# P1 手里是特殊颜色(最后一种颜色)的 2 以及普通的 I1R3, 手写每种玩法 P0 可以给 P1 的提示
+SPECIAL_CLUES = [
+    ("No Variant", {"I1", "I4", "R2", "R3"}),
+    # 彩虹: 没有自己的颜色提示, 被所有颜色提示触及
+    ("Rainbow (5 Suits)", {"I0", "I1", "I2", "I3", "R2", "R3"}),
+    # 粉色: 被所有数字提示触及, 有自己的颜色提示
+    ("Pink (5 Suits)", {"I1", "I4", "R1", "R2", "R3", "R4", "R5"}),
+    # 棕色: 不被数字提示触及
+    ("Brown (5 Suits)", {"I1", "I4", "R3"}),
+    # 白色: 没有自己的颜色提示, 也不被其他颜色触及
+    ("White (5 Suits)", {"I1", "R2", "R3"}),
+    # Null: 不被任何提示触及
+    ("Null (5 Suits)", {"I1", "R3"}),
+    # 恶魔: 被所有提示触及, 没有自己的颜色提示
+    ("Omni (5 Suits)", {"I0", "I1", "I2", "I3", "R1", "R2", "R3", "R4", "R5"}),
+    ("Pink (6 Suits)", {"I1", "I5", "R1", "R2", "R3", "R4", "R5"}),
+    ("Rainbow (6 Suits)", {"I0", "I1", "I2", "I3", "I4", "R2", "R3"}),
+]
+
+
+@pytest.mark.parametrize("variant,clues", SPECIAL_CLUES)
+def test_variant_legal_masks(variant, clues):
+    special = (get_variant(variant).suits - 1) * 10 + 2
+    hands = [[1, 21], [special, 13]]
+    actions = {"play-myself-POS0", "play-myself-POS1", "discard-myself-POS0", "discard-myself-POS1"}
+    expected = actions | {f"clue-myself->PRT1-{clue}" for clue in clues}
+    assert legal_tokens(variant, 0, hands, 4) == expected
+    # 提示数已满不能弃牌, 没有提示数不能提示
+    assert legal_tokens(variant, 0, hands, 8) == expected - {"discard-myself-POS0", "discard-myself-POS1"}
+    assert legal_tokens(variant, 0, hands, 0) == actions
+
+
+def test_variant_legal_masks_three_players():
+    # 3 人局中 P1 行动: 下家 P2 是 PRT1, P0 是 PRT2; 粉色的 5 被所有数字提示触及
+    hands = [[45], [3], [2, 33]]
+    expected = {"play-myself-POS0", "discard-myself-POS0"}
+    expected |= {f"clue-myself->PRT1-{clue}" for clue in ("I0", "I3", "R2", "R3")}
+    expected |= {f"clue-myself->PRT2-{clue}" for clue in ("I4", "R1", "R2", "R3", "R4", "R5")}
+    assert legal_tokens("Pink (5 Suits)", 1, hands, 1) == expected
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from play_util import load_model, export_numpy_weights, generate_answer_ids
+
+
+@pytest.fixture(scope="module", params=["dense", "moe"])
+def engines(request, model_dir, moe_model_dir):
+    model_name = model_dir if request.param == "dense" else moe_model_dir
+    export_numpy_weights(model_name)
+    return load_model(model_name)[0], load_model(model_name, engine="numpy")[0]
+
+
+def random_ids(model, length, seed=0):
+    return np.random.default_rng(seed).integers(1, model.vocab_size, length).tolist()
+
+
+def test_logits_match_torch(engines):
+    torch_model, numpy_model = engines
+    ids = random_ids(numpy_model, 120)
+    with torch.no_grad():
+        expected = torch_model(torch.tensor([ids]))[0, -1].numpy()
+    logits = numpy_model.forward(np.array([ids]))[0, -1]
+    np.testing.assert_allclose(logits, expected, atol=1e-4)
+
+
+def test_kv_cache_matches_full_forward(engines):
+    _, numpy_model = engines
+    ids = random_ids(numpy_model, 90, seed=1)
+    kv_cache = numpy_model.new_cache()
+    generate_answer_ids(numpy_model, ids[:40], "cpu", 5, kv_cache)
+    cached_idx, cached_probs = generate_answer_ids(numpy_model, ids[40:], "cpu", 5, kv_cache)
+    idx, probs = generate_answer_ids(numpy_model, ids, "cpu", 5)
+    assert cached_idx.tolist() == idx.tolist()
+    np.testing.assert_allclose(cached_probs, probs, atol=1e-4)
+
+
+def test_padded_batch_matches_torch(engines):
+    torch_model, numpy_model = engines
+    ids = random_ids(numpy_model, 80, seed=2)
+    input_ids = [ids[:20], ids[:55], ids]
+    # 与 batch_env 一样左侧补 <pad>
+    batch_id = np.zeros((len(input_ids), len(ids)), dtype=np.int64)
+    pad_mask = np.zeros((len(input_ids), len(ids)), dtype=bool)
+    for i, input_id in enumerate(input_ids):
+        batch_id[i, len(ids) - len(input_id):] = input_id
+        pad_mask[i, len(ids) - len(input_id):] = True
+    expected_idx, expected_probs = torch_model.play_topk_batch(torch.from_numpy(batch_id), torch.from_numpy(pad_mask), 5)
+    results = zip(*numpy_model.play_topk_batch(batch_id, pad_mask, 5))
+    for input_id, (idx, probs), e_idx, e_probs in zip(input_ids, results, expected_idx, expected_probs):
+        assert idx.tolist() == e_idx.tolist()
+        np.testing.assert_allclose(probs, e_probs.numpy(), atol=1e-4)
+        # padding 不影响结果
+        single_idx, _ = generate_answer_ids(numpy_model, input_id, "cpu", 5)
+        assert idx.tolist() == single_idx.tolist()
@@ -0,0 +1,56 @@
+import numpy as np
+
+from prediction_cache import PredictionCache
+
+
+def test_roundtrip_through_sqlite(tmp_path):
+    db_path = str(tmp_path / "predictions.sqlite")
+    cache = PredictionCache("model-a", db_path)
+    cache.put([1, 2, 3], 5, [7, 8], [0.75, 0.25])
+    cache.put([1, 2, 3], 5, [9], [1.0], masked=True)
+    cache.close()
+    # 内存层是空的, 只能从 SQLite 读到
+    cache = PredictionCache("model-a", db_path)
+    idx, probs = cache.get([1, 2, 3], 5)
+    assert idx.tolist() == [7, 8]
+    np.testing.assert_allclose(probs, [0.75, 0.25])
+    assert cache.get([1, 2, 3], 5, masked=True)[0].tolist() == [9]
+    assert cache.get([1, 2, 3], 10) is None
+    assert PredictionCache("model-b", db_path).get([1, 2, 3], 5) is None
+    cache.close()
+
+
+def test_evicts_least_recently_used_rows(tmp_path):
+    cache = PredictionCache("model-a", str(tmp_path / "predictions.sqlite"), max_bytes=200, mem_entries=1)
+    for i in range(20):
+        cache.put([i], 5, [i, i + 1], [0.5, 0.5])
+    assert cache.db_bytes <= 200
+    rows = cache.db.execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()[0]
+    assert rows == cache.db_bytes
+    # 最新写入的还在, 最早的已经删除
+    assert cache.get([19], 5) is not None
+    assert cache.get([0], 5) is None
+    cache.close()
+
+
+def test_two_caches_share_one_database(tmp_path):
+    # 同一个模型目录下的两个实例(例如两个 GameController)交替读写
+    db_path = str(tmp_path / "predictions.sqlite")
+    first, second = PredictionCache("model-a", db_path), PredictionCache("model-a", db_path)
+    first.put([1], 5, [1], [1.0])
+    second.put([2], 5, [2], [1.0])
+    first.put([3], 5, [3], [1.0])
+    assert second.get([1], 5)[0].tolist() == [1]
+    assert first.get([2], 5)[0].tolist() == [2]
+    assert first.db is not None and second.db is not None
+    first.close()
+    second.close()
+
+
+def test_database_errors_fall_back_to_memory(tmp_path):
+    db_path = str(tmp_path / "predictions.sqlite")
+    cache = PredictionCache("model-a", db_path)
+    cache.db.execute("DROP TABLE predictions")
+    cache.put([1], 5, [4], [1.0])
+    assert cache.db is None
+    assert cache.get([1], 5)[0].tolist() == [4]
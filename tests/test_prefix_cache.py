@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from play_util import generate_answer_ids
+from net.prefix_cache import PrefixKVCache
+
+
+def filled_cache(model, ids):
+    kv_cache = model.new_cache()
+    generate_answer_ids(model, ids, "cpu", 5, kv_cache)
+    return kv_cache
+
+
+def test_miss_on_empty_tree(model_data):
+    model = model_data[0]
+    cache = PrefixKVCache(model)
+    kv_cache, matched = cache.match([5, 6, 7])
+    assert matched == 0
+    assert kv_cache.seq_len == 0
+
+
+def test_hit_reuses_common_prefix(model_data):
+    model = model_data[0]
+    cache = PrefixKVCache(model)
+    ids = list(range(10, 60))
+    cache.insert(ids, filled_cache(model, ids))
+    # 同一序列: 最后一个 token 留给模型
+    assert cache.match(ids)[1] == len(ids) - 1
+    # 共享前 30 个 token 的另一条序列
+    other = ids[:30] + list(range(200, 220))
+    kv_cache, matched = cache.match(other)
+    assert matched == 30 and kv_cache.seq_len == 30
+    idx, probs = generate_answer_ids(model, other[matched:], "cpu", 5, kv_cache)
+    expected_idx, expected_probs = generate_answer_ids(model, other, "cpu", 5)
+    assert idx.tolist() == expected_idx.tolist()
+    np.testing.assert_allclose(probs.numpy(), expected_probs.numpy(), atol=1e-4)
+    # 插入之后两条序列在第 30 个 token 处分叉
+    cache.insert(other, filled_cache(model, other))
+    assert cache.match(other)[1] == len(other) - 1
+    assert cache.match(ids)[1] == len(ids) - 1
+
+
+def test_evicts_least_recently_used_leaf(model_data):
+    model = model_data[0]
+    first, second, third = list(range(10, 50)), list(range(100, 140)), list(range(300, 340))
+    nbytes = filled_cache(model, first).segment(0, len(first))[2]
+    cache = PrefixKVCache(model, max_bytes=2 * nbytes)
+    cache.insert(first, filled_cache(model, first))
+    cache.insert(second, filled_cache(model, second))
+    # 访问 first 之后 second 是最久没有使用的
+    cache.match(first)
+    cache.insert(third, filled_cache(model, third))
+    assert cache.total_bytes <= cache.max_bytes
+    assert cache.match(first)[1] == len(first) - 1
+    assert cache.match(second)[1] == 0
+    assert cache.match(third)[1] == len(third) - 1
+
+
+def test_split_does_not_share_storage(model_data):
+    # 拆分之后两段各自只占自己的存储, 淘汰叶子节点时真正释放内存
+    model = model_data[0]
+    cache = PrefixKVCache(model)
+    ids = list(range(10, 60))
+    cache.insert(ids, filled_cache(model, ids))
+    other = ids[:30] + list(range(200, 220))
+    cache.insert(other, filled_cache(model, other))
+    head = cache.root.children[ids[0]]
+    tail = head.children[ids[30]]
+    assert len(head.ids) == 30 and len(tail.ids) == 20
+    for node in (head, tail):
+        storage = sum(t.untyped_storage().nbytes() for t in node.ks + node.vs)
+        assert storage == node.nbytes
+    assert cache.total_bytes == sum(node.nbytes for node in (head, tail, head.children[other[30]]))
@@ -0,0 +1,48 @@
+import random
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from game_controller_v2 import GameController
+from game_utils import GameArgs
+from search import ISMCTS, env_action
+
+
+def started_game(model_data, players=2):
+    controller = GameController(model_data)
+    controller.start_game(GameArgs(players=players, players_card=5, AIplayer=list(range(players)),
+                                   random_start=True))
+    deck = list(controller.variant.deck)
+    random.Random(0).shuffle(deck)
+    for order in range(5 * players):
+        suit, rank = deck.pop()
+        controller.online_handle_draw({"playerIndex": order // 5, "order": order, "suitIndex": suit, "rank": rank})
+    _, actions = controller.call_AI_predict(0, 5)
+    return controller, actions
+
+
+def root_actions(searcher, actions):
+    legal = [action for action, ok in zip(actions, searcher.legal_mask(actions)) if ok]
+    return env_action(legal, searcher.batch_size)
+
+
+def test_truncated_rollouts_are_not_counted(model_data):
+    controller, actions = started_game(model_data)
+    searcher = ISMCTS(controller, 0, batch_size=8, seed=0)
+    # 模型长度上限只比当前序列多一点: 每一局都会在终局之前被截断
+    searcher.env.max_seq_len = len(controller.AIids[0]) + 60
+    scores, finished = searcher.rollout(root_actions(searcher, actions), float("inf"))
+    assert searcher.env.truncated.all() and not finished.any()
+    values, visits = searcher.search(actions, 0.5)
+    assert (visits == 0).all()
+
+
+def test_finished_rollouts_are_counted(model_data):
+    controller, actions = started_game(model_data)
+    searcher = ISMCTS(controller, 0, batch_size=8, seed=0)
+    scores, finished = searcher.rollout(root_actions(searcher, actions), float("inf"))
+    assert searcher.env.done.all()
+    assert (finished == ~searcher.env.truncated).all() and finished.any()
+    assert ((scores >= 0) & (scores <= 25)).all()
@@ -0,0 +1,110 @@
+import random
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from game_controller_v2 import GameController
+from game_utils import GameArgs
+from selfplay import is_legal, fallback_action, clue_orders
+
+
+def state(controller):
+    belief = controller.belief
+    return (
+        [(list(p.cards), list(p.known_cards), list(p.online_order)) for p in controller.players],
+        list(controller.Irank), list(controller.Hrank), controller.clue, controller.score, controller.mistake,
+        controller.round_p, controller.round, controller.final_turns, list(controller.discard_cards),
+        list(controller.discard_count), dict(controller.order_slot), [list(t) for t in controller.AItokens],
+        [list(ids) for ids in controller.AIids], [list(m) for m in controller.AImasks],
+        [len(preds) for preds in controller.AI_pred_cache],
+        belief.masks.tolist(), belief.hand_len.tolist(), belief.unseen.tolist(), belief.held.tolist(),
+    )
+
+
+def action_events(controller, action, pid, deck, order):
+    # 与 selfplay.play_game 相同的规则, 返回 (handler 名字, 数据) 的列表(出牌/弃牌之后摸牌)
+    events = []
+    if action["type"] == "clue":
+        events.append(("online_handle_clue", {
+            "giver": pid, "target": action["to"],
+            "clue": {"type": action["clue_type"], "value": action["clue_value"]},
+            "list": clue_orders(controller, action["to"], action["clue_type"], action["clue_value"])}))
+    else:
+        player = controller.players[pid]
+        suit, rank = controller.parse_card(player.cards[action["pos"]])
+        data = {"playerIndex": pid, "order": player.online_order[action["pos"]], "suitIndex": suit, "rank": rank}
+        if action["type"] == "play" and controller.Irank[suit] + 1 == rank:
+            events.append(("online_handle_play", data))
+        else:
+            data["failed"] = action["type"] == "play"
+            events.append(("online_handle_discard", data))
+        if deck:
+            suit, rank = deck.pop()
+            events.append(("online_handle_draw", {"playerIndex": pid, "order": order, "suitIndex": suit, "rank": rank}))
+    return events
+
+
+def run(controller, events, status=True):
+    for name, data in events:
+        getattr(controller, name)(data)
+    if status:
+        controller.online_handle_status({"clues": controller.clue, "score": controller.score,
+                                         "maxScore": sum(controller.Hrank)})
+
+
+def test_undo_restores_state_and_kv_cache(model_data):
+    players = 3
+    game = GameController(model_data)
+    reference = GameController(model_data)
+    for controller, drawback in ((game, True), (reference, False)):
+        controller.start_game(GameArgs(players=players, players_card=5, AIplayer=list(range(players)),
+                                       variant="Rainbow (5 Suits)", random_start=True, allow_drawback=drawback))
+    deck = list(game.variant.deck)
+    random.Random(0).shuffle(deck)
+    order = 0
+    for pid in range(players):
+        for _ in range(5):
+            suit, rank = deck.pop()
+            draw = [("online_handle_draw", {"playerIndex": pid, "order": order, "suitIndex": suit, "rank": rank})]
+            run(game, draw, False)
+            run(reference, draw, False)
+            order += 1
+
+    history = []
+    for turn in range(24):
+        pid = turn % players
+        ref_list, ref_actions = reference.call_AI_predict(pid, 5)
+        action_list, actions = game.call_AI_predict(pid, 5)
+        assert [a["token"] for a in action_list] == [a["token"] for a in ref_list]
+        np.testing.assert_allclose([a["probs"] for a in action_list], [a["probs"] for a in ref_list], atol=1e-5)
+        action = next((a for a in actions if is_legal(game, a, pid)), None) or fallback_action(game, pid)
+        before = state(game)
+        events = action_events(game, action, pid, deck, order)
+        order += any(name == "online_handle_draw" for name, _ in events)
+        run(game, events)
+        run(reference, events)
+        assert state(game) == state(reference)
+        history.append((pid, before, events))
+
+        if turn % 4 == 3:
+            # 撤回最近两次行动(中间还有一次预测, KV cache 已经超过快照), 检查状态之后按原样重做
+            (pid0, before0, events0), (pid1, before1, events1) = history[-2:]
+            after = state(game)
+            assert game.undo() and state(game) == before1
+            assert game.undo() and state(game) == before0
+            run(game, events0)
+            game.call_AI_predict(pid1, 5)
+            run(game, events1)
+            assert state(game) == after
+
+
+def test_undo_without_drawback(model_data):
+    controller = GameController(model_data)
+    controller.start_game(GameArgs(players=2, players_card=5, AIplayer=[0, 1], random_start=True))
+    for order in range(10):
+        controller.online_handle_draw({"playerIndex": order // 5, "order": order, "suitIndex": 0, "rank": 1})
+    controller.online_handle_discard({"playerIndex": 0, "order": 0, "suitIndex": 0, "rank": 1, "failed": True})
+    assert controller.undo_stack == [] and not controller.undo()
+    assert controller.mistake == 1